@@ -0,0 +1,445 @@
+import argparse
+import sys
+import os
+import shutil
+import json
+import time
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+import HD_DSC
+import Main
+
+
+def measure_peak_memory(function):
+    """
+    Measuring the peak memory allocated while running a function.
+
+    Only memory allocated by python and numpy is traced (see tracemalloc).
+
+    Parameters
+    ----------
+    function : callable
+        Function to run, called without arguments.
+
+    Returns
+    -------
+    peak_memory_mb : float
+        Peak traced memory in megabytes.
+
+    """
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    return peak / 1024**2
+
+def run_benchmark(function,
+                  repeat=3,
+                  measure_memory=True,
+                  ):
+    """
+    Timing a function several times and measuring its peak memory.
+
+    Timings are taken without tracing memory, the peak memory is measured in
+    one additional run.
+
+    Parameters
+    ----------
+    function : callable
+        Function to benchmark, called without arguments. If it returns a
+        dictionary of additional values (Ex. {"comparisons": 15}) they are
+        saved with the results.
+    repeat : int
+        Number of timed runs.
+    measure_memory : bool
+        If True the peak memory is measured.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with keys "seconds" (time of every run), "best_s",
+        "mean_s", "peak_memory_mb" (None if not measured) and the additional
+        values returned by the function.
+
+    """
+    seconds = []
+    extra = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        returned = function()
+        seconds.append(time.perf_counter() - start)
+        if isinstance(returned, dict):
+            extra = returned
+    
+    if measure_memory:
+        peak_memory_mb = measure_peak_memory(function)
+    else:
+        peak_memory_mb = None
+    
+    result = {"seconds": seconds,
+              "best_s": min(seconds),
+              "mean_s": float(np.mean(seconds)),
+              "peak_memory_mb": peak_memory_mb,
+              }
+    result.update(extra)
+    
+    return result
+
+def code_version():
+    """
+    Identifying the version of the code being benchmarked.
+
+    Returns
+    -------
+    version : str or None
+        Current git commit of the repository, None if it is not available.
+
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True,
+                              text=True,
+                              check=True,
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_stages(ct_folder_path,
+                     rtstruct_file_path,
+                     manual_segments,
+                     config,
+                     repeat=3,
+                     measure_memory=True,
+                     threads=1,
+                     ):
+    """
+    Benchmarking every stage of the analysis of a single patient.
+
+    Every run starts from the files, so nothing is reused between runs.
+
+    Parameters
+    ----------
+    ct_folder_path : str
+        Path to the CT folder of the patient.
+    rtstruct_file_path : str
+        Path to the RS.dcm file of the patient.
+    manual_segments : list
+        List of the manual segments of the patient.
+    config : dict
+        Content of the configuration file.
+    repeat : int
+        Number of timed runs of each stage.
+    measure_memory : bool
+        If True the peak memory of each stage is measured.
+    threads : int
+        If greater than 1, extract_hausdorff_dice is also benchmarked with
+        this number of threads, to compare it with a single thread.
+
+    Returns
+    -------
+    results : dict
+        Result of run_benchmark for each stage.
+
+    """
+    results = {}
+    
+    print("Benchmarking read_ct_slices")
+    results["read_ct_slices"] = run_benchmark(
+        lambda: {"slices": len(HD_DSC.read_ct_slices(ct_folder_path))},
+        repeat,
+        measure_memory,
+        )
+    
+    print("Benchmarking spacing_and_tolerance")
+    results["spacing_and_tolerance"] = run_benchmark(
+        lambda: HD_DSC.spacing_and_tolerance(ct_folder_path),
+        repeat,
+        measure_memory,
+        )
+    
+    print("Benchmarking create_labelmap")
+    results["create_labelmap"] = run_benchmark(
+        lambda: HD_DSC.create_labelmap(ct_folder_path,
+                                       rtstruct_file_path,
+                                       manual_segments[2],
+                                       ),
+        repeat,
+        measure_memory,
+        )
+    
+    print("Benchmarking compute_metrics")
+    reference_labelmap = HD_DSC.create_labelmap(ct_folder_path,
+                                                rtstruct_file_path,
+                                                manual_segments[2],
+                                                )
+    compared_labelmap = HD_DSC.create_labelmap(ct_folder_path,
+                                               rtstruct_file_path,
+                                               config["MBS segments"][2],
+                                               )
+    results["compute_metrics"] = run_benchmark(
+        lambda: HD_DSC.compute_metrics(reference_labelmap,
+                                       compared_labelmap,
+                                       ct_folder_path,
+                                       ),
+        repeat,
+        measure_memory,
+        )
+    
+    def extract(threads=1):
+        rows = HD_DSC.extract_hausdorff_dice(manual_segments,
+                                             config,
+                                             ct_folder_path,
+                                             rtstruct_file_path,
+                                             threads=threads,
+                                             )
+        return {"comparisons": len(rows)}
+    
+    extract_stages = [("extract_hausdorff_dice", 1)]
+    if threads > 1:
+        extract_stages.append((f"extract_hausdorff_dice_{threads}_threads",
+                               threads,
+                               ))
+    for stage, stage_threads in extract_stages:
+        print(f"Benchmarking {stage}")
+        results[stage] = run_benchmark(lambda: extract(stage_threads),
+                                       repeat,
+                                       measure_memory,
+                                       )
+        results[stage]["comparisons_per_s"] = (results[stage]["comparisons"]
+                                               / results[stage]["best_s"])
+    
+    # Speedup of the comparisons computed in parallel.
+    if threads > 1:
+        results[extract_stages[1][0]]["speedup"] = (
+            results["extract_hausdorff_dice"]["best_s"]
+            / results[extract_stages[1][0]]["best_s"]
+            )
+    
+    return results
+
+def benchmark_main(patients_folder_path,
+                   config_path,
+                   repeat=1,
+                   measure_memory=True,
+                   ):
+    """
+    Benchmarking the whole program on a copy of a folder of patients.
+
+    Every run works on a fresh temporary copy of the patients, so the
+    original folder is never modified. Unknown segments are resolved
+    without asking the user (see --non-interactive).
+
+    Parameters
+    ----------
+    patients_folder_path : str
+        Path to the folder where patients are stored.
+    config_path : str
+        Path to the configuration json file.
+    repeat : int
+        Number of timed runs.
+    measure_memory : bool
+        If True the peak memory is measured.
+
+    Returns
+    -------
+    result : dict
+        Same keys of run_benchmark, plus the number of patients, of
+        comparisons and the throughput in patients per minute and
+        comparisons per second.
+
+    """
+    patient_folders = HD_DSC.store_patients(patients_folder_path)
+    
+    def run_main():
+        with tempfile.TemporaryDirectory() as temp_folder:
+            input_folder_path = os.path.join(temp_folder,
+                                             "patients",
+                                             )
+            for patient_folder in patient_folders:
+                shutil.copytree(os.path.join(patients_folder_path,
+                                             patient_folder,
+                                             ),
+                                os.path.join(input_folder_path,
+                                             patient_folder,
+                                             ),
+                                )
+            excel_path = os.path.join(temp_folder,
+                                      "data.xlsx",
+                                      )
+            
+            # Only the time spent by the program is measured, not the copy.
+            start = time.perf_counter()
+            Main.main([input_folder_path,
+                       config_path,
+                       os.path.join(temp_folder,
+                                    "new_config.json",
+                                    ),
+                       excel_path,
+                       "--non-interactive",
+                       ])
+            elapsed = time.perf_counter() - start
+            
+            comparisons = len(HD_DSC.load_existing_dataframe(excel_path))
+        
+        return elapsed, comparisons
+    
+    seconds = []
+    for _ in range(repeat):
+        elapsed, comparisons = run_main()
+        seconds.append(elapsed)
+    
+    if measure_memory:
+        peak_memory_mb = measure_peak_memory(run_main)
+    else:
+        peak_memory_mb = None
+    
+    return {"seconds": seconds,
+            "best_s": min(seconds),
+            "mean_s": float(np.mean(seconds)),
+            "peak_memory_mb": peak_memory_mb,
+            "patients": len(patient_folders),
+            "comparisons": comparisons,
+            "patients_per_min": 60 * len(patient_folders) / min(seconds),
+            "comparisons_per_s": comparisons / min(seconds),
+            }
+
+def main(argv):
+    """
+    Benchmarking the stages of the pipeline and saving the results in a json
+    file, so that the results of different versions can be compared.
+
+    Parameters
+    ----------
+    argv : list
+        Command line arguments.
+
+    Returns
+    -------
+    results : dict
+        Benchmark results, as saved in the json file.
+
+    """
+    parser = argparse.ArgumentParser(description
+                                     = "Benchmark of HD, volDSC and surfDSC computation")
+    parser.add_argument(dest="output_path",
+                        metavar="output_path",
+                        help="Path to the json file where results are saved",
+                        )
+    parser.add_argument("-p", "--patients",
+                        dest="patients_folder_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to a folder of patients on which the
+                              whole program is benchmarked, if not given
+                              only the single stages are benchmarked"""
+                              )
+                        )
+    parser.add_argument("-r", "--repeat",
+                        dest="repeat",
+                        metavar="N",
+                        type=int,
+                        default=3,
+                        required=False,
+                        help="Number of timed runs of every stage",
+                        )
+    parser.add_argument("-t", "--threads",
+                        dest="threads",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help=("""Number of threads of extract_hausdorff_dice
+                              compared with a single thread (default 1, no
+                              comparison)"""
+                              )
+                        )
+    parser.add_argument("--no-memory",
+                        dest="no_memory",
+                        action="store_true",
+                        required=False,
+                        help=("""Do not measure peak memory (saves one run of
+                              every stage)"""
+                              )
+                        )
+    args = parser.parse_args(argv)
+    
+    # Test patient shipped with the repository.
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    tests_path = os.path.join(base_path,
+                              "tests",
+                              )
+    ct_folder_path = os.path.join(tests_path,
+                                  "test_patient",
+                                  "CT",
+                                  )
+    rtstruct_folder_path = os.path.join(tests_path,
+                                        "test_patient",
+                                        "RTSTRUCT",
+                                        )
+    rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
+    config_path = os.path.join(tests_path,
+                               "config.json",
+                               )
+    config = HD_DSC.read_config(config_path)
+    manual_segments = HD_DSC.extract_manual_segments(
+        HD_DSC.extract_all_segments(ct_folder_path,
+                                    rtstruct_file_path,
+                                    ),
+        config,
+        )
+    
+    results = {"version": code_version(),
+               "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": platform.python_version(),
+               "machine": platform.machine(),
+               "cpus": os.cpu_count(),
+               "repeat": args.repeat,
+               "stages": benchmark_stages(ct_folder_path,
+                                          rtstruct_file_path,
+                                          manual_segments,
+                                          config,
+                                          args.repeat,
+                                          not args.no_memory,
+                                          args.threads,
+                                          ),
+               }
+    
+    if args.patients_folder_path is not None:
+        print("Benchmarking Main.main")
+        results["stages"]["main"] = benchmark_main(
+            args.patients_folder_path.replace("\\", "/"),
+            os.path.join(base_path,
+                         "config.json",
+                         ),
+            args.repeat,
+            not args.no_memory,
+            )
+    
+    # Summary of the results.
+    for stage, result in results["stages"].items():
+        if result["peak_memory_mb"] is None:
+            memory = ""
+        else:
+            memory = f", peak memory {result['peak_memory_mb']:.1f} MB"
+        print(f"{stage}: best {result['best_s']:.3f} s{memory}")
+    
+    with open(args.output_path, "w") as outfile:
+        outfile.write(json.dumps(results,
+                                 indent=4,
+                                 ))
+    
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,14 +3,28 @@ import sys
 import os
 import shutil
 import json
+import time
+import hashlib
+import tempfile
+import re
+import difflib
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 
 import numpy as np
 import pandas as pd
 
 import pydicom
-from rt_utils import RTStructBuilder
+import cv2 as cv
+from rt_utils import RTStruct, RTStructBuilder
+from rt_utils import image_helper
 import surface_distance as sd
 
+import classification
+import telemetry
+
+
 
 def is_empty(folder_path):
     """
@@ -42,8 +56,9 @@ def patient_info(rtstruct_file_path,
 
     Parameters
     ----------
-    rtstruct_file_path : str
-        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
+    rtstruct_file_path : str or PatientStudy
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm") or an
+        already loaded patient study.
     information : str
         Name of the information that you want to extract from the RTSTRUCT.dcm
         file (Ex: "PatientID").
@@ -57,21 +72,50 @@ def patient_info(rtstruct_file_path,
 
     """
     try:
-        rtstruct_dataset = pydicom.dcmread(rtstruct_file_path)
+        if isinstance(rtstruct_file_path, PatientStudy):
+            rtstruct_dataset = rtstruct_file_path.rtstruct_dataset
+        else:
+            rtstruct_dataset = pydicom.dcmread(rtstruct_file_path)
         info = rtstruct_dataset[information].value
         return info
     except KeyError:
         sys.exit(f"There is no {information} in the RTSTRUCT file provided.")
         
+def series_file_paths(ct_folder_path):
+    """
+    Listing the files of a CT series.
+
+    Parameters
+    ----------
+    ct_folder_path : str or list
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or list of the paths of the files of the
+        series (see classification.classify_patient_files).
+
+    Returns
+    -------
+    ct_file_paths : list
+        Paths of the files of the series.
+
+    """
+    if isinstance(ct_folder_path, (list, tuple)):
+        return list(ct_folder_path)
+    
+    return [os.path.join(ct_folder_path,
+                         ct_image,
+                         )
+            for ct_image in os.listdir(ct_folder_path)]
+
 def read_ct_slices(ct_folder_path):
     """
     This function creates the CT volume from the DICOM series.
 
     Parameters
     ----------
-    ct_folder_path : str
+    ct_folder_path : str, list or PatientStudy
         Path to the folder containing DICOM series files
-        (Ex: path/to/CTfolder).
+        (Ex: path/to/CTfolder), list of the paths of the files of the series
+        or an already loaded patient study.
 
     Returns
     -------
@@ -79,14 +123,14 @@ def read_ct_slices(ct_folder_path):
         Ordered list of the slices that compose the CT volume.
 
     """
-    ct_images = os.listdir(ct_folder_path)
+    # The series of a loaded study has already been read and sorted.
+    if isinstance(ct_folder_path, PatientStudy):
+        return list(ct_folder_path.series_data)
+    
     slices = []
     
     # Reading each ct image using pydicom and storing the results in a list.
-    for ct_image in ct_images:
-        ct_file_path = os.path.join(ct_folder_path,
-                                    ct_image,
-                                    )
+    for ct_file_path in series_file_paths(ct_folder_path):
         single_slice = pydicom.read_file(ct_file_path,
                                          force=True,
                                          )
@@ -101,12 +145,14 @@ def read_ct_slices(ct_folder_path):
 def spacing_and_tolerance(ct_folder_path):
     """
     Computing voxel spacing of the loaded DICOM series.
+    
+    Only the headers of the CT files are read, pixel data are skipped.
 
     Parameters
     ----------
-    ct_folder_path : str
+    ct_folder_path : str or PatientStudy
         Path to the folder containing DICOM series files
-        (Ex: path/to/CTfolder).
+        (Ex: path/to/CTfolder) or an already loaded patient study.
 
     Returns
     -------
@@ -116,21 +162,10 @@ def spacing_and_tolerance(ct_folder_path):
         Greatest voxel dimension in millimeters.
 
     """
-    # Creating CT volume
-    slices = read_ct_slices(ct_folder_path)
-    
-    # Computing pixel spacing.
-    pixel_spacing_mm = list(map(float,
-                                slices[0].PixelSpacing._list,
-                                ),
-                            )
-    
-    # Computing slice thickness.
-    slice_thickness_mm = float(slices[0].SliceThickness)
+    geometry = get_ct_geometry(ct_folder_path)
     
     # Computing voxel spacing.
-    voxel_spacing_mm = pixel_spacing_mm.copy()
-    voxel_spacing_mm.append(slice_thickness_mm)
+    voxel_spacing_mm = list(geometry.voxel_spacing_mm)
     
     # Computing tolerance
     voxel_array = np.array(voxel_spacing_mm)
@@ -138,19 +173,911 @@ def spacing_and_tolerance(ct_folder_path):
     
     return voxel_spacing_mm, tolerance
 
+# Header tags needed to describe the geometry of a CT series.
+GEOMETRY_TAGS = ["PixelSpacing",
+                 "SliceThickness",
+                 "ImagePositionPatient",
+                 "ImageOrientationPatient",
+                 "Rows",
+                 "Columns",
+                 "SOPInstanceUID",
+                 ]
+
+# Greatest difference (in millimeters) allowed between two slice gaps of the
+# same CT series.
+SLICE_GAP_TOLERANCE_MM = 0.01
+
+class CTGeometry(namedtuple("CTGeometry",
+                            ["z_positions",
+                             "pixel_spacing_mm",
+                             "slice_thickness_mm",
+                             "orientation",
+                             "origin",
+                             "rows",
+                             "columns",
+                             "sop_instance_uids",
+                             "consistent_slice_gaps",
+                             ],
+                            )):
+    """
+    Geometry of a CT series, extracted from the slice headers.
+
+    Attributes
+    ----------
+    z_positions : tuple
+        Sorted z coordinates (mm) of the slices.
+    pixel_spacing_mm : tuple
+        In-plane pixel dimensions in millimeters.
+    slice_thickness_mm : float
+        Slice thickness in millimeters.
+    orientation : tuple
+        ImageOrientationPatient of the series (six direction cosines).
+    origin : tuple
+        ImagePositionPatient of the first slice.
+    rows : int
+        Number of rows of each slice.
+    columns : int
+        Number of columns of each slice.
+    sop_instance_uids : tuple
+        SOPInstanceUID of each slice, in the same order of z_positions.
+    consistent_slice_gaps : bool
+        True if all the gaps between consecutive slices are equal.
+
+    """
+    __slots__ = ()
+    
+    @property
+    def voxel_spacing_mm(self):
+        """
+        Voxel dimensions in millimeters.
+
+        """
+        return self.pixel_spacing_mm + (self.slice_thickness_mm,)
+    
+def ct_geometry_from_datasets(datasets):
+    """
+    Computing the geometry of a CT series from its slices.
+
+    Parameters
+    ----------
+    datasets : list
+        Slices (or slice headers) of the CT series, in any order.
+
+    Returns
+    -------
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    """
+    # Sorting every slice along z.
+    datasets = sorted(datasets,
+                      key=lambda x:x.ImagePositionPatient[2],
+                      )
+    first_slice = datasets[0]
+    z_positions = tuple(float(dataset.ImagePositionPatient[2])
+                        for dataset in datasets)
+    
+    # Checking that slices are equally spaced.
+    slice_gaps = np.diff(z_positions)
+    consistent_slice_gaps = bool(np.all(np.abs(slice_gaps - slice_gaps[:1])
+                                        <= SLICE_GAP_TOLERANCE_MM)
+                                 )
+    if not consistent_slice_gaps:
+        print("Warning: the gaps between CT slices are not uniform")
+    
+    geometry = CTGeometry(z_positions=z_positions,
+                          pixel_spacing_mm=tuple(map(float,
+                                                     first_slice.PixelSpacing,
+                                                     ),
+                                                 ),
+                          slice_thickness_mm=float(first_slice.SliceThickness),
+                          orientation=tuple(map(float,
+                                                first_slice.ImageOrientationPatient,
+                                                ),
+                                            ),
+                          origin=tuple(map(float,
+                                           first_slice.ImagePositionPatient,
+                                           ),
+                                       ),
+                          rows=int(first_slice.Rows),
+                          columns=int(first_slice.Columns),
+                          sop_instance_uids=tuple(str(dataset.SOPInstanceUID)
+                                                  for dataset in datasets),
+                          consistent_slice_gaps=consistent_slice_gaps,
+                          )
+    
+    return geometry
+
+def get_ct_geometry(ct_folder_path):
+    """
+    Returning the geometry of a CT series.
+
+    Parameters
+    ----------
+    ct_folder_path : str or PatientStudy
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or an already loaded patient study.
+
+    Returns
+    -------
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    """
+    # A loaded study computes its geometry only once.
+    if isinstance(ct_folder_path, PatientStudy):
+        return ct_folder_path.geometry
+    
+    return read_ct_geometry(ct_folder_path)
+
+def read_ct_geometry(ct_folder_path,
+                     profiler=None,
+                     ):
+    """
+    Reading the geometry of a CT series from the headers of its files.
+    
+    Only the tags listed in GEOMETRY_TAGS are parsed and the reading stops
+    before pixel data, so no image is loaded in memory.
+
+    Parameters
+    ----------
+    ct_folder_path : str or list
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or list of the paths of the files of the
+        series.
+    profiler : telemetry.Profiler or None
+        If given, the bytes actually read are added to its "bytes read"
+        counter.
+
+    Returns
+    -------
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    """
+    headers = []
+    for ct_file_path in series_file_paths(ct_folder_path):
+        with open(ct_file_path, "rb") as ct_file:
+            header = pydicom.dcmread(ct_file,
+                                     force=True,
+                                     stop_before_pixels=True,
+                                     specific_tags=GEOMETRY_TAGS,
+                                     )
+            if profiler is not None:
+                profiler.count("bytes read", ct_file.tell())
+        headers.append(header)
+    
+    return ct_geometry_from_datasets(headers)
+
+# Default greatest number of bytes of labelmaps kept in memory for a patient.
+DEFAULT_MASK_CACHE_BYTES = 1024**3
+
+class MaskCache:
+    """
+    Least recently used cache of labelmaps, bounded by their size in bytes.
+    
+    When a new labelmap does not fit in the cache the least recently used
+    ones are discarded. Labelmaps bigger than the whole cache are not stored.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Greatest number of bytes of labelmaps kept in the cache.
+
+    """
+    def __init__(self,
+                 max_bytes=DEFAULT_MASK_CACHE_BYTES,
+                 ):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._labelmaps = OrderedDict()
+        
+    def __contains__(self, segment_name):
+        return segment_name in self._labelmaps
+    
+    def __len__(self):
+        return len(self._labelmaps)
+    
+    def get(self, segment_name):
+        """
+        Returning a cached labelmap and marking it as the most recently used.
+
+        Parameters
+        ----------
+        segment_name : str
+            Name of the segment (Ex. "Prostate").
+
+        Returns
+        -------
+        labelmap : numpy.ndarray or None
+            Cached labelmap, None if the segment is not in the cache.
+
+        """
+        labelmap = self._labelmaps.get(segment_name)
+        if labelmap is not None:
+            self._labelmaps.move_to_end(segment_name)
+        
+        return labelmap
+    
+    def put(self,
+            segment_name,
+            labelmap,
+            ):
+        """
+        Storing a labelmap, discarding the least recently used ones if
+        needed.
+
+        Parameters
+        ----------
+        segment_name : str
+            Name of the segment (Ex. "Prostate").
+        labelmap : numpy.ndarray
+            Labelmap of the segment.
+
+        Returns
+        -------
+        None.
+
+        """
+        if segment_name in self._labelmaps:
+            self.current_bytes -= self._labelmaps.pop(segment_name).nbytes
+        if labelmap.nbytes > self.max_bytes:
+            return
+        
+        while self.current_bytes + labelmap.nbytes > self.max_bytes:
+            _, oldest = self._labelmaps.popitem(last=False)
+            self.current_bytes -= oldest.nbytes
+        
+        self._labelmaps[segment_name] = labelmap
+        self.current_bytes += labelmap.nbytes
+
+# Default greatest number of bytes of labelmaps stored on disk.
+DEFAULT_DISK_CACHE_BYTES = 10 * 1024**3
+
+# Version of the format of the files of DiskMaskCache. It is part of the file
+# names, so files written in another format are never read, they are only
+# evicted.
+DISK_CACHE_VERSION = 1
+
+def geometry_hash(geometry):
+    """
+    Computing a short hash that identifies the geometry of a CT series.
+
+    Parameters
+    ----------
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal hash of the geometry.
+
+    """
+    return hashlib.sha1(repr(tuple(geometry)).encode()).hexdigest()[:16]
+
+class DiskMaskCache:
+    """
+    Persistent cache of labelmaps stored as CompactMask .npz files.
+    
+    Every labelmap is identified by the SOPInstanceUID of its RTSTRUCT, by
+    its ROI number and by the hash of the CT geometry, so a labelmap is
+    reused only if both the contours and the CT series are unchanged (and if
+    it was written in the current format, see DISK_CACHE_VERSION).
+    When the cache grows beyond its size the least recently used files are
+    deleted. The size is kept as a running total (the folder is scanned once
+    when the cache is opened and again only to evict files), so saving a
+    labelmap does not list the folder. Files are written atomically, so the
+    same cache can be shared by several worker processes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the folder where labelmaps are stored (it is created if it
+        does not exist).
+    max_bytes : int
+        Greatest number of bytes of files kept in the cache folder.
+
+    """
+    def __init__(self,
+                 cache_dir,
+                 max_bytes=DEFAULT_DISK_CACHE_BYTES,
+                 ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir,
+                    exist_ok=True,
+                    )
+        self.total_bytes = sum(size for _, size, _ in self.entries())
+        
+    def file_path(self,
+                  rtstruct_uid,
+                  roi_number,
+                  geometry,
+                  ):
+        """
+        Path to the file of a labelmap.
+
+        Parameters
+        ----------
+        rtstruct_uid : str
+            SOPInstanceUID of the RTSTRUCT file.
+        roi_number : int
+            ROINumber of the segment.
+        geometry : CTGeometry
+            Geometry of the CT series.
+
+        Returns
+        -------
+        file_path : str
+            Path to the .npz file of the labelmap.
+
+        """
+        file_name = (f"v{DISK_CACHE_VERSION}_{rtstruct_uid}_{roi_number}_"
+                     f"{geometry_hash(geometry)}.npz")
+        
+        return os.path.join(self.cache_dir,
+                            file_name,
+                            )
+    
+    def load(self,
+             rtstruct_uid,
+             roi_number,
+             geometry,
+             ):
+        """
+        Loading a labelmap from the cache.
+
+        Parameters
+        ----------
+        rtstruct_uid : str
+            SOPInstanceUID of the RTSTRUCT file.
+        roi_number : int
+            ROINumber of the segment.
+        geometry : CTGeometry
+            Geometry of the CT series.
+
+        Returns
+        -------
+        labelmap : CompactMask or None
+            Compact mask of the segment, None if it is not in the cache.
+
+        """
+        file_path = self.file_path(rtstruct_uid,
+                                   roi_number,
+                                   geometry,
+                                   )
+        try:
+            with np.load(file_path) as data:
+                if len(data["bbox_min"]) == 0:
+                    bbox_min = None
+                else:
+                    bbox_min = data["bbox_min"]
+                labelmap = CompactMask(data["shape"],
+                                       bbox_min,
+                                       data["bits"],
+                                       data["box_shape"],
+                                       )
+            # Marking the file as recently used.
+            os.utime(file_path)
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+        
+        return labelmap
+    
+    def save(self,
+             rtstruct_uid,
+             roi_number,
+             geometry,
+             labelmap,
+             ):
+        """
+        Saving a labelmap in the cache and deleting the least recently used
+        files if the cache is too big.
+
+        Parameters
+        ----------
+        rtstruct_uid : str
+            SOPInstanceUID of the RTSTRUCT file.
+        roi_number : int
+            ROINumber of the segment.
+        geometry : CTGeometry
+            Geometry of the CT series.
+        labelmap : CompactMask
+            Compact mask of the segment.
+
+        Returns
+        -------
+        None.
+
+        """
+        file_path = self.file_path(rtstruct_uid,
+                                   roi_number,
+                                   geometry,
+                                   )
+        
+        # Writing to a temporary file first, so that other processes never
+        # read a partially written labelmap.
+        try:
+            old_bytes = os.path.getsize(file_path)
+        except OSError:
+            old_bytes = 0
+        fd, temp_path = tempfile.mkstemp(suffix=".npz",
+                                         dir=self.cache_dir,
+                                         )
+        with os.fdopen(fd, "wb") as temp_file:
+            np.savez_compressed(temp_file,
+                                bits=labelmap.bits,
+                                shape=np.array(labelmap.shape),
+                                bbox_min=np.array(labelmap.bbox_min or []),
+                                box_shape=np.array(labelmap.box_shape),
+                                )
+        new_bytes = os.path.getsize(temp_path)
+        os.replace(temp_path,
+                   file_path,
+                   )
+        self.total_bytes += new_bytes - old_bytes
+        
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+    
+    def entries(self):
+        """
+        Listing the files of the cache folder.
+
+        Returns
+        -------
+        entries : list
+            (modification time, size, path) of every .npz file.
+
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.is_file() and entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        
+        return entries
+    
+    def evict(self):
+        """
+        Deleting the least recently used files until the cache is not bigger
+        than max_bytes.
+        
+        The folder is scanned again, so the running total also includes the
+        files saved by other processes sharing the cache.
+
+        Returns
+        -------
+        None.
+
+        """
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        self.total_bytes = total_bytes
+
+def patient_to_pixel_matrix(geometry):
+    """
+    Computing the matrix that maps patient coordinates (mm) to voxel indices
+    of a CT series.
+    
+    The matrix is built exactly as rt_utils does, in single precision, so
+    that contour points fall on the same voxels.
+
+    Parameters
+    ----------
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    Returns
+    -------
+    matrix : numpy.ndarray
+        4x4 affine transformation matrix (float32).
+
+    """
+    row_direction = np.array(geometry.orientation[:3])
+    column_direction = np.array(geometry.orientation[3:])
+    slice_direction = np.cross(row_direction,
+                               column_direction,
+                               )
+    row_spacing, column_spacing = geometry.pixel_spacing_mm
+    
+    # Distance between slices along the slice direction, slices are sorted
+    # along z.
+    z_positions = geometry.z_positions
+    if len(z_positions) > 1:
+        slice_spacing = ((z_positions[-1] - z_positions[0])
+                         / slice_direction[2]
+                         / (len(z_positions) - 1))
+    else:
+        slice_spacing = 1.0
+    
+    linear = np.identity(3, dtype=np.float32)
+    linear[0, :3] = row_direction / row_spacing
+    linear[1, :3] = column_direction / column_spacing
+    linear[2, :3] = slice_direction / slice_spacing
+    
+    matrix = np.identity(4, dtype=np.float32)
+    matrix[:3, :3] = linear
+    matrix[:3, 3] = np.array(geometry.origin).dot(-linear.T)
+    
+    return matrix
+
+def rasterize_roi(rtstruct_dataset,
+                  roi_number,
+                  geometry,
+                  ):
+    """
+    Creating the labelmap of a segment directly from its contours.
+    
+    Only the CT geometry is needed, CT images are never read. Contour points
+    of all slices are mapped to voxel indices with a single matrix product
+    and polygons are filled only on the slices that have contours, inside a
+    buffer that spans only those slices. The labelmap is identical to the one
+    of rt_utils get_roi_mask_by_name.
+
+    Parameters
+    ----------
+    rtstruct_dataset : pydicom.dataset.FileDataset
+        RTSTRUCT dataset.
+    roi_number : int
+        ROINumber of the segment.
+    geometry : CTGeometry
+        Geometry of the CT series.
+
+    Returns
+    -------
+    labelmap : CompactMask
+        Compact mask of the segment, with shape (columns, rows, slices).
+
+    """
+    shape = (geometry.columns, geometry.rows, len(geometry.z_positions))
+    
+    contour_sequence = None
+    for roi_contour in rtstruct_dataset.ROIContourSequence:
+        if str(roi_contour.ReferencedROINumber) == str(roi_number):
+            contour_sequence = roi_contour.get("ContourSequence", [])
+    if contour_sequence is None:
+        raise Exception(f"Referenced ROI number '{roi_number}' not found")
+    
+    # Contours of each slice, matched by the SOPInstanceUID they reference.
+    slice_indices = {uid: index for index, uid
+                     in enumerate(geometry.sop_instance_uids)}
+    slice_contours = {}
+    for contour in contour_sequence:
+        for contour_image in contour.get("ContourImageSequence", []):
+            uid = str(contour_image.ReferencedSOPInstanceUID)
+            if uid not in slice_indices:
+                raise Exception(
+                    f"ROI number '{roi_number}' references slice {uid}, "
+                    "which is not in the CT series",
+                    )
+            slice_contours.setdefault(slice_indices[uid], []).append(
+                np.reshape(contour.ContourData, [-1, 3]),
+                )
+    
+    if len(slice_contours) == 0:
+        return CompactMask(shape,
+                           None,
+                           np.zeros(0, dtype=np.uint8),
+                           (0,) * len(shape),
+                           )
+    
+    # Mapping all contour points to voxel indices at once.
+    contours = [points for index in sorted(slice_contours)
+                for points in slice_contours[index]]
+    points = np.concatenate(contours)
+    points = np.concatenate((points, np.ones((points.shape[0], 1))),
+                            axis=1,
+                            )
+    pixels = np.around(points.dot(patient_to_pixel_matrix(geometry).T)[:, :2])
+    pixels = pixels.astype(np.int32)
+    
+    # Filling the polygons only on the slices with contours.
+    first_slice = min(slice_contours)
+    buffer = np.zeros(shape[:2] + (max(slice_contours) - first_slice + 1,),
+                      dtype=bool,
+                      )
+    slice_mask = np.zeros(shape[:2], dtype=np.uint8)
+    start = 0
+    for index in sorted(slice_contours):
+        polygons = []
+        for contour in slice_contours[index]:
+            polygons.append(np.squeeze(pixels[start:start + len(contour)]))
+            start += len(contour)
+        slice_mask[:] = 0
+        cv.fillPoly(img=slice_mask,
+                    pts=polygons,
+                    color=1,
+                    )
+        buffer[:, :, index - first_slice] = slice_mask
+    
+    # Keeping only the bounding box of the segment.
+    bbox_min, bbox_max = bounding_box(buffer)
+    if bbox_min is None:
+        return CompactMask(shape,
+                           None,
+                           np.zeros(0, dtype=np.uint8),
+                           (0,) * len(shape),
+                           )
+    box = buffer[tuple(slice(lower, upper + 1)
+                       for lower, upper in zip(bbox_min, bbox_max))]
+    bbox_min[2] += first_slice
+    
+    return CompactMask(shape,
+                       bbox_min,
+                       np.packbits(box),
+                       box.shape,
+                       )
+
+class PatientStudy:
+    """
+    CT series and RTSTRUCT of a single patient, loaded only once.
+    
+    The RTSTRUCT dataset is read when the study is created, so patient
+    informations and ROI names are available without touching the CT series.
+    Labelmaps are created from the contours and the geometry read from the
+    CT headers (see rasterize_roi), so CT images are read only if the
+    rt_utils RTStruct or the series data are requested.
+    Labelmaps are kept as CompactMask in a MaskCache, so every segment is
+    rasterized only once as long as it fits in the cache. If a DiskMaskCache
+    is given, labelmaps are also looked up on disk before rasterizing them
+    and saved there afterwards.
+    Every function of this module that accepts a CT folder path also accepts
+    a PatientStudy in its place.
+
+    Parameters
+    ----------
+    ct_folder_path : str or list
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or list of the paths of the files of the
+        series (see classification.classify_patient_files), so that files
+        can be read where they are.
+    rtstruct_file_path : str
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
+    mask_cache_bytes : int
+        Greatest number of bytes of labelmaps kept in memory.
+    disk_cache : DiskMaskCache or None
+        Persistent cache of labelmaps. If None labelmaps are not stored on
+        disk.
+    profiler : telemetry.Profiler or None
+        If given, header reading, rasterization and metrics of the study are
+        timed with it, bytes read and masks built are counted.
+
+    """
+    def __init__(self,
+                 ct_folder_path,
+                 rtstruct_file_path,
+                 mask_cache_bytes=DEFAULT_MASK_CACHE_BYTES,
+                 disk_cache=None,
+                 profiler=None,
+                 ):
+        self.ct_folder_path = ct_folder_path
+        self.rtstruct_file_path = rtstruct_file_path
+        self.profiler = profiler
+        with telemetry.profile_stage(profiler, "header read"):
+            self.rtstruct_dataset = pydicom.dcmread(rtstruct_file_path)
+        if profiler is not None:
+            profiler.count("bytes read", os.path.getsize(rtstruct_file_path))
+        self.mask_cache = MaskCache(mask_cache_bytes)
+        self.disk_cache = disk_cache
+        self.masks_built = 0
+        self._rtstruct = None
+        self._geometry = None
+        
+    @property
+    def rtstruct(self):
+        """
+        rt_utils RTStruct built from the CT series and the RTSTRUCT dataset.
+        The CT series is read the first time this property is accessed.
+
+        """
+        if self._rtstruct is None:
+            if isinstance(self.ct_folder_path, (list, tuple)):
+                series_data = [pydicom.dcmread(ct_file_path)
+                               for ct_file_path in self.ct_folder_path]
+                series_data.sort(key=image_helper.get_slice_position)
+            else:
+                series_data = image_helper.load_sorted_image_series(
+                    self.ct_folder_path,
+                    )
+            RTStructBuilder.validate_rtstruct(self.rtstruct_dataset)
+            RTStructBuilder.validate_rtstruct_series_references(
+                self.rtstruct_dataset,
+                series_data,
+                )
+            self._rtstruct = RTStruct(series_data,
+                                      self.rtstruct_dataset,
+                                      )
+        
+        return self._rtstruct
+    
+    @property
+    def series_data(self):
+        """
+        Ordered list of the slices that compose the CT volume.
+
+        """
+        return self.rtstruct.series_data
+    
+    @property
+    def patient_id(self):
+        """
+        PatientID stored in the RTSTRUCT file.
+
+        """
+        return patient_info(self, "PatientID")
+    
+    @property
+    def frame_of_reference_uid(self):
+        """
+        FrameOfReferenceUID stored in the RTSTRUCT file.
+
+        """
+        return patient_info(self, "FrameOfReferenceUID")
+    
+    @property
+    def roi_names(self):
+        """
+        List of the names of all segments in the RTSTRUCT file.
+
+        """
+        if "StructureSetROISequence" not in self.rtstruct_dataset:
+            return []
+        
+        return [structure_roi.ROIName for structure_roi
+                in self.rtstruct_dataset.StructureSetROISequence]
+    
+    def get_mask(self, segment_name):
+        """
+        Creating the binary labelmap of a segment, or returning it from the
+        mask cache if it was already created.
+
+        Parameters
+        ----------
+        segment_name : str
+            Name of the segment (Ex. "Prostate").
+
+        Returns
+        -------
+        labelmap : CompactMask
+            Compact mask of the selected segment, see CompactMask.to_dense
+            for the 3D binary array.
+
+        """
+        labelmap = self.mask_cache.get(segment_name)
+        if labelmap is not None:
+            return labelmap
+        
+        # Looking for the labelmap in the persistent cache.
+        if self.disk_cache is not None:
+            cache_key = (str(self.rtstruct_dataset.SOPInstanceUID),
+                         self.roi_number(segment_name),
+                         self.geometry,
+                         )
+            labelmap = self.disk_cache.load(*cache_key)
+        
+        if labelmap is None:
+            geometry = self.geometry
+            with telemetry.profile_stage(self.profiler, "rasterize"):
+                labelmap = rasterize_roi(self.rtstruct_dataset,
+                                         self.roi_number(segment_name),
+                                         geometry,
+                                         )
+            self.masks_built += 1
+            if self.profiler is not None:
+                self.profiler.count("masks built")
+            if self.disk_cache is not None:
+                self.disk_cache.save(*cache_key,
+                                     labelmap,
+                                     )
+        
+        self.mask_cache.put(segment_name,
+                            labelmap,
+                            )
+        
+        return labelmap
+    
+    def roi_number(self, segment_name):
+        """
+        Returning the ROINumber of a segment.
+
+        Parameters
+        ----------
+        segment_name : str
+            Name of the segment (Ex. "Prostate").
+
+        Returns
+        -------
+        roi_number : int
+            ROINumber of the segment in the RTSTRUCT file.
+
+        """
+        for structure_roi in self.rtstruct_dataset.StructureSetROISequence:
+            if structure_roi.ROIName == segment_name:
+                return int(structure_roi.ROINumber)
+        
+        raise RTStruct.ROIException(
+            f"ROI of name `{segment_name}` does not exist in RTStruct",
+            )
+    
+    @property
+    def geometry(self):
+        """
+        Geometry of the CT series, computed only once. If the CT series has
+        not been loaded yet only the file headers are read.
+
+        """
+        if self._geometry is None:
+            if self._rtstruct is None:
+                with telemetry.profile_stage(self.profiler, "header read"):
+                    self._geometry = read_ct_geometry(self.ct_folder_path,
+                                                      self.profiler,
+                                                      )
+            else:
+                self._geometry = ct_geometry_from_datasets(self.series_data)
+        
+        return self._geometry
+
+def open_study(ct_folder_path,
+               rtstruct_file_path,
+               disk_cache=None,
+               ):
+    """
+    Returning the PatientStudy of the given CT folder and RTSTRUCT file.
+    If a PatientStudy is already given it is returned unchanged.
+
+    Parameters
+    ----------
+    ct_folder_path : str or PatientStudy
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or an already loaded patient study.
+    rtstruct_file_path : str or None
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm"). Ignored
+        if ct_folder_path is a PatientStudy.
+    disk_cache : DiskMaskCache or None
+        Persistent cache of labelmaps of the new study. Ignored if
+        ct_folder_path is a PatientStudy.
+
+    Returns
+    -------
+    study : PatientStudy
+        Patient study of the given files.
+
+    """
+    if isinstance(ct_folder_path, PatientStudy):
+        return ct_folder_path
+    
+    return PatientStudy(ct_folder_path,
+                        rtstruct_file_path,
+                        disk_cache=disk_cache,
+                        )
+
 def extract_all_segments(ct_folder_path,
-                         rtstruct_file_path,
+                         rtstruct_file_path=None,
                          ):
     """
     Creates a list with the names of all segments in the current patient file.
 
     Parameters
     ----------
-    ct_folder_path : str
+    ct_folder_path : str or PatientStudy
         Path to the folder containing DICOM series files
-        (Ex: path/to/CTfolder).
-    rtstruct_file_path : str
-        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
+        (Ex: path/to/CTfolder) or an already loaded patient study.
+    rtstruct_file_path : str or None
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm"). Ignored
+        if ct_folder_path is a PatientStudy.
 
     Returns
     -------
@@ -160,18 +1087,94 @@ def extract_all_segments(ct_folder_path,
 
     """
     # Reading current patient files.
-    patient_data = RTStructBuilder.create_from(ct_folder_path, 
-                                               rtstruct_file_path,
-                                               )
+    patient_data = open_study(ct_folder_path,
+                              rtstruct_file_path,
+                              )
     
     # Creating the list of all segments
-    all_segments = patient_data.get_roi_names()
+    all_segments = patient_data.roi_names
     
     return all_segments
     
 
+# Lists of the configuration file with the names of the manual segments,
+# in the order of the alias names.
+MANUAL_NAME_LISTS = ["Prostate names",
+                     "Rectum names",
+                     "Bladder names",
+                     "Left femur names",
+                     "Right femur names",
+                     ]
+
+# Lists of the configuration file with the names of segments that are not
+# manual segments.
+OTHER_NAME_LISTS = ["MBS segments",
+                    "DL segments",
+                    "External names",
+                    ]
+
+def normalize_name(name):
+    """
+    Normalizing a segment name so that names differing only by case or
+    whitespace are considered equal.
+
+    Parameters
+    ----------
+    name : str
+        Segment name (Ex. " Femore  Sinistro").
+
+    Returns
+    -------
+    normalized_name : str
+        Case folded name with single spaces (Ex. "femore sinistro").
+
+    """
+    return " ".join(name.split()).casefold()
+
+def build_alias_index(config):
+    """
+    Compiling all the segment names of the configuration file into a single
+    lookup table, so that every segment is classified with one lookup.
+    
+    Lists are read in the order MBS segments, DL segments, External names and
+    then the manual segment lists, if the same name is in more than one list
+    the first one is kept and the name is reported as a conflict. The index
+    must be built again when names are added to the configuration.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    alias_index : dict
+        Normalized segment name (see normalize_name) mapped to a
+        (list name, slot) tuple, slot is the position of the segment in the
+        manual segments list or None if it is not a manual segment
+        (Ex. {"prostata": ("Prostate names", 0), ...}).
+    conflicts : list
+        (normalized name, kept list name, ignored list name) tuples.
+
+    """
+    alias_index = {}
+    conflicts = []
+    categories = ([(list_name, None) for list_name in OTHER_NAME_LISTS]
+                  + [(list_name, slot) for slot, list_name
+                     in enumerate(MANUAL_NAME_LISTS)])
+    for list_name, slot in categories:
+        for name in config[list_name]:
+            key = normalize_name(name)
+            if key not in alias_index:
+                alias_index[key] = (list_name, slot)
+            elif alias_index[key][0] != list_name:
+                conflicts.append((key, alias_index[key][0], list_name))
+    
+    return alias_index, conflicts
+
 def find_unknown_segments(all_segments,
                           config,
+                          alias_index=None,
                           ):
     """
     Creates a list of current patient's segments that are not in the
@@ -184,6 +1187,8 @@ def find_unknown_segments(all_segments,
         (Ex. [Prostate, Bladder, Rectum]).
     config : dict
         Dictionary containing lists of possible manual segments names.
+    alias_index : dict or None
+        Index returned by build_alias_index(config). If None it is built.
 
     Returns
     -------
@@ -192,29 +1197,12 @@ def find_unknown_segments(all_segments,
         (Ex. Spinal cord, Brainstem)
 
     """
-    # Creating the list that will contain the unkown segments
-    unknown_segments = []
+    if alias_index is None:
+        alias_index, _ = build_alias_index(config)
     
     # Finding the unkown segments and storing them in a list 
-    for name in all_segments:
-        if name in config["MBS segments"]:
-            continue
-        elif name in config["DL segments"]:
-            continue
-        elif name in config["External names"]:
-            continue
-        elif name in config["Prostate names"]:
-            continue
-        elif name in config["Rectum names"]:
-            continue
-        elif name in config["Bladder names"]:
-            continue
-        elif name in config["Left femur names"]:
-            continue
-        elif name in config["Right femur names"]:
-            continue
-        else:
-            unknown_segments.append(name)
+    unknown_segments = [name for name in all_segments
+                        if normalize_name(name) not in alias_index]
             
     return unknown_segments
 
@@ -270,151 +1258,1211 @@ def user_selection(unknown_segments,
         elif to_keep == "N":
             continue
         
+# Smallest similarity for an unknown name to be added to the list of its
+# closest known name.
+DEFAULT_FUZZY_THRESHOLD = 0.85
+
+def compile_alias_rules(config):
+    """
+    Compiling the regular expressions in the optional "Alias rules" of the
+    configuration file, so that an invalid rule stops the execution before
+    any patient is analysed.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+
+    Returns
+    -------
+    alias_rules : list
+        (list name, pattern, compiled pattern) tuples, in the order of the
+        configuration file. Patterns are case insensitive.
+
+    """
+    alias_rules = []
+    for list_name, patterns in config.get("Alias rules", {}).items():
+        if list_name not in MANUAL_NAME_LISTS:
+            sys.exit(f"Alias rules for unknown list {list_name} in the "
+                     "configuration file, execution halted")
+        for pattern in patterns:
+            try:
+                compiled = re.compile(pattern,
+                                      re.IGNORECASE,
+                                      )
+            except re.error as error:
+                sys.exit(f"Invalid alias rule {pattern!r} for {list_name} in "
+                         f"the configuration file ({error}), execution halted")
+            alias_rules.append((list_name, pattern, compiled))
+    
+    return alias_rules
+
+def resolve_segment(name,
+                    config,
+                    fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD,
+                    alias_rules=None,
+                    ):
+    """
+    Finding, without asking the user, the list of manual segment names an
+    unknown segment belongs to.
+    
+    The regular expressions in the optional "Alias rules" of the
+    configuration file (Ex. {"Prostate names": ["^prost", "^ctv"]}) are
+    searched first, case insensitive. Otherwise the name is compared with all
+    the known manual segment names and, if the closest one is similar enough,
+    the list of the closest name is chosen.
+
+    Parameters
+    ----------
+    name : str
+        Name of the unknown segment.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    fuzzy_threshold : float
+        Smallest similarity (between 0 and 1, see difflib.SequenceMatcher)
+        accepted for the closest name.
+    alias_rules : list or None
+        Rules returned by compile_alias_rules(config). If None they are
+        compiled.
+
+    Returns
+    -------
+    list_name : str or None
+        Name of the list of the configuration file, None if the segment could
+        not be resolved.
+    closest_name : str or None
+        Rule or known name that matched (or the closest one if not resolved).
+    score : float
+        Similarity with the closest name, 1 for a rule.
+
+    """
+    # Rule based matching.
+    if alias_rules is None:
+        alias_rules = compile_alias_rules(config)
+    for list_name, pattern, compiled in alias_rules:
+        if compiled.search(name):
+            return list_name, pattern, 1.0
+    
+    # Fuzzy matching with the known names.
+    best = (None, None, 0.0)
+    for list_name in MANUAL_NAME_LISTS:
+        for known_name in config[list_name]:
+            score = difflib.SequenceMatcher(None,
+                                            name.casefold(),
+                                            known_name.casefold(),
+                                            ).ratio()
+            if score > best[2]:
+                best = (list_name, known_name, score)
+    
+    if best[2] >= fuzzy_threshold:
+        return best
+    
+    return None, best[1], best[2]
+
+def automatic_selection(unknown_segments,
+                        config,
+                        fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD,
+                        alias_rules=None,
+                        ):
+    """
+    Non interactive version of user_selection, used for unattended runs.
+    
+    Unknown segments resolved by resolve_segment are saved in the list of the
+    configuration file they belong to, the others are discarded for this run
+    and returned so that they can be reviewed later.
+
+    Parameters
+    ----------
+    unknown_segments : list
+        List of segments names that are not in the configuration file.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    fuzzy_threshold : float
+        Smallest similarity accepted for fuzzy matching.
+    alias_rules : list or None
+        Rules returned by compile_alias_rules(config). If None they are
+        compiled once for all the segments.
+
+    Returns
+    -------
+    deferred : list
+        One dictionary for every segment not resolved, with keys
+        "Segment name", "Closest name" and "Score".
+
+    """
+    if alias_rules is None:
+        alias_rules = compile_alias_rules(config)
+    
+    deferred = []
+    for name in unknown_segments:
+        list_name, closest_name, score = resolve_segment(name,
+                                                         config,
+                                                         fuzzy_threshold,
+                                                         alias_rules,
+                                                         )
+        if list_name is None:
+            deferred.append({"Segment name": name,
+                             "Closest name": closest_name,
+                             "Score": round(score, 3),
+                             })
+        else:
+            config[list_name].append(name)
+            print(name,
+                  f"added to {list_name} in config.json (matched",
+                  f"{closest_name}, score {score:.2f})",
+                  )
+    
+    return deferred
+
+def save_deferred_report(deferred,
+                         report_path,
+                         ):
+    """
+    Saving the segments that could not be resolved into a json file for
+    later review.
+
+    Parameters
+    ----------
+    deferred : list
+        Deferred segments, as returned by automatic_selection with the
+        "Patient folder" key added.
+    report_path : str
+        Path to the json file.
+
+    Returns
+    -------
+    None.
+
+    """
+    json_object = json.dumps(deferred,
+                             indent=4,
+                             )
+    with open(report_path, "w") as outfile:
+        outfile.write(json_object)
+
 def extract_manual_segments(all_segments,
                             config,
+                            alias_index=None,
                             ):
     """
-    Creating the list of manual segments.
+    Creating the list of manual segments.
+    
+    The list of all segments in the image is extracted from patient data.
+    Then, the manual_segments list is created starting from the list of alias
+    names and is initially filled with zeros.
+    Every element of all_segments is looked up in the alias index of the
+    config.json file and inserted in the correct place of the manual_segments
+    list.
+
+    Parameters
+    ----------
+    all_segments: list
+        List of all the segments in the current CT series
+        (Ex. [Prostate, Bladder, Rectum]).
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    alias_index : dict or None
+        Index returned by build_alias_index(config). If None it is built.
+
+    Returns
+    -------
+    manual_segments: list
+        List containing current patient manual segments names.
+
+    """
+    if alias_index is None:
+        alias_index, _ = build_alias_index(config)
+    
+    # Creates the list of manual segments
+    manual_segments = [0 for i in range(len(config["Alias names"]))]
+    # Puts every manual segment in the correct place of the list
+    for name in all_segments:
+        _, slot = alias_index.get(normalize_name(name), (None, None))
+        if slot is not None:
+            manual_segments[slot] = name
+        
+    return manual_segments
+
+def create_labelmap(ct_folder_path,
+                    rtstruct_file_path,
+                    segment_name,
+                    disk_cache=None,
+                    ):
+    """
+    Creating the binary labelmap for the current segment.
+
+    Parameters
+    ----------
+    ct_folder_path : str or PatientStudy
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or an already loaded patient study.
+    rtstruct_file_path : str or None
+        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm"). Ignored
+        if ct_folder_path is a PatientStudy.
+    segment_name : str
+        Name of the segment
+        (Ex. "Prostate")
+    disk_cache : DiskMaskCache or None
+        Persistent cache consulted before rasterizing the segment. Ignored if
+        ct_folder_path is a PatientStudy (the cache of the study is used).
+     
+    Returns
+    -------
+    labelmap : numpy.ndarray
+        3D binary array of the selected segment (0 out of the segment,
+        1 inside).
+
+    """
+    # Reading current patient files.
+    patient_data = open_study(ct_folder_path,
+                              rtstruct_file_path,
+                              disk_cache,
+                              )
+    
+    # Binary labelmap creation
+    labelmap = patient_data.get_mask(segment_name).to_dense()
+    
+    return labelmap
+
+def bounding_box(labelmap):
+    """
+    Computing the bounding box of the non zero voxels of a labelmap.
+
+    Parameters
+    ----------
+    labelmap : numpy.ndarray or CompactMask
+        3D binary array of a segment.
+
+    Returns
+    -------
+    bbox_min : list or None
+        Lowest index of the segment along each axis. None if the labelmap is
+        empty.
+    bbox_max : list or None
+        Highest index of the segment along each axis. None if the labelmap
+        is empty.
+
+    """
+    # Compact masks already know their bounding box.
+    if isinstance(labelmap, CompactMask):
+        return labelmap.bounding_box()
+    
+    bbox_min = []
+    bbox_max = []
+    
+    # The search along each axis is restricted to the range already found
+    # along the previous ones, so the whole array is scanned only once.
+    view = labelmap
+    for axis in reversed(range(labelmap.ndim)):
+        other_axes = tuple(i for i in range(view.ndim) if i != axis)
+        nonzero = np.flatnonzero(np.any(view,
+                                        axis=other_axes,
+                                        ),
+                                 )
+        if len(nonzero) == 0:
+            return None, None
+        bbox_min.insert(0, int(nonzero[0]))
+        bbox_max.insert(0, int(nonzero[-1]))
+        
+        index = [slice(None)] * view.ndim
+        index[axis] = slice(nonzero[0], nonzero[-1] + 1)
+        view = view[tuple(index)]
+    
+    return bbox_min, bbox_max
+
+class CompactMask:
+    """
+    Binary labelmap stored as the bit-packed content of its bounding box.
+    
+    Segments occupy a small part of the CT volume, so only the voxels inside
+    their bounding box are kept, 8 per byte. The labelmap is expanded only
+    where it is needed (see crop) or, if really needed, in full
+    (see to_dense).
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the whole labelmap.
+    bbox_min : tuple or None
+        Lowest index of the segment along each axis. None if the labelmap is
+        empty.
+    bits : numpy.ndarray
+        Bit-packed voxels of the bounding box (see numpy.packbits).
+    box_shape : tuple
+        Shape of the bounding box.
+
+    """
+    def __init__(self,
+                 shape,
+                 bbox_min,
+                 bits,
+                 box_shape,
+                 ):
+        self.shape = tuple(int(size) for size in shape)
+        self.ndim = len(self.shape)
+        if bbox_min is None:
+            self.bbox_min = None
+        else:
+            self.bbox_min = tuple(int(index) for index in bbox_min)
+        self.bits = bits
+        self.bits.flags.writeable = False
+        self.box_shape = tuple(int(size) for size in box_shape)
+    
+    @classmethod
+    def from_dense(cls, labelmap):
+        """
+        Creating a compact mask from a 3D binary array.
+
+        Parameters
+        ----------
+        labelmap : numpy.ndarray
+            3D binary array of a segment.
+
+        Returns
+        -------
+        mask : CompactMask
+            Compact mask of the segment.
+
+        """
+        bbox_min, bbox_max = bounding_box(labelmap)
+        if bbox_min is None:
+            return cls(labelmap.shape,
+                       None,
+                       np.zeros(0, dtype=np.uint8),
+                       (0,) * labelmap.ndim,
+                       )
+        
+        index = tuple(slice(lower, upper + 1)
+                      for lower, upper in zip(bbox_min, bbox_max))
+        box = labelmap[index]
+        
+        return cls(labelmap.shape,
+                   bbox_min,
+                   np.packbits(box.astype(bool)),
+                   box.shape,
+                   )
+    
+    @property
+    def nbytes(self):
+        """
+        Number of bytes used by the voxels of the mask.
+
+        """
+        return self.bits.nbytes
+    
+    def bounding_box(self):
+        """
+        Bounding box of the segment, as returned by bounding_box.
+
+        """
+        if self.bbox_min is None:
+            return None, None
+        
+        bbox_max = [lower + size - 1 for lower, size
+                    in zip(self.bbox_min, self.box_shape)]
+        
+        return list(self.bbox_min), bbox_max
+    
+    def box(self):
+        """
+        Unpacking the voxels of the bounding box.
+
+        Returns
+        -------
+        box : numpy.ndarray
+            3D binary array of the bounding box.
+
+        """
+        return np.unpackbits(self.bits,
+                             count=int(np.prod(self.box_shape)),
+                             ).astype(bool).reshape(self.box_shape)
+    
+    def crop(self, index):
+        """
+        Expanding the mask only inside a region.
+
+        Parameters
+        ----------
+        index : tuple
+            One slice for each axis, with explicit start and stop inside the
+            labelmap shape.
+
+        Returns
+        -------
+        region : numpy.ndarray
+            3D binary array of the region, equal to
+            self.to_dense()[index].
+
+        """
+        region = np.zeros([region_slice.stop - region_slice.start
+                           for region_slice in index],
+                          dtype=bool,
+                          )
+        if self.bbox_min is None:
+            return region
+        
+        # Part of the bounding box that falls inside the region.
+        box_index = []
+        region_index = []
+        for region_slice, lower, size in zip(index,
+                                             self.bbox_min,
+                                             self.box_shape,
+                                             ):
+            start = max(region_slice.start, lower)
+            stop = min(region_slice.stop, lower + size)
+            if start >= stop:
+                return region
+            box_index.append(slice(start - lower, stop - lower))
+            region_index.append(slice(start - region_slice.start,
+                                      stop - region_slice.start,
+                                      ),
+                                )
+        region[tuple(region_index)] = self.box()[tuple(box_index)]
+        
+        return region
+    
+    def to_dense(self):
+        """
+        Expanding the mask to the whole labelmap.
+
+        Returns
+        -------
+        labelmap : numpy.ndarray
+            3D binary array of the segment.
+
+        """
+        return self.crop(tuple(slice(0, size) for size in self.shape))
+
+def crop_to_bounding_box(reference_labelmap,
+                         compared_labelmap,
+                         margin=1,
+                         ):
+    """
+    Cropping two labelmaps to the union of their bounding boxes.
+    
+    The cropped labelmaps are views of the original ones, no voxel is copied.
+    Compact masks are expanded only inside the cropped region.
+    Surface distances and Dice coefficients computed on the cropped labelmaps
+    are identical to the ones computed on the original labelmaps.
+
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the segment to compare.
+    margin : int
+        Number of voxels added to each side of the bounding box (the box is
+        never extended beyond the labelmap borders).
+
+    Returns
+    -------
+    reference_labelmap: numpy.ndarray
+        Cropped reference labelmap.
+    compared_labelmap: numpy.ndarray
+        Cropped labelmap to compare.
+
+    """
+    boxes = [bounding_box(reference_labelmap),
+             bounding_box(compared_labelmap),
+             ]
+    boxes = [box for box in boxes if box[0] is not None]
+    
+    # If both labelmaps are empty there is nothing to crop.
+    if len(boxes) == 0:
+        return (dense_labelmap(reference_labelmap),
+                dense_labelmap(compared_labelmap),
+                )
+    
+    index = []
+    for axis in range(reference_labelmap.ndim):
+        lower = min(box[0][axis] for box in boxes) - margin
+        upper = max(box[1][axis] for box in boxes) + margin + 1
+        index.append(slice(max(lower, 0),
+                           min(upper, reference_labelmap.shape[axis]),
+                           ),
+                     )
+    index = tuple(index)
+    
+    cropped = []
+    for labelmap in [reference_labelmap, compared_labelmap]:
+        if isinstance(labelmap, CompactMask):
+            cropped.append(labelmap.crop(index))
+        else:
+            cropped.append(labelmap[index])
+    
+    return cropped[0], cropped[1]
+
+def dense_labelmap(labelmap):
+    """
+    Returning a labelmap as a 3D binary array.
+
+    Parameters
+    ----------
+    labelmap : numpy.ndarray or CompactMask
+        Labelmap of a segment.
+
+    Returns
+    -------
+    labelmap : numpy.ndarray
+        3D binary array of the segment (the same array if it was already
+        dense).
+
+    """
+    if isinstance(labelmap, CompactMask):
+        return labelmap.to_dense()
+    
+    return labelmap
+
+class SurfaceMetrics(namedtuple("SurfaceMetrics",
+                                ["hausdorff_95_mm",
+                                 "hausdorff_max_mm",
+                                 "mean_surface_distance_mm",
+                                 "volume_dice",
+                                 "surface_dice",
+                                 "percentile_hausdorff_mm",
+                                 ],
+                                )):
+    """
+    Metrics of the comparison between two segments.
+
+    Attributes
+    ----------
+    hausdorff_95_mm : float
+        95 percentile Hausdorff distance in millimeters.
+    hausdorff_max_mm : float
+        Maximum Hausdorff distance in millimeters.
+    mean_surface_distance_mm : float
+        Mean distance between the two surfaces in millimeters (both
+        directions, weighted by surface element areas).
+    volume_dice : float
+        Volumetric Dice similarity coefficient.
+    surface_dice : dict
+        Surface Dice similarity coefficient for each tolerance in millimeters
+        (Ex. {1.0: 0.71, 3.0: 0.90}).
+    percentile_hausdorff_mm : dict
+        Hausdorff distance in millimeters for each requested percentile
+        (Ex. {95: 4.2, 100: 7.1}).
+
+    """
+    __slots__ = ()
+
+def compute_all_metrics(reference_labelmap,
+                        compared_labelmap,
+                        geometry,
+                        tolerances_mm=None,
+                        percentiles=None,
+                        crop=True,
+                        report_speedup=False,
+                        ):
+    """
+    Computing all the metrics between two segments with a single surface
+    distance computation.
+    
+    Labelmaps are cropped to the region around the two segments, surface
+    distances are computed once on the cropped region and every metric is
+    derived from them (volumetric Dice is computed on the same cropped
+    region). Adding a metric does not require any further distance
+    transform or file reading.
+
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the segment to compare.
+    geometry : CTGeometry
+        Geometry of the CT series of the two segments.
+    tolerances_mm : list or None
+        Tolerances (mm) of the surface Dice similarity coefficient. If None
+        the greatest voxel dimension is used.
+    percentiles : list or None
+        Percentiles of the Hausdorff distance (Ex. [95, 100]). If None only
+        the 95 percentile is computed.
+    crop : bool
+        If True (default) the labelmaps are cropped to the union of their
+        bounding boxes before computing the metrics. The metrics are the same.
+    report_speedup : bool
+        If True the metrics are computed both with and without cropping and
+        the speedup obtained by cropping is printed.
+
+    Returns
+    -------
+    metrics : SurfaceMetrics
+        Metrics of the comparison.
+
+    """
+    if report_speedup:
+        start = time.perf_counter()
+        uncropped_metrics = compute_all_metrics(reference_labelmap,
+                                                compared_labelmap,
+                                                geometry,
+                                                tolerances_mm,
+                                                percentiles,
+                                                crop=False,
+                                                )
+        uncropped_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        cropped_metrics = compute_all_metrics(reference_labelmap,
+                                              compared_labelmap,
+                                              geometry,
+                                              tolerances_mm,
+                                              percentiles,
+                                              crop=True,
+                                              )
+        cropped_time = time.perf_counter() - start
+        
+        print(f"Cropping speedup: {uncropped_time / cropped_time:.1f}x",
+              f"({uncropped_time:.3f} s without cropping,",
+              f"{cropped_time:.3f} s with cropping),",
+              f"identical metrics: {uncropped_metrics == cropped_metrics}",
+              )
+        return cropped_metrics
+    
+    # Computing voxel spacing and default tolerance.
+    voxel_spacing_mm = list(geometry.voxel_spacing_mm)
+    if tolerances_mm is None:
+        tolerances_mm = [np.array(voxel_spacing_mm).max()]
+    if percentiles is None:
+        percentiles = [95]
+    
+    # Restricting the computation to the region around the two segments.
+    if crop:
+        reference_labelmap, compared_labelmap = crop_to_bounding_box(
+            reference_labelmap,
+            compared_labelmap,
+            )
+    else:
+        reference_labelmap = dense_labelmap(reference_labelmap)
+        compared_labelmap = dense_labelmap(compared_labelmap)
+    
+    # Surface distances computation, surface distances are sorted.
+    surf_dists = sd.compute_surface_distances(reference_labelmap,
+                                              compared_labelmap,
+                                              voxel_spacing_mm,
+                                              )
+    distances = [surf_dists["distances_gt_to_pred"],
+                 surf_dists["distances_pred_to_gt"],
+                 ]
+    areas = [surf_dists["surfel_areas_gt"],
+             surf_dists["surfel_areas_pred"],
+             ]
+    
+    hausdorff_95 = sd.compute_robust_hausdorff(surf_dists,
+                                               percent=95,
+                                               )
+    
+    # The greatest distance is the last one of each sorted array.
+    if all(len(direction) > 0 for direction in distances):
+        hausdorff_max = float(max(direction[-1] for direction in distances))
+    else:
+        hausdorff_max = np.inf
+    
+    total_area = np.sum(areas[0]) + np.sum(areas[1])
+    if total_area > 0:
+        mean_surface_distance = ((np.sum(distances[0] * areas[0])
+                                  + np.sum(distances[1] * areas[1]))
+                                 / total_area)
+    else:
+        mean_surface_distance = np.nan
+    
+    volume_dice = sd.compute_dice_coefficient(reference_labelmap,
+                                              compared_labelmap,
+                                              )
+    
+    # Every tolerance and percentile is evaluated on the same sorted
+    # distances.
+    surface_dice = {}
+    for tolerance in tolerances_mm:
+        surface_dice[tolerance] = sd.compute_surface_dice_at_tolerance(
+            surf_dists,
+            tolerance_mm=tolerance,
+            )
+    
+    percentile_hausdorff = {}
+    for percent in percentiles:
+        percentile_hausdorff[percent] = sd.compute_robust_hausdorff(
+            surf_dists,
+            percent=percent,
+            )
+    
+    return SurfaceMetrics(hausdorff_95_mm=hausdorff_95,
+                          hausdorff_max_mm=hausdorff_max,
+                          mean_surface_distance_mm=mean_surface_distance,
+                          volume_dice=volume_dice,
+                          surface_dice=surface_dice,
+                          percentile_hausdorff_mm=percentile_hausdorff,
+                          )
+
+def compute_metrics(reference_labelmap,
+                    compared_labelmap,
+                    ct_folder_path,
+                    crop=True,
+                    report_speedup=False,
+                    ):
+    """
+    Computing Hausdorff distance (hd), volumetric Dice similarity coefficient
+    (dsc) and surface Dice similarity coefficient (sdsc).
+    
+    Starting from the binary labelmaps of the two segments the three metrics
+    are computed.
+    Surface Dice tolerance is set equal to the greatest voxel dimension.
+    Percent value of Hausdorff distance is set to 95.
+    
+
+    Parameters
+    ----------
+    reference_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the reference segment.
+    compared_labelmap: numpy.ndarray or CompactMask
+        3D binary array of the segment to compare.
+    ct_folder_path : str or PatientStudy
+        Path to the folder containing DICOM series files
+        (Ex: path/to/CTfolder) or an already loaded patient study.
+    crop : bool
+        If True (default) the labelmaps are cropped to the union of their
+        bounding boxes before computing the metrics. The metrics are the same.
+    report_speedup : bool
+        If True the metrics are computed both with and without cropping and
+        the speedup obtained by cropping is printed.
+
+    Returns
+    -------
+    surface_dice : float
+        Value of the surface Dice similarity coefficient between the two
+        compared segments.
+    volume_dice : float
+        Value of the Dice similarity coefficient between the two compared
+        segments.
+    hausdorff_distance : float
+        Value of the Hausdorff distance between the two compared segments.
+
+    """
+    # Computing voxel spacing and tolerance
+    geometry = get_ct_geometry(ct_folder_path)
+    
+    metrics = compute_all_metrics(reference_labelmap,
+                                  compared_labelmap,
+                                  geometry,
+                                  crop=crop,
+                                  report_speedup=report_speedup,
+                                  )
+    surface_dice, = metrics.surface_dice.values()
+    
+    return surface_dice, metrics.volume_dice, metrics.hausdorff_95_mm
+
+# Compact masks read by the processes of compute_pairs_metrics, together
+# with the shared memory block that holds their voxels (see
+# attach_shared_masks).
+SHARED_MASKS = {"Memory": None,
+                "Masks": {},
+                }
+
+def share_masks(masks):
+    """
+    Copying the voxels of compact masks to a single block of shared memory.
+
+    Parameters
+    ----------
+    masks : dict
+        CompactMask of every segment name.
+
+    Returns
+    -------
+    shared_memory : multiprocessing.shared_memory.SharedMemory
+        Block with the voxels of every mask, it must be closed and unlinked
+        when the masks are not needed anymore.
+    layout : dict
+        Shape, bounding box lowest index, offset in the block, number of
+        bytes and bounding box shape of every mask, as needed by
+        attach_shared_masks.
+
+    """
+    shared_memory = SharedMemory(create=True,
+                                 size=max(sum(mask.nbytes for mask
+                                              in masks.values()), 1),
+                                 )
+    layout = {}
+    offset = 0
+    for name, mask in masks.items():
+        shared_memory.buf[offset:offset + mask.nbytes] = mask.bits.tobytes()
+        layout[name] = (mask.shape,
+                        mask.bbox_min,
+                        offset,
+                        mask.nbytes,
+                        mask.box_shape,
+                        )
+        offset += mask.nbytes
+    
+    return shared_memory, layout
+
+def attach_shared_masks(shared_memory_name,
+                        layout,
+                        ):
+    """
+    Creating the compact masks of a block of shared memory (see share_masks)
+    in SHARED_MASKS, without copying their voxels. It is the initializer of
+    the processes of compute_pairs_metrics.
+
+    Parameters
+    ----------
+    shared_memory_name : str
+        Name of the block of shared memory.
+    layout : dict
+        Layout of the masks in the block, as returned by share_masks.
+
+    Returns
+    -------
+    None.
+
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+    SHARED_MASKS["Memory"] = shared_memory
+    SHARED_MASKS["Masks"] = {
+        name: CompactMask(shape,
+                          bbox_min,
+                          np.ndarray(size,
+                                     dtype=np.uint8,
+                                     buffer=shared_memory.buf,
+                                     offset=offset,
+                                     ),
+                          box_shape,
+                          )
+        for name, (shape, bbox_min, offset, size, box_shape) in layout.items()
+        }
+
+def compute_shared_pair_metrics(reference_name,
+                                compared_name,
+                                geometry,
+                                tolerances_mm=None,
+                                percentiles=None,
+                                report_speedup=False,
+                                ):
+    """
+    Computing the metrics of a pair of segments whose masks are in
+    SHARED_MASKS (see attach_shared_masks).
+
+    Parameters
+    ----------
+    reference_name : str
+        Name of the reference segment.
+    compared_name : str
+        Name of the segment to compare.
+    geometry : CTGeometry
+        Geometry of the CT series of the two segments.
+    tolerances_mm : list or None
+        Tolerances (mm) of the surface Dice similarity coefficient.
+    percentiles : list or None
+        Percentiles of the Hausdorff distance.
+    report_speedup : bool
+        If True the speedup obtained by cropping the labelmaps is printed.
+
+    Returns
+    -------
+    metrics : SurfaceMetrics
+        Metrics of the comparison.
+
+    """
+    return compute_all_metrics(SHARED_MASKS["Masks"][reference_name],
+                               SHARED_MASKS["Masks"][compared_name],
+                               geometry,
+                               tolerances_mm,
+                               percentiles,
+                               report_speedup=report_speedup,
+                               )
+
+def compute_pairs_metrics(study,
+                          reference_names,
+                          compared_names,
+                          processes,
+                          tolerances_mm=None,
+                          percentiles=None,
+                          report_speedup=False,
+                          ):
+    """
+    Computing the metrics of several pairs of segments of the same patient in
+    a process pool, yielding them one at a time.
+    
+    The distance transforms of the surface distances hold the GIL for most
+    of their work, so pairs are computed in processes instead of threads.
+    Each labelmap is created only once and its compact mask is copied to
+    shared memory, where every process reads it without pickling it again
+    for each pair. Metrics are yielded in the order of the pairs, each one as
+    soon as it is computed.
+
+    Parameters
+    ----------
+    study : PatientStudy
+        Loaded patient study.
+    reference_names : list
+        Names of the reference segments, one for each pair.
+    compared_names : list
+        Names of the segments to compare, one for each pair.
+    processes : int
+        Number of pairs computed at the same time.
+    tolerances_mm : list or None
+        Tolerances (mm) of the surface Dice similarity coefficient.
+    percentiles : list or None
+        Percentiles of the Hausdorff distance.
+    report_speedup : bool
+        If True the speedup obtained by cropping the labelmaps is printed.
+
+    Yields
+    ------
+    metrics : SurfaceMetrics
+        Metrics of each pair (in the same order of the input names).
+
+    """
+    # Creating every labelmap only once.
+    masks = {}
+    for name in list(reference_names) + list(compared_names):
+        if name not in masks:
+            mask = study.get_mask(name)
+            if not isinstance(mask, CompactMask):
+                mask = CompactMask.from_dense(mask)
+            masks[name] = mask
+    
+    # Geometry is computed before starting the processes.
+    geometry = study.geometry
+    
+    shared_memory, layout = share_masks(masks)
+    executor = ProcessPoolExecutor(max_workers=processes,
+                                   initializer=attach_shared_masks,
+                                   initargs=(shared_memory.name, layout),
+                                   )
+    try:
+        futures = [executor.submit(compute_shared_pair_metrics,
+                                   reference_name,
+                                   compared_name,
+                                   geometry,
+                                   tolerances_mm,
+                                   percentiles,
+                                   report_speedup=report_speedup,
+                                   )
+                   for reference_name, compared_name
+                   in zip(reference_names, compared_names)]
+        for future in futures:
+            with telemetry.profile_stage(study.profiler, "metrics"):
+                metrics = future.result()
+            yield metrics
+    finally:
+        executor.shutdown(cancel_futures=True)
+        shared_memory.close()
+        shared_memory.unlink()
+
+def scan_patient(input_folder_path,
+                 patient_folder,
+                 patient_files=None,
+                 profiler=None,
+                 ):
+    """
+    Reading the information needed to plan the analysis of a patient from
+    the headers of its files.
+    
+    Files are classified by their header (see
+    classification.classify_patient_files), both in the patient folder and in
+    its subfolders, and only the selected CT series and RTSTRUCT are
+    described. Pixel data and contours are never loaded. Nothing is moved or
+    created.
+
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folder : str
+        Name of the patient folder.
+    patient_files : dict or None
+        Files of the patient (see classification.classify_patient_files). If
+        None they are classified (or taken from
+        classification.CLASSIFICATION_CACHE).
+    profiler : telemetry.Profiler or None
+        Profiler of the patient, the bytes of the headers read to classify
+        the files are counted with it.
+
+    Returns
+    -------
+    entry : dict
+        Manifest entry of the patient with keys "Patient folder",
+        "Patient ID", "Study instance UID", "Series instance UID",
+        "Frame of reference", "RTSTRUCT SOP instance UID", "Slices", "Rows",
+        "Columns", "ROI names" and "Bytes". Values that could not be read
+        are None.
+
+    """
+    if patient_files is None:
+        patient_folder_path = os.path.join(input_folder_path,
+                                           patient_folder,
+                                           )
+        patient_files = classification.classify_patient_files(patient_folder_path,
+                                                              profiler=profiler,
+                                                              )
+    ct_file_paths = patient_files["CT"]
+    rtstruct_file_paths = patient_files["RTSTRUCT"][:1]
+    
+    entry = {"Patient folder": patient_folder,
+             "Patient ID": None,
+             "Study instance UID": None,
+             "Series instance UID": patient_files["Series instance UID"],
+             "Frame of reference": None,
+             "RTSTRUCT SOP instance UID": None,
+             "Slices": len(ct_file_paths),
+             "Rows": None,
+             "Columns": None,
+             "ROI names": [],
+             "Bytes": sum(os.path.getsize(file_path) for file_path
+                          in ct_file_paths + rtstruct_file_paths),
+             }
+    
+    if len(rtstruct_file_paths) > 0:
+        rtstruct_info = patient_files["Structure sets"][rtstruct_file_paths[0]]
+        entry["Patient ID"] = rtstruct_info["Patient ID"]
+        entry["Study instance UID"] = rtstruct_info["Study instance UID"]
+        entry["Frame of reference"] = rtstruct_info["Frame of reference"]
+        entry["RTSTRUCT SOP instance UID"] = rtstruct_info["SOP instance UID"]
+        entry["ROI names"] = list(rtstruct_info["ROI names"])
+    
+    # All the slices of a series have the same size.
+    if entry["Series instance UID"] is not None:
+        series_info = patient_files["Series"][entry["Series instance UID"]]
+        entry["Rows"] = series_info["Rows"]
+        entry["Columns"] = series_info["Columns"]
+    
+    return entry
+
+def scan_patients(input_folder_path,
+                  patient_folders,
+                  profilers=None,
+                  patient_files=None,
+                  ):
+    """
+    Creating the manifest of all patients before starting the analysis.
+
+    Parameters
+    ----------
+    input_folder_path : str
+        Path to the folder where patients are stored.
+    patient_folders : list
+        List containing the names of patient folders in the input directory.
+    profilers : dict or None
+        Profiler of each patient folder, the scan of every patient is timed
+        and the bytes of the headers it reads are counted with it. If None
+        nothing is timed.
+    patient_files : dict or None
+        Files of each patient folder (see
+        classification.classify_patient_files). Folders that are not in it
+        are classified by the headers of their files (or taken from
+        classification.CLASSIFICATION_CACHE).
+
+    Returns
+    -------
+    manifest : list
+        Manifest entry (see scan_patient) of each patient, in the same order
+        of patient_folders.
+
+    """
+    if profilers is None:
+        profilers = {}
+    if patient_files is None:
+        patient_files = {}
+    
+    manifest = []
+    for patient_folder in patient_folders:
+        profiler = profilers.get(patient_folder)
+        with telemetry.profile_stage(profiler, "scan"):
+            manifest.append(scan_patient(input_folder_path,
+                                         patient_folder,
+                                         patient_files.get(patient_folder),
+                                         profiler,
+                                         ))
+    
+    return manifest
+
+def estimate_patient_cost(entry,
+                          config,
+                          skip_comparisons=None,
+                          ):
+    """
+    Estimating the work needed to analyse a patient from its manifest entry.
     
-    The list of all segments in the image is extracted from patient data.
-    Then, the manual_segments list is created starting from the list of alias
-    names and is initially filled with zeros.
-    Every element of all_segments is compared with the lists of names in the 
-    config.json file and inserted in the correct place of the manual_segments
-    list.
+    Every comparison rasterizes and compares labelmaps as large as the CT
+    series, so the cost is the number of voxels of the series times the
+    number of comparisons still to be computed. The value is only meaningful
+    relative to the cost of other patients.
 
     Parameters
     ----------
-    all_segments: list
-        List of all the segments in the current CT series
-        (Ex. [Prostate, Bladder, Rectum]).
+    entry : dict
+        Manifest entry of the patient (see scan_patient).
     config : dict
-        Dictionary containing lists of possible manual segments names.
+        Content of the configuration file.
+    skip_comparisons : set or None
+        Comparisons already computed, as (compared methods, alias name)
+        tuples.
 
     Returns
     -------
-    manual_segments: list
-        List containing current patient manual segments names.
+    cost : int
+        Estimated cost of the patient, 0 if the CT size is unknown.
 
     """
-    # Creates the list of manual segments
-    manual_segments = [0 for i in range(len(config["Alias names"]))]
-    # Puts every manual segment in the correct place of the list
-    for name in all_segments:
-        if name in config["MBS segments"]:
-            continue
-        elif name in config["DL segments"]:
-            continue
-        elif name in config["External names"]:
-            continue
-        elif name in config["Prostate names"]:
-            manual_segments[0] = name
-        elif name in config["Rectum names"]:
-            manual_segments[1] = name
-        elif name in config["Bladder names"]:
-            manual_segments[2] = name
-        elif name in config["Left femur names"]:
-            manual_segments[3] = name
-        elif name in config["Right femur names"]:
-            manual_segments[4] = name
-        else:
-            continue
-        
-    return manual_segments
+    comparisons = expected_comparisons(config)
+    if skip_comparisons is not None:
+        comparisons = comparisons - set(skip_comparisons)
+    
+    if entry["Rows"] is None or entry["Columns"] is None:
+        return 0
+    
+    return (entry["Slices"]
+            * entry["Rows"]
+            * entry["Columns"]
+            * len(comparisons)
+            )
 
-def create_labelmap(ct_folder_path,
-                    rtstruct_file_path,
-                    segment_name,
-                    ):
+def longest_job_first(costs):
     """
-    Creating the binary labelmap for the current segment.
+    Ordering jobs from the most to the least expensive, so that in a pool of
+    workers the largest patients do not start last and straggle at the end.
 
     Parameters
     ----------
-    ct_folder_path : str
-        Path to the folder containing DICOM series files
-        (Ex: path/to/CTfolder).
-    rtstruct_file_path : str
-        Path to the RTSTRUCT.dcm file (Ex: "path/to/RTSTRUCT.dcm").
-    segment_name : str
-        Name of the segment
-        (Ex. "Prostate")
-     
+    costs : list
+        Estimated cost of every job.
+
     Returns
     -------
-    labelmap : numpy.ndarray
-        3D binary array of the selected segment (0 out of the segment,
-        1 inside).
+    order : list
+        Indices of costs sorted by decreasing cost, jobs with the same cost
+        keep their original order.
 
     """
-    # Reading current patient files.
-    patient_data = RTStructBuilder.create_from(ct_folder_path, 
-                                               rtstruct_file_path,
-                                               )
-    
-    # Binary labelmap creation
-    labelmap = patient_data.get_roi_mask_by_name(segment_name)
-    
-    return labelmap
+    return sorted(range(len(costs)),
+                  key=lambda index: -costs[index],
+                  )
 
-def compute_metrics(reference_labelmap,
-                    compared_labelmap,
-                    ct_folder_path,
-                    ):
+def save_manifest(manifest,
+                  manifest_path,
+                  ):
     """
-    Computing Hausdorff distance (hd), volumetric Dice similarity coefficient
-    (dsc) and surface Dice similarity coefficient (sdsc).
-    
-    Starting from the binary labelmaps of the two segments the three metrics
-    are computed.
-    Surface Dice tolerance is set equal to the greatest voxel dimension.
-    Percent value of Hausdorff distance is set to 95.
-    
+    Saving the manifest of the patients into a json file.
 
     Parameters
     ----------
-    reference_labelmap: numpy.ndarray
-        3D binary array of the reference segment.
-    compared_labelmap: numpy.ndarray
-        3D binary array of the segment to compare.
-    voxel_spacing_mm : list
-        Voxel dimensions (Ex. [1, 1, 3])
+    manifest : list
+        Manifest entries of the patients.
+    manifest_path : str
+        Path to the json file.
 
     Returns
     -------
-    surface_dice : float
-        Value of the surface Dice similarity coefficient between the two
-        compared segments.
-    volume_dice : float
-        Value of the Dice similarity coefficient between the two compared
-        segments.
-    hausdorff_distance : float
-        Value of the Hausdorff distance between the two compared segments.
+    None.
 
     """
-    # Computing voxel spacing and tolerance
-    voxel_spacing_mm, tolerance = spacing_and_tolerance(ct_folder_path)
-    
-    # Metrics computation
-    surf_dists = sd.compute_surface_distances(reference_labelmap,
-                                              compared_labelmap,
-                                              voxel_spacing_mm,
-                                              )
-    
-   
-    surface_dice = sd.compute_surface_dice_at_tolerance(surf_dists,
-                                                        tolerance_mm=tolerance,
-                                                        )
-    
-    volume_dice = sd.compute_dice_coefficient(reference_labelmap,
-                                              compared_labelmap,
-                                              )
-    
-    hausdorff_distance = sd.compute_robust_hausdorff(surf_dists,
-                                                     percent=95,
-                                                     )
-    
-    return surface_dice, volume_dice, hausdorff_distance
+    json_object = json.dumps(manifest,
+                             indent=4,
+                             )
+    with open(manifest_path, "w") as outfile:
+        outfile.write(json_object)
 
 def store_patients(input_folder_path):
     """
@@ -478,7 +2526,12 @@ def move_ct_rtstruct_files(patient_folder_path,
                            ):
     """
     Moving CT files in the CT folder and RS files in the RTSTRUCT folder.
-    Folders and different kind of files won't be moved.
+    Files are recognized by their header (see
+    classification.classify_patient_files): the files of the selected CT
+    series and the RTSTRUCT that references it are moved, other series,
+    other RTSTRUCTs and different kind of files won't be moved. The
+    classification of the patient is updated with the new paths, so the
+    files are not read again.
     
     Parameters
     ----------
@@ -494,23 +2547,41 @@ def move_ct_rtstruct_files(patient_folder_path,
     None.
 
     """
-    for file in os.listdir(patient_folder_path):
-        file_path = os.path.join(patient_folder_path,
-                                 file,
-                                 )
-        if not os.path.isfile(file_path):
-            pass
-        else:
-            if not (file.startswith("CT") or file.startswith("RS")):
-                pass
-            elif file.startswith("CT"):
-                shutil.move(file_path,
-                            ct_folder_path,
-                            )
-            elif file.startswith("RS"):
-                shutil.move(file_path,
-                            rtstruct_folder_path,
-                            )
+    patient_files = classification.classify_patient_files(patient_folder_path)
+    
+    moved_paths = {}
+    for file_paths, folder_path in [(patient_files["CT"], ct_folder_path),
+                                    (patient_files["RTSTRUCT"][:1],
+                                     rtstruct_folder_path,
+                                     ),
+                                    ]:
+        for file_path in file_paths:
+            new_file_path = os.path.join(folder_path,
+                                         os.path.basename(file_path),
+                                         )
+            shutil.move(file_path,
+                        new_file_path,
+                        )
+            moved_paths[file_path] = new_file_path
+    
+    # Updating the paths of the classification.
+    def relocate(file_path):
+        return moved_paths.get(file_path, file_path)
+    
+    for series_info in patient_files["Series"].values():
+        series_info["Files"] = [relocate(file_path) for file_path
+                                in series_info["Files"]]
+    patient_files["CT"] = sorted(relocate(file_path) for file_path
+                                 in patient_files["CT"])
+    patient_files["RTSTRUCT"] = [relocate(file_path) for file_path
+                                 in patient_files["RTSTRUCT"]]
+    patient_files["Structure sets"] = OrderedDict(
+        (relocate(file_path), rtstruct_info) for file_path, rtstruct_info
+        in patient_files["Structure sets"].items()
+        )
+    classification.CLASSIFICATION_CACHE.put(patient_folder_path,
+                                            patient_files,
+                                            )
 
 def fill_ct_rtstruct_folders(patient_folder_path,
                              ct_folder_path,
@@ -652,9 +2723,38 @@ def exit_if_no_patients(input_folder_path,
                   )
                  )
         
+def exit_if_no_series(patient_folder_path,
+                      patient_files,
+                      ):
+    """
+    Exiting from execution if a patient has no CT or no RTSTRUCT files.
+
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder.
+    patient_files : dict
+        Files of the patient (see classification.classify_patient_files).
+
+    Returns
+    -------
+    None.
+
+    """
+    for modality in ["CT", "RTSTRUCT"]:
+        if len(patient_files[modality]) == 0:
+            sys.exit(f"{patient_folder_path} does not contain {modality} "
+                     "files, execution halted")
+
 def extract_rtstruct_file_path(rtstruct_folder_path):
     """
     Extracting rtstruct file path.
+    
+    Files of the patient folder that contains the RTSTRUCT folder are
+    classified by their header (see classification.classify_patient_files)
+    and the RTSTRUCT that references the CT series is chosen among the ones
+    in the folder. If no file of the folder is recognized the last one is
+    returned.
 
     Parameters
     ----------
@@ -667,6 +2767,15 @@ def extract_rtstruct_file_path(rtstruct_folder_path):
         Path to the RS.dcm file.
 
     """
+    patient_folder_path = os.path.dirname(os.path.normpath(rtstruct_folder_path))
+    patient_files = classification.classify_patient_files(patient_folder_path)
+    for file_path in patient_files["RTSTRUCT"]:
+        if (os.path.normpath(os.path.dirname(file_path))
+            == os.path.normpath(rtstruct_folder_path)):
+            return os.path.join(rtstruct_folder_path,
+                                os.path.basename(file_path),
+                                )
+    
     for file in os.listdir(rtstruct_folder_path):
         rtstruct_file_path = os.path.join(rtstruct_folder_path,
                                           file,
@@ -707,50 +2816,290 @@ def create_segments_matrices(manual_segments,
     
     return ref_segs, comp_segs
 
-def extract_hausdorff_dice(manual_segments,
-                           config,
-                           ct_folder_path,
-                           rtstruct_file_path,
-                           final_data
-                           ):
+# Columns of the final dataframe that are always present.
+DATA_COLUMNS = ["Patient ID",
+                "Frame of reference",
+                "Compared methods",
+                "Reference segment name",
+                "Compared segment name",
+                "Alias name",
+                "95% Hausdorff distance (mm)",
+                "Volumetric Dice similarity coefficient",
+                "Surface Dice similarity coefficient",
+                ]
+
+# Columns that identify the RTSTRUCT and the configuration of every row, they
+# follow the metric columns.
+STUDY_COLUMNS = ["RTSTRUCT SOP instance UID",
+                 "Configuration hash",
+                 ]
+
+# Configuration entries that change the computed rows.
+HASHED_CONFIG_KEYS = ["Compared methods",
+                      "MBS segments",
+                      "DL segments",
+                      "Alias names",
+                      "Hausdorff percentiles",
+                      "Surface Dice tolerances (mm)",
+                      ]
+
+def config_hash(config):
     """
-    Extracting Hausdorff distance, Dice similarity coefficient and
-    surface dice similarity coefficient for each segment.
-    The comparisons manual-MBS, manual-DL and MBS-DL are performed.
-    Extracted data are saved in the final_data list.
+    Computing a short hash of the configuration entries that change the
+    computed rows.
+    
+    Lists of manual segments names are not included, they only grow when new
+    names are met and do not change the results of already analysed
+    patients.
 
     Parameters
     ----------
-    manual_segments : list
-        List of the manual segments.
     config : dict
-        Dictionary containing lists of possible manual segments names.
-    ct_folder_path : str
-        Path to the folder where CT files will be stored.
-    rtstruct_file_path : str
-        Path to the RS.dcm file.
-    final_data: list
-        List containing the final data.
+        Content of the configuration file.
 
     Returns
     -------
-    final_data: list
-        List containing the final data (updated)
+    digest : str
+        Hexadecimal hash of the configuration.
 
     """
-    # Extraction of patient ID and frame of reference UID.
-    patient_id = patient_info(rtstruct_file_path,
-                              "PatientID",
-                              )
-    frame_of_reference_uid = patient_info(rtstruct_file_path,
-                                          "FrameOfReferenceUID",
-                                          )
+    relevant = {key: config.get(key) for key in HASHED_CONFIG_KEYS}
+    serialized = json.dumps(relevant,
+                            sort_keys=True,
+                            )
+    
+    return hashlib.sha1(serialized.encode()).hexdigest()[:16]
+
+def expected_comparisons(config):
+    """
+    Creating the set of the comparisons performed for every patient.
+
+    Parameters
+    ----------
+    config : dict
+        Content of the configuration file.
+
+    Returns
+    -------
+    comparisons : set
+        Set of (compared methods, alias name) tuples
+        (Ex. {("Manual-MBS", "Prostate"), ...}).
+
+    """
+    return {(methods, alias)
+            for methods in config["Compared methods"]
+            for alias in config["Alias names"]}
+
+def metric_settings(config):
+    """
+    Extracting the additional Hausdorff distance percentiles and surface Dice
+    tolerances from the configuration.
+    
+    The 95 percentile Hausdorff distance and the surface Dice at the greatest
+    voxel dimension are always computed, so they are not repeated.
+
+    Parameters
+    ----------
+    config : dict
+        Content of the configuration file. Percentiles are read from
+        "Hausdorff percentiles" and tolerances from
+        "Surface Dice tolerances (mm)", both are optional.
+
+    Returns
+    -------
+    percentiles : list
+        Additional percentiles of the Hausdorff distance (Ex. [100]).
+    tolerances_mm : list
+        Additional tolerances of the surface Dice in millimeters
+        (Ex. [1, 2, 3]).
+
+    """
+    percentiles = [float(percent) for percent
+                   in config.get("Hausdorff percentiles", [])
+                   if float(percent) != 95]
+    tolerances_mm = [float(tolerance) for tolerance
+                     in config.get("Surface Dice tolerances (mm)", [])]
+    
+    return percentiles, tolerances_mm
+
+def result_columns(config):
+    """
+    Creating the list of the columns of the final dataframe.
+
+    Parameters
+    ----------
+    config : dict
+        Content of the configuration file.
+
+    Returns
+    -------
+    columns : list
+        DATA_COLUMNS followed by a column for each additional Hausdorff
+        distance percentile and surface Dice tolerance and by STUDY_COLUMNS.
+
+    """
+    percentiles, tolerances_mm = metric_settings(config)
+    columns = list(DATA_COLUMNS)
+    columns += [f"{percent:g}% Hausdorff distance (mm)"
+                for percent in percentiles]
+    columns += [f"Surface Dice similarity coefficient at {tolerance:g} mm"
+                for tolerance in tolerances_mm]
+    columns += STUDY_COLUMNS
+    
+    return columns
+
+class ComparisonResult(namedtuple("ComparisonResult",
+                                  ["patient_id",
+                                   "frame_of_reference_uid",
+                                   "compared_methods",
+                                   "reference_segment_name",
+                                   "compared_segment_name",
+                                   "alias_name",
+                                   "hausdorff_95_mm",
+                                   "volume_dice",
+                                   "surface_dice",
+                                   "extra_values",
+                                   "rtstruct_uid",
+                                   "config_hash",
+                                   ],
+                                  )):
+    """
+    Result of the comparison between two segments of a patient.
+
+    Attributes
+    ----------
+    patient_id : str
+        Patient ID.
+    frame_of_reference_uid : str
+        Frame of reference UID of the study.
+    compared_methods : str
+        Compared methods (Ex. "Manual-MBS").
+    reference_segment_name : str
+        Name of the reference segment.
+    compared_segment_name : str
+        Name of the compared segment.
+    alias_name : str
+        Alias name of the segment.
+    hausdorff_95_mm : float
+        95 percentile Hausdorff distance in millimeters.
+    volume_dice : float
+        Volumetric Dice similarity coefficient.
+    surface_dice : float
+        Surface Dice similarity coefficient at the greatest voxel dimension.
+    extra_values : tuple
+        Additional percentile Hausdorff distances and surface Dice values,
+        in the order of the columns given by result_columns(config).
+    rtstruct_uid : str
+        SOP instance UID of the RTSTRUCT.
+    config_hash : str
+        Hash of the configuration used (see config_hash).
+
+    """
+    __slots__ = ()
+    
+    def to_row(self):
+        """
+        Converting the result to a row of the final data.
+
+        Returns
+        -------
+        row : list
+            Values in the order of the columns given by
+            result_columns(config).
+
+        """
+        return (list(self[:9])
+                + list(self.extra_values)
+                + [self.rtstruct_uid, self.config_hash]
+                )
+
+def iter_hausdorff_dice(manual_segments,
+                        config,
+                        ct_folder_path,
+                        rtstruct_file_path=None,
+                        report_crop_speedup=False,
+                        threads=1,
+                        skip_comparisons=None,
+                        ):
+    """
+    Computing Hausdorff distance, Dice similarity coefficient and
+    surface dice similarity coefficient for each segment, one comparison at a
+    time.
+    The comparisons manual-MBS, manual-DL and MBS-DL are performed and every
+    result is yielded as soon as it is computed, so nothing is accumulated.
+
+    Parameters
+    ----------
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    ct_folder_path : str or PatientStudy
+        Path to the folder where CT files will be stored or an already loaded
+        patient study.
+    rtstruct_file_path : str or None
+        Path to the RS.dcm file. Ignored if ct_folder_path is a PatientStudy.
+    report_crop_speedup : bool
+        If True the speedup obtained by cropping the labelmaps is printed for
+        every comparison.
+    threads : int
+        Number of comparisons computed at the same time (default 1). With more
+        than one, comparisons are computed in a pool of processes that share
+        every labelmap, created once (see compute_pairs_metrics), and each
+        result is still yielded as soon as it is computed.
+    skip_comparisons : set or None
+        Comparisons already computed, as (compared methods, alias name)
+        tuples, they are not computed again.
+
+    Yields
+    ------
+    result : ComparisonResult
+        Result of each comparison, ordered by compared methods and alias name.
+
+    """
+    if skip_comparisons is None:
+        skip_comparisons = set()
+    
+    # CT series and RTSTRUCT are read only once for all the comparisons.
+    study = open_study(ct_folder_path,
+                       rtstruct_file_path,
+                       )
+    
+    # Extraction of patient ID, frame of reference UID and of the values that
+    # identify the RTSTRUCT and the configuration.
+    patient_id = study.patient_id
+    frame_of_reference_uid = study.frame_of_reference_uid
+    rtstruct_uid = str(study.rtstruct_dataset.SOPInstanceUID)
+    digest = config_hash(config)
     
     # Reference and compared segments lists.
     ref_segs, comp_segs = create_segments_matrices(manual_segments,
                                                    config,
                                                    )
     
+    # Surface Dice is always computed at the greatest voxel dimension plus
+    # the additional tolerances, all from the same surface distances.
+    percentiles, extra_tolerances_mm = metric_settings(config)
+    voxel_tolerance = max(study.geometry.voxel_spacing_mm)
+    tolerances_mm = [voxel_tolerance] + extra_tolerances_mm
+    
+    # With more than one thread the comparisons are computed in parallel and
+    # their metrics are taken in the same order of the loop below.
+    parallel_metrics = None
+    if threads > 1:
+        pairs = [(methods, segment)
+                 for methods in range(len(config["Compared methods"]))
+                 for segment in range(len(config["Alias names"]))
+                 if (config["Compared methods"][methods],
+                     config["Alias names"][segment]) not in skip_comparisons]
+        parallel_metrics = compute_pairs_metrics(study,
+                                                 [ref_segs[m][s] for m, s in pairs],
+                                                 [comp_segs[m][s] for m, s in pairs],
+                                                 threads,
+                                                 tolerances_mm,
+                                                 percentiles,
+                                                 report_speedup=report_crop_speedup,
+                                                 )
     
     # Computing HD, DSC and SDSC for every segment in manual and MBS lists.
     for methods in range(len(config["Compared methods"])):
@@ -761,38 +3110,107 @@ def extract_hausdorff_dice(manual_segments,
               )
         
         for segment in range(len(config["Alias names"])):
-            #Create binary labelmaps for reference and to compare segments.
-            ref_labelmap = create_labelmap(ct_folder_path,
-                                           rtstruct_file_path,
-                                           ref_segs[methods][segment],
-                                           )
-            comp_labelmap = create_labelmap(ct_folder_path,
-                                            rtstruct_file_path,
-                                            comp_segs[methods][segment],
-                                            )
+            if (config["Compared methods"][methods],
+                config["Alias names"][segment]) in skip_comparisons:
+                continue
             
-            # Computing surface Dice similarity coefficient (sdsc), Dice
-            # similarity coefficient (dsc) and Hausdorff distance (hd).
-            sdsc, dsc, hd = compute_metrics(ref_labelmap,
-                                            comp_labelmap,
-                                            ct_folder_path,
-                                            )
+            if parallel_metrics is not None:
+                metrics = next(parallel_metrics)
+            else:
+                #Create binary labelmaps for reference and to compare segments.
+                ref_labelmap = study.get_mask(ref_segs[methods][segment])
+                comp_labelmap = study.get_mask(comp_segs[methods][segment])
+                
+                # Computing all the metrics with a single surface distance
+                # computation.
+                with telemetry.profile_stage(study.profiler, "metrics"):
+                    metrics = compute_all_metrics(ref_labelmap,
+                                                  comp_labelmap,
+                                                  study.geometry,
+                                                  tolerances_mm,
+                                                  percentiles,
+                                                  report_speedup=report_crop_speedup,
+                                                  )
             
-            # Temporary list to store the current row of the final
-            # dataframe.
-            row = [patient_id,
-                   frame_of_reference_uid,
-                   config["Compared methods"][methods],
-                   ref_segs[methods][segment],
-                   comp_segs[methods][segment],
-                   config["Alias names"][segment],
-                   hd,
-                   dsc,
-                   sdsc,
-                   ]
+            # Additional percentiles and tolerances.
+            extra_values = tuple([metrics.percentile_hausdorff_mm[percent]
+                                  for percent in percentiles]
+                                 + [metrics.surface_dice[tolerance]
+                                    for tolerance in extra_tolerances_mm]
+                                 )
             
-            # Adding the constructed row to final_data.
-            final_data.append(row)
+            yield ComparisonResult(patient_id,
+                                   frame_of_reference_uid,
+                                   config["Compared methods"][methods],
+                                   ref_segs[methods][segment],
+                                   comp_segs[methods][segment],
+                                   config["Alias names"][segment],
+                                   metrics.hausdorff_95_mm,
+                                   metrics.volume_dice,
+                                   metrics.surface_dice[voxel_tolerance],
+                                   extra_values,
+                                   rtstruct_uid,
+                                   digest,
+                                   )
+
+def extract_hausdorff_dice(manual_segments,
+                           config,
+                           ct_folder_path,
+                           rtstruct_file_path=None,
+                           final_data=None,
+                           report_crop_speedup=False,
+                           threads=1,
+                           skip_comparisons=None,
+                           ):
+    """
+    Extracting Hausdorff distance, Dice similarity coefficient and
+    surface dice similarity coefficient for each segment.
+    The comparisons manual-MBS, manual-DL and MBS-DL are performed.
+    Extracted data are saved in the final_data list, each row has the columns
+    given by result_columns(config). See iter_hausdorff_dice to receive the
+    results one at a time.
+
+    Parameters
+    ----------
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    ct_folder_path : str or PatientStudy
+        Path to the folder where CT files will be stored or an already loaded
+        patient study.
+    rtstruct_file_path : str or None
+        Path to the RS.dcm file. Ignored if ct_folder_path is a PatientStudy.
+    final_data: list or None
+        List containing the final data. If None a new list is created.
+    report_crop_speedup : bool
+        If True the speedup obtained by cropping the labelmaps is printed for
+        every comparison.
+    threads : int
+        Number of comparisons computed at the same time (default 1).
+    skip_comparisons : set or None
+        Comparisons already computed, as (compared methods, alias name)
+        tuples, they are not computed again.
+
+    Returns
+    -------
+    final_data: list
+        List containing the final data (updated)
+
+    """
+    if final_data is None:
+        final_data = []
+    
+    for result in iter_hausdorff_dice(manual_segments,
+                                      config,
+                                      ct_folder_path,
+                                      rtstruct_file_path,
+                                      report_crop_speedup,
+                                      threads,
+                                      skip_comparisons,
+                                      ):
+        # Adding the row of the comparison to final_data.
+        final_data.append(result.to_row())
     
     return final_data
 
@@ -909,38 +3327,98 @@ def concatenate_data(old_data,
     
     return new_data
 
-def check_study(old_data,
-                frame_of_reference_uid,
-                patient_id,
-                ):
+class StudyIndex:
     """
-    Checking if the current patient has been already analysed.
+    Index of the studies already analysed, built once from the old data.
+    
+    Studies are identified by FrameOfReferenceUID, RTSTRUCT SOPInstanceUID
+    and configuration hash, so a study is analysed again if its contours or
+    the configuration changed. For each study the index stores the
+    comparisons already computed, thus, deciding what to do with a patient
+    takes constant time.
+    Rows saved before the RTSTRUCT and configuration columns were introduced
+    are indexed by frame of reference only and their studies are skipped.
 
     Parameters
     ----------
     old_data : DataFrame
-        Dataframe contained in the excel file (if there is not an excel file
-        it is an empty dataframe).
-    frame_of_reference_uid : pydicom.uid.UID
-        Code of the current patient.
-    patient_id : str
-        Name of the anlysed patient.
-
-    Returns
-    -------
-    frame_uid_in_old_data : bool
-        Flag to know if the current patient study is already in the dataframe.
+        Dataframe of the data already computed (it can be empty).
 
     """
-    for frame_of_reference in old_data.loc[:,"Frame of reference"]:
-        if frame_of_reference == frame_of_reference_uid:
-            print(f"Study {frame_of_reference} of patient",
-                  f"{patient_id} is alreday in the dataframe,",
-                  "going to the next one",
-                  )
-            frame_uid_in_old_data = True
-            break
-        else:
-            frame_uid_in_old_data = False
+    def __init__(self, old_data):
+        # Comparisons of each (frame of reference, RTSTRUCT, configuration).
+        self._comparisons = {}
+        # Frames of reference of the rows without RTSTRUCT and configuration.
+        self._legacy_frames = set()
+        
+        if "Frame of reference" not in old_data.columns:
+            return
+        
+        frames = old_data["Frame of reference"]
+        methods = old_data.get("Compared methods",
+                               pd.Series([None] * len(old_data)),
+                               )
+        aliases = old_data.get("Alias name",
+                               pd.Series([None] * len(old_data)),
+                               )
+        missing = pd.Series([None] * len(old_data))
+        rtstruct_uids = old_data.get(STUDY_COLUMNS[0], missing)
+        hashes = old_data.get(STUDY_COLUMNS[1], missing)
+        
+        for frame, method, alias, rtstruct_uid, digest in zip(frames,
+                                                              methods,
+                                                              aliases,
+                                                              rtstruct_uids,
+                                                              hashes,
+                                                              ):
+            if pd.isna(rtstruct_uid) or pd.isna(digest):
+                self._legacy_frames.add(str(frame))
+            else:
+                key = (str(frame), str(rtstruct_uid), str(digest))
+                self._comparisons.setdefault(key, set()).add((method, alias))
     
-    return frame_uid_in_old_data
\ No newline at end of file
+    def status(self,
+               frame_of_reference_uid,
+               rtstruct_uid,
+               digest,
+               comparisons,
+               ):
+        """
+        Deciding if a study must be skipped, partially computed or computed.
+
+        Parameters
+        ----------
+        frame_of_reference_uid : str
+            FrameOfReferenceUID of the study.
+        rtstruct_uid : str
+            SOPInstanceUID of the RTSTRUCT file.
+        digest : str
+            Hash of the configuration (see config_hash).
+        comparisons : set
+            Comparisons required for the study (see expected_comparisons).
+
+        Returns
+        -------
+        status : str
+            "skip" if every comparison is already computed, "partial" if only
+            some of them are, "compute" otherwise.
+        done : set
+            Comparisons already computed.
+
+        """
+        if str(frame_of_reference_uid) in self._legacy_frames:
+            return "skip", set(comparisons)
+        
+        done = self._comparisons.get((str(frame_of_reference_uid),
+                                      str(rtstruct_uid),
+                                      str(digest),
+                                      ),
+                                     set(),
+                                     )
+        done = done & set(comparisons)
+        if done == set(comparisons):
+            return "skip", done
+        elif len(done) > 0:
+            return "partial", done
+        else:
+            return "compute", done
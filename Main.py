@@ -1,12 +1,253 @@
 import argparse
 import sys
 import os
+import time
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import pandas as pd
 
 import HD_DSC
+import classification
+import storage
+import telemetry
 
 
+def compute_patient(ct_folder_path,
+                    rtstruct_file_path,
+                    manual_segments,
+                    config,
+                    report_crop_speedup=False,
+                    threads=1,
+                    mask_cache_bytes=HD_DSC.DEFAULT_MASK_CACHE_BYTES,
+                    disk_cache=None,
+                    skip_comparisons=None,
+                    on_row=None,
+                    profiler=None,
+                    on_start=None,
+                    ):
+    """
+    Computing HD, DSC and SDSC between all the segments of a single patient.
+    
+    When patients are processed in parallel this function runs in a worker
+    process, thus, it receives only paths and plain data and every error is
+    returned instead of being raised, so that a failing patient does not stop
+    the others.
+
+    Parameters
+    ----------
+    ct_folder_path : str or HD_DSC.PatientStudy
+        Path to the CT folder or an already loaded patient study.
+    rtstruct_file_path : str or None
+        Path to the RS.dcm file. Ignored if ct_folder_path is a PatientStudy.
+    manual_segments : list
+        List of the manual segments.
+    config : dict
+        Dictionary containing lists of possible manual segments names.
+    report_crop_speedup : bool
+        If True the speedup obtained by cropping the labelmaps is printed.
+    threads : int
+        Number of comparisons of the patient computed at the same time.
+    mask_cache_bytes : int
+        Greatest number of bytes of labelmaps kept in memory. Ignored if
+        ct_folder_path is a PatientStudy.
+    disk_cache : HD_DSC.DiskMaskCache or None
+        Persistent cache of labelmaps. Ignored if ct_folder_path is a
+        PatientStudy.
+    skip_comparisons : set or None
+        Comparisons already computed, as (compared methods, alias name)
+        tuples.
+    on_row : callable or None
+        Function called with every row as soon as it is computed (Ex. to
+        store it). When the patient runs in a worker process it must be
+        picklable (Ex. telemetry.WorkerEvents.comparison).
+    profiler : telemetry.Profiler or None
+        Profiler of the patient. Ignored if ct_folder_path is a
+        PatientStudy, whose own profiler is used.
+    on_start : callable or None
+        Function called with the start time (as returned by time.time) when
+        the computation starts (Ex. telemetry.WorkerEvents.patient_start).
+
+    Returns
+    -------
+    rows : list or None
+        Rows of the final data of the patient. None if the computation failed.
+    error : str or None
+        Description of the error that stopped the computation. None if the
+        computation succeeded.
+    elapsed : float
+        Seconds spent computing the patient.
+    started : float
+        Time (as returned by time.time) when the computation started.
+    profiler : telemetry.Profiler or None
+        Profiler of the patient with the peak memory of the process that
+        computed it, sampled while the patient was analysed. None if the
+        patient was not profiled.
+
+    """
+    if isinstance(ct_folder_path, HD_DSC.PatientStudy):
+        profiler = ct_folder_path.profiler
+    
+    # Sampling the memory of the process while the patient is analysed.
+    started = time.time()
+    start = time.perf_counter()
+    if on_start is not None:
+        on_start(started)
+    with telemetry.track_rss(profiler):
+        try:
+            if isinstance(ct_folder_path, HD_DSC.PatientStudy):
+                study = ct_folder_path
+            else:
+                study = HD_DSC.PatientStudy(ct_folder_path,
+                                            rtstruct_file_path,
+                                            mask_cache_bytes,
+                                            disk_cache,
+                                            profiler,
+                                            )
+            rows = []
+            for result in HD_DSC.iter_hausdorff_dice(manual_segments,
+                                                     config,
+                                                     study,
+                                                     report_crop_speedup=report_crop_speedup,
+                                                     threads=threads,
+                                                     skip_comparisons=skip_comparisons,
+                                                     ):
+                row = result.to_row()
+                if on_row is not None:
+                    on_row(row)
+                rows.append(row)
+            error = None
+        except (Exception, SystemExit):
+            rows = None
+            error = traceback.format_exc()
+    
+    return rows, error, time.perf_counter() - start, started, profiler
+
+
+def finish_patient(patient_folder,
+                   patient_folder_path,
+                   result,
+                   new_folder_path,
+                   columns,
+                   store=None,
+                   cost=None,
+                   timings=None,
+                   profiler=None,
+                   events=None,
+                   journal=None,
+                   ):
+    """
+    Storing the rows of a computed patient and moving its folder.
+    
+    If the computation failed the error is reported and the patient folder is
+    not moved.
+
+    Parameters
+    ----------
+    patient_folder : str
+        Name of the patient folder.
+    patient_folder_path : str
+        Path to the patient folder.
+    result : tuple
+        Rows, error, elapsed time, start time and profiler returned by
+        compute_patient.
+    new_folder_path : str or bool
+        Path where patient folders will be moved after execution, False if
+        they must not be moved.
+    columns : list
+        Columns of the rows.
+    store : storage.ResultStore or None
+        Store where the rows are committed. If None rows are not stored.
+    cost : int or None
+        Estimated cost of the patient (see HD_DSC.estimate_patient_cost).
+    timings : list or None
+        (cost, elapsed) of the patients already completed, used to predict
+        the time of this patient from its cost. The patient is appended to it.
+    profiler : telemetry.Profiler or None
+        Profiler of the patient, the profiler returned by a worker process is
+        added to it and storing and moving are timed with it.
+    events : telemetry.EventStream or None
+        Stream where the end of the patient is reported.
+    journal : storage.RunJournal or None
+        Journal of the run, where the rows and the stages completed by the
+        patient are recorded.
+
+    Returns
+    -------
+    rows : list or None
+        Rows of the patient, None if the computation failed.
+
+    """
+    rows, error, elapsed, started, worker_profiler = result
+    if profiler is not None and worker_profiler is not None:
+        profiler.merge(worker_profiler)
+    
+    if error is not None:
+        print(f"Patient {patient_folder} failed, it will not be moved:",
+              error,
+              )
+        if events is not None:
+            events.patient_finish(patient_folder,
+                                  elapsed,
+                                  error,
+                                  )
+        if journal is not None:
+            journal.set_stage(patient_folder,
+                              "failed",
+                              )
+        return None
+    
+    # Rows are committed before moving the folder, so a patient that has
+    # been moved always has its data saved.
+    with telemetry.profile_stage(profiler, "store"):
+        if journal is not None:
+            journal.append_rows(patient_folder,
+                                rows,
+                                )
+        if store is not None:
+            store.append_rows(rows,
+                              columns,
+                              )
+    if journal is not None:
+        journal.set_stage(patient_folder,
+                          "computed",
+                          )
+    
+    # Moving patient folder to a different location, if the destination
+    # folder does not exist it will be automatically created.
+    with telemetry.profile_stage(profiler, "move"):
+        HD_DSC.move_patient_folder(new_folder_path,
+                                   patient_folder_path,
+                                   patient_folder,
+                                   )
+    if journal is not None:
+        journal.set_stage(patient_folder,
+                          "moved",
+                          )
+    
+    # Comparing the time predicted from the patients already completed with
+    # the actual one.
+    if cost is not None and timings is not None:
+        done_cost = sum(timing[0] for timing in timings)
+        done_elapsed = sum(timing[1] for timing in timings)
+        if done_cost > 0:
+            predicted = f"{cost * done_elapsed / done_cost:.1f} s"
+        else:
+            predicted = "not available"
+        print(f"Patient {patient_folder} computed in {elapsed:.1f} s",
+              f"(predicted {predicted})",
+              )
+        timings.append((cost, elapsed))
+    
+    if events is not None:
+        events.patient_finish(patient_folder,
+                              elapsed,
+                              )
+    
+    return rows
+
 def main(argv):
     """
     Computation of Hausdorff distance (hd), volumetric Dice similarity 
@@ -71,13 +312,218 @@ def main(argv):
                               )
                         )
     
+    parser.add_argument("-w", "--workers",
+                        dest="workers",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help=("""Number of patients processed in parallel
+                              (default 1)"""
+                              )
+                        )
+    parser.add_argument("-t", "--threads",
+                        dest="threads",
+                        metavar="N",
+                        type=int,
+                        default=1,
+                        required=False,
+                        help=("""Number of comparisons of the same patient
+                              computed in parallel (default 1)"""
+                              )
+                        )
+    parser.add_argument("--mask-cache-mb",
+                        dest="mask_cache_mb",
+                        metavar="MB",
+                        type=int,
+                        default=HD_DSC.DEFAULT_MASK_CACHE_BYTES // 1024**2,
+                        required=False,
+                        help=("""Megabytes of labelmaps kept in memory for
+                              each patient (default 1024)"""
+                              )
+                        )
+    parser.add_argument("--cache-dir",
+                        dest="cache_dir",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the folder where labelmaps are
+                              stored to be reused by the following runs"""
+                              )
+                        )
+    parser.add_argument("--cache-size-mb",
+                        dest="cache_size_mb",
+                        metavar="MB",
+                        type=int,
+                        default=HD_DSC.DEFAULT_DISK_CACHE_BYTES // 1024**2,
+                        required=False,
+                        help=("""Megabytes of labelmaps kept in the cache
+                              folder (default 10240)"""
+                              )
+                        )
+    parser.add_argument("--percentiles",
+                        dest="percentiles",
+                        metavar="P",
+                        type=float,
+                        nargs="+",
+                        default=None,
+                        required=False,
+                        help=("""Hausdorff distance percentiles computed in
+                              addition to 95 (Ex. 100), they replace the
+                              ones in the configuration file"""
+                              )
+                        )
+    parser.add_argument("--tolerances",
+                        dest="tolerances",
+                        metavar="MM",
+                        type=float,
+                        nargs="+",
+                        default=None,
+                        required=False,
+                        help=("""Surface Dice tolerances in millimeters
+                              computed in addition to the greatest voxel
+                              dimension (Ex. 1 2 3), they replace the ones in
+                              the configuration file"""
+                              )
+                        )
+    parser.add_argument("-s", "--result-store",
+                        dest="store_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the SQLite database where the data of
+                              every patient are saved as soon as they are
+                              computed"""
+                              )
+                        )
+    parser.add_argument("--export-excel",
+                        dest="export_excel",
+                        action="store_true",
+                        required=False,
+                        help=("""With --result-store, export the current data
+                              of the store to the excel file at the end of
+                              the run (without it the excel file is not
+                              written)"""
+                              )
+                        )
+    parser.add_argument("--crop-report",
+                        dest="crop_report",
+                        action="store_true",
+                        required=False,
+                        help=("""Print the speedup obtained by cropping the
+                              labelmaps before computing the metrics"""
+                              )
+                        )
+    parser.add_argument("--non-interactive",
+                        dest="non_interactive",
+                        action="store_true",
+                        required=False,
+                        help=("""Unknown segments are resolved with the alias
+                              rules of the configuration file and fuzzy
+                              matching, without asking the user"""
+                              )
+                        )
+    parser.add_argument("--fuzzy-threshold",
+                        dest="fuzzy_threshold",
+                        metavar="SCORE",
+                        type=float,
+                        default=HD_DSC.DEFAULT_FUZZY_THRESHOLD,
+                        required=False,
+                        help=("""Smallest similarity (0-1) for an unknown
+                              segment to be matched to a known name in
+                              non interactive mode"""
+                              )
+                        )
+    parser.add_argument("--deferred-report",
+                        dest="deferred_report_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the json file where the unknown
+                              segments not resolved in non interactive mode
+                              are saved for later review"""
+                              )
+                        )
+    parser.add_argument("--manifest",
+                        dest="manifest_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the json file where the manifest of
+                              the patients, read before the analysis, is
+                              saved"""
+                              )
+                        )
+    parser.add_argument("--profile",
+                        dest="profile_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the json or csv file where the time
+                              spent in every stage, the bytes read, the
+                              masks built and the peak memory of every
+                              patient are saved"""
+                              )
+                        )
+    parser.add_argument("--events",
+                        dest="events_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the file where progress events are
+                              appended as json lines ("-" for the standard
+                              output), with throughput and ETA"""
+                              )
+                        )
+    parser.add_argument("--journal",
+                        dest="journal_path",
+                        metavar="PATH",
+                        default=None,
+                        required=False,
+                        help=("""Path to the SQLite journal where the stages
+                              completed by every patient and the computed
+                              rows are recorded, so that an interrupted run
+                              can be resumed"""
+                              )
+                        )
+    parser.add_argument("--resume",
+                        dest="resume",
+                        action="store_true",
+                        required=False,
+                        help=("""Resume the run recorded in the journal
+                              without computing again the patients and the
+                              comparisons already completed"""
+                              )
+                        )
+    parser.add_argument("--read-only",
+                        dest="read_only",
+                        action="store_true",
+                        required=False,
+                        help=("""Read the files of every patient where they
+                              are, recognized by their DICOM header: no
+                              folder is created and no file or folder is
+                              moved"""
+                              )
+                        )
+    
     args = parser.parse_args(argv)
+    if args.resume and args.journal_path is None:
+        parser.error("--resume requires --journal")
+    if args.export_excel and args.store_path is None:
+        parser.error("--export-excel requires --result-store")
     
     # To better separate input from output messages
     print("\n")
     
     # Check if the user provided new_folder
     new_folder_path = HD_DSC.check_new_folder_path(args.new_folder_path)
+    
+    # In read only mode the input folder is never modified.
+    if args.read_only and new_folder_path:
+        print("Read only mode: patient folders won't be moved after",
+              "execution.",
+              )
+        new_folder_path = False
         
     # Convert to python path style.
     input_folder_path = args.input_folder_path.replace("\\", "/")
@@ -91,260 +537,643 @@ def main(argv):
     # Opening the json file where the lists of names are stored.
     config = HD_DSC.read_config(config_path)
     
+    # Percentiles and tolerances given from command line replace the ones
+    # in the configuration file.
+    if args.percentiles is not None:
+        config["Hausdorff percentiles"] = args.percentiles
+    if args.tolerances is not None:
+        config["Surface Dice tolerances (mm)"] = args.tolerances
+    
+    # Lookup table of all the segment names of the configuration file.
+    alias_index, conflicts = HD_DSC.build_alias_index(config)
+    for name, kept_list, ignored_list in conflicts:
+        print(f"Warning: {name} is both in {kept_list} and in {ignored_list}",
+              f"of the configuration file, {kept_list} is used",
+              )
+    
+    # Alias rules are checked before any patient is analysed.
+    alias_rules = HD_DSC.compile_alias_rules(config)
+    
     # List where final data will be stored.
     final_data = []
     
-    # Input folder can not be empty.
-    HD_DSC.exit_if_empty(input_folder_path)
+    # Number of patients processed in parallel.
+    workers = max(args.workers, 1)
+    
+    # Bytes of labelmaps kept in memory for each patient.
+    mask_cache_bytes = args.mask_cache_mb * 1024**2
+    
+    # Labelmaps are stored on disk only if a cache folder is given.
+    if args.cache_dir is None:
+        disk_cache = None
+    else:
+        disk_cache = HD_DSC.DiskMaskCache(args.cache_dir.replace("\\", "/"),
+                                          args.cache_size_mb * 1024**2,
+                                          )
+    
+    # Columns of the final data.
+    columns = HD_DSC.result_columns(config)
+    
+    # Comparisons required for every patient and hash of the configuration.
+    comparisons = HD_DSC.expected_comparisons(config)
+    digest = HD_DSC.config_hash(config)
+    
+    # The journal records the progress of the run, so that it can be
+    # resumed. A resumed run must have the same configuration and uses the
+    # names already chosen for the unknown segments.
+    if args.journal_path is None:
+        journal = None
+        journal_stages = {}
+    else:
+        journal = storage.RunJournal(args.journal_path.replace("\\", "/"))
+        if args.resume:
+            if journal.setting("Configuration hash") != digest:
+                sys.exit(f"The run in {args.journal_path} was started with a "
+                         "different configuration, execution halted")
+            journal_stages = journal.stages()
+            saved_config = journal.load_config()
+            if saved_config is not None:
+                config = saved_config
+                alias_index, _ = HD_DSC.build_alias_index(config)
+                alias_rules = HD_DSC.compile_alias_rules(config)
+            print(f"Resuming the run in {args.journal_path},",
+                  f"{len(journal_stages)} patients already started",
+                  )
+        else:
+            journal.start(digest,
+                          columns,
+                          )
+            journal_stages = {}
+    
+    # Input folder can not be empty, unless a resumed run has already moved
+    # all its patients.
+    if len(journal_stages) == 0:
+        HD_DSC.exit_if_empty(input_folder_path)
     
     # Input folder must contain patient folders, not directly .dcm files.
     patient_folders = HD_DSC.store_patients(input_folder_path)   
-    HD_DSC.exit_if_no_patients(input_folder_path,
-                               patient_folders,
-                               )
-    # If join_data is True, old data will be extracted from excel_path,
-    # otherwise the old excel file will be overwritten.
-    if join_data:
-        old_data = HD_DSC.load_existing_dataframe(excel_path)
-        
-        for patient_folder in patient_folders:
-            patient_folder_path = os.path.join(input_folder_path,
-                                               patient_folder,
-                                               )
-            
-            # Patient folder can not be empty.
-            HD_DSC.exit_if_empty(patient_folder_path)
-            
-            # RTSTRUCT and CT series should be in different folders.
-            # Creating RTSTRUCT folder if it is not already present, otherwise
-            # going on with the execution.
-            rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                        "RTSTRUCT",
-                                                        )
-            
-            # Creating CT folder if it is not already present, otherwise
-            # going on with the execution.
-            ct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                  "CT",
-                                                  )
-            
-            # Filling CT and RTSTRUCT folders if both empty
-            HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
-                                            ct_folder_path,
-                                            rtstruct_folder_path,
-                                            )
-            
-            # If RTSTRUCT or CT folders are still empty there are no data.
-            HD_DSC.exit_if_empty(rtstruct_folder_path)
-            HD_DSC.exit_if_empty(ct_folder_path)
-            
-            # Extracting rtstruct file path.
-            rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
-                
-            # Extraction of patient ID and frame of reference UID.
-            patient_id = HD_DSC.patient_info(rtstruct_file_path,
-                                             "PatientID",
-                                             )
-            frame_of_reference_uid = HD_DSC.patient_info(rtstruct_file_path,
-                                                         "FrameOfReferenceUID",
-                                                         )
-            
-            print(f"Starting patient {patient_id} analysis")
-            
-            # If the current frame of reference is already in the excel file
-            # we can move to the next one.
-            try:
-                frame_uid_in_old_data = HD_DSC.check_study(old_data,
-                                                           frame_of_reference_uid,
-                                                           patient_id,
-                                                           )
-                if frame_uid_in_old_data:
-                    # Moving patient folder to a different location if the
-                    # destination folder does not exist it will be
-                    # automatically created.
-                    HD_DSC.move_patient_folder(new_folder_path,
-                                               patient_folder_path,
-                                               patient_folder,
-                                               )
-                    continue
-            except KeyError:
-                pass
-                    
-            # Creating the list of all segments of current patient.
-            all_segments = HD_DSC.extract_all_segments(ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       )
-            
-            # Creating manual segments list.
-            print("Creating the list of manual segments")
-            unknown_segments = HD_DSC.find_unknown_segments(all_segments,
-                                                            config,
-                                                            )
-            HD_DSC.user_selection(unknown_segments,
-                                  config,
-                                  )
-            manual_segments = HD_DSC.extract_manual_segments(all_segments,
-                                                             config,
-                                                             )
-            
-            # Computing HD, DSC and SDSC for every segment in manual and MBS
-            # lists.
-            final_data = HD_DSC.extract_hausdorff_dice(manual_segments,
-                                                       config,
-                                                       ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       final_data,
-                                                       )
-            
-            # Moving patient folder to a different location, if the destination
-            # folder does not exist it will be automatically created.
+    if len(journal_stages) == 0:
+        HD_DSC.exit_if_no_patients(input_folder_path,
+                                   patient_folders,
+                                   )
+    
+    # Patients finished by the resumed run are not computed again, their
+    # rows are read from the journal. Patients computed but not moved yet are
+    # moved now.
+    recovered_rows = OrderedDict()
+    for patient_folder, stage in journal_stages.items():
+        if stage not in storage.RunJournal.FINISHED_STAGES:
+            continue
+        recovered_rows[patient_folder] = journal.rows(patient_folder)
+        if stage == "computed" and patient_folder in patient_folders:
             HD_DSC.move_patient_folder(new_folder_path,
-                                       patient_folder_path,
+                                       os.path.join(input_folder_path,
+                                                    patient_folder,
+                                                    ),
                                        patient_folder,
                                        )
-
-        # Creating the dataframe
-        new_data = pd.DataFrame(final_data,
-                                columns=["Patient ID",
-                                         "Frame of reference",
-                                         "Compared methods",
-                                         "Reference segment name",
-                                         "Compared segment name",
-                                         "Alias name",
-                                         "95% Hausdorff distance (mm)",
-                                         "Volumetric Dice similarity coefficient",
-                                         "Surface Dice similarity coefficient",
-                                         ],
-                                )
-        
-        # Concatenating old and new dataframes.
-        new_data = HD_DSC.concatenate_data(old_data,
-                                           new_data,
-                                           )
-        
-        # Saving dataframe to excel.
-        print("Saving data")
-        new_data.to_excel(excel_path,
-                          sheet_name="Data",
-                          index=False,
-                          )
-        
-        # Saving configuration data.
-        HD_DSC.save_config_data(config,
-                                new_config_path,
-                                )
+            journal.set_stage(patient_folder,
+                              "moved",
+                              )
+    patient_folders = [patient_folder for patient_folder in patient_folders
+                       if patient_folder not in recovered_rows]
+    
+    # Rows of every patient are appended to the result store (if given) as
+    # soon as they are computed.
+    if args.store_path is None:
+        store = None
+    else:
+        # A resumed run keeps saving its rows in the run of the store it
+        # started, so that the rows stored before the interruption are still
+        # current. Rows recorded only in the journal are added to it.
+        if args.resume:
+            store_run = journal.setting("Store run")
+        else:
+            store_run = None
+        store = storage.ResultStore(args.store_path.replace("\\", "/"),
+                                    run_id=store_run,
+                                    )
+        if store.has_run():
+            for patient_folder in journal_stages:
+                store.append_missing_rows(journal.rows(patient_folder),
+                                          columns,
+                                          )
+            print(f"Data will be saved in {args.store_path} in the resumed",
+                  f"run {store.run_id}",
+                  )
+        else:
+            store.start_run(join_data)
+            print(f"Data will be saved in {args.store_path} as run {store.run_id}")
+        if journal is not None:
+            journal.save_setting("Store run",
+                                 store.run_id,
+                                 )
+    
+    # If join_data is True, old data will be extracted from excel_path or,
+    # with a result store, only the keys of the studies already analysed are
+    # read from it. Otherwise the old excel file will be overwritten and the
+    # rows already in the store will not be loaded by later runs.
+    # An empty store is filled with the data of the excel file first.
+    old_data = pd.DataFrame()
+    if join_data:
+        if store is None:
+            old_data = HD_DSC.load_existing_dataframe(excel_path)
+            study_keys = old_data
+        else:
+            if len(store.columns()) == 0:
+                store.seed(HD_DSC.load_existing_dataframe(excel_path))
+            study_keys = store.load_study_keys()
+    else:
+        study_keys = old_data
+        if store is None or args.export_excel:
+            print(f"Excel file at {excel_path} will be overwritten if",
+                  "already present, otherwise it will be created.",
+                  )
+    
+    # Index of the studies already analysed, built only once.
+    study_index = HD_DSC.StudyIndex(study_keys)
+    
+    # With more than one worker patients are computed in a process pool.
+    # Unknown segments are always resolved here, in the main process, so that
+    # workers never need to ask the user and config is updated only once.
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        print(f"Processing patients with {workers} workers")
+    else:
+        executor = None
+    
+    # Rows of each patient (None if failed) indexed by input order, and
+    # computations still running in the worker processes.
+    patient_rows = {}
+    pending = {}
+    
+    # Stages of every patient are timed only in profile mode.
+    if args.profile_path is None:
+        profilers = {}
+        run_profiler = None
+    else:
+        profilers = {patient_folder: telemetry.Profiler()
+                     for patient_folder in patient_folders}
+        run_profiler = telemetry.Profiler()
+    
+    # Reading the headers of all patients before any heavy work, so that
+    # studies already analysed are skipped without loading them and the
+    # size of the run is known in advance.
+    # Files are classified from their headers only once, the classification
+    # is reused to move and to load them.
+    print("Scanning patients")
+    manifest = HD_DSC.scan_patients(input_folder_path,
+                                    patient_folders,
+                                    profilers,
+                                    )
+    if args.manifest_path is not None:
+        HD_DSC.save_manifest(manifest,
+                             args.manifest_path.replace("\\", "/"),
+                             )
+    
+    # Planning the run: every patient is skipped, partially computed or
+    # fully computed.
+    plan = []
+    for index, entry in enumerate(manifest):
+        status, done_comparisons = study_index.status(entry["Frame of reference"],
+                                                      entry["RTSTRUCT SOP instance UID"],
+                                                      digest,
+                                                      comparisons,
+                                                      )
+        if status == "skip":
+            print(f"Study {entry['Frame of reference']} of patient",
+                  f"{entry['Patient ID']} is already in the dataframe,",
+                  "it will be skipped",
+                  )
+            # Moving patient folder to a different location if the
+            # destination folder does not exist it will be automatically
+            # created.
+            HD_DSC.move_patient_folder(new_folder_path,
+                                       os.path.join(input_folder_path,
+                                                    entry["Patient folder"],
+                                                    ),
+                                       entry["Patient folder"],
+                                       )
+            if journal is not None:
+                journal.set_stage(entry["Patient folder"],
+                                  "skipped",
+                                  )
+            continue
         
-        print("Execution successfully ended")
+        # Comparisons already recorded in the journal by the resumed run.
+        if journal is not None:
+            done_comparisons = (done_comparisons
+                                | journal.done_comparisons(entry["Patient folder"]))
+            if len(done_comparisons) > 0:
+                status = "partial"
+            journal.set_stage(entry["Patient folder"],
+                              "planned",
+                              )
+        cost = HD_DSC.estimate_patient_cost(entry,
+                                            config,
+                                            done_comparisons,
+                                            )
+        plan.append((index, entry, status, done_comparisons, cost))
+    
+    partial_patients = [item for item in plan if item[2] == "partial"]
+    planned_mb = sum(item[1]["Bytes"] for item in plan) / 1024**2
+    print(f"Patients to compute: {len(plan) - len(partial_patients)},",
+          f"partially computed: {len(partial_patients)},",
+          f"skipped: {len(manifest) - len(plan)}",
+          f"({planned_mb:.1f} MB to read)",
+          )
     
+    # With several workers the most expensive patients are started first, so
+    # that the largest studies do not straggle at the end of the run. A single
+    # process keeps the input order (and asks about unknown segments in that
+    # order). Rows are merged in input order anyway.
+    if workers > 1:
+        order = HD_DSC.longest_job_first([item[4] for item in plan])
+        plan = [plan[position] for position in order]
+    
+    # Progress events, with the comparisons planned for the whole run.
+    if args.events_path is None:
+        events = None
     else:
-        print(f"Excel file at {excel_path} will be overwritten if already",
-              "present, otherwise it will be created.",
-              )
+        events = telemetry.EventStream(args.events_path.replace("\\", "/"),
+                                       len(plan),
+                                       sum(len(comparisons - item[3])
+                                           for item in plan),
+                                       columns,
+                                       )
+        events.run_start()
+    
+    # Events of the patients computed by the workers are sent back through a
+    # queue and written as soon as the main process finds them.
+    if executor is not None and events is not None:
+        manager = multiprocessing.Manager()
+        event_queue = manager.Queue()
+    else:
+        manager = None
+        event_queue = None
+    
+    # Cost and elapsed time of the completed patients.
+    timings = []
+    
+    # Unknown segments not resolved in non interactive mode.
+    deferred_segments = []
+    
+    for index, entry, status, done_comparisons, cost in plan:
+        patient_folder = entry["Patient folder"]
+        patient_folder_path = os.path.join(input_folder_path,
+                                           patient_folder,
+                                           )
+        profiler = profilers.get(patient_folder)
         
-        for patient_folder in patient_folders:
-            patient_folder_path = os.path.join(input_folder_path,
-                                               patient_folder,
-                                               )
+        # Errors of a single patient (Ex. an empty folder or a missing
+        # RTSTRUCT) are reported as a failed patient, the others go on.
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            if args.read_only:
+                # Files are read where they are, CT files are passed to the
+                # study as a list instead of a folder.
+                patient_files = classification.classify_patient_files(patient_folder_path)
+                HD_DSC.exit_if_no_series(patient_folder_path,
+                                         patient_files,
+                                         )
+                ct_folder_path = patient_files["CT"]
+                rtstruct_file_path = patient_files["RTSTRUCT"][0]
+            else:
+                # Patient folder can not be empty.
+                HD_DSC.exit_if_empty(patient_folder_path)
             
-            # Patient folder can not be empty.
-            HD_DSC.exit_if_empty(patient_folder_path)
+                # RTSTRUCT and CT series should be in different folders.
+                # Creating RTSTRUCT folder if it is not already present,
+                # otherwise going on with the execution.
+                rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                                            "RTSTRUCT",
+                                                            )
             
-            # RTSTRUCT and CT series should be in different folders.
-            # Creating RTSTRUCT folder if it is not already present, otherwise
-            # going on with the execution.
-            rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                        "RTSTRUCT",
-                                                        )
+                # Creating CT folder if it is not already present, otherwise
+                # going on with the execution.
+                ct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                                      "CT",
+                                                      )
             
-            # Creating CT folder if it is not already present, otherwise
-            # going on with the execution.
-            ct_folder_path = HD_DSC.create_folder(patient_folder_path,
-                                                  "CT",
-                                                  )
+                # Filling CT and RTSTRUCT folders if both empty
+                with telemetry.profile_stage(profiler, "move"):
+                    HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
+                                                    ct_folder_path,
+                                                    rtstruct_folder_path,
+                                                    )
             
-            # Filling CT and RTSTRUCT folders if both empty
-            HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
-                                            ct_folder_path,
-                                            rtstruct_folder_path,
-                                            )
+                # If RTSTRUCT or CT folders are still empty there are no
+                # data.
+                HD_DSC.exit_if_empty(rtstruct_folder_path)
+                HD_DSC.exit_if_empty(ct_folder_path)
             
-            # If RTSTRUCT or CT folders are still empty there are no data.
-            HD_DSC.exit_if_empty(rtstruct_folder_path)
-            HD_DSC.exit_if_empty(ct_folder_path)
+                # Extracting rtstruct file path.
+                rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
             
-            # Extracting rtstruct file path.
-            rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
+            if executor is None or entry["Patient ID"] is None:
+                # Loading the patient study, CT series and RTSTRUCT are
+                # parsed only once for the whole patient analysis.
+                study = HD_DSC.PatientStudy(ct_folder_path,
+                                            rtstruct_file_path,
+                                            mask_cache_bytes,
+                                            disk_cache,
+                                            profiler,
+                                            )
                 
-            # Extraction of patient ID and frame of reference UID.
-            patient_id = HD_DSC.patient_info(rtstruct_file_path,
-                                             "PatientID",
-                                             )
-            frame_of_reference_uid = HD_DSC.patient_info(rtstruct_file_path,
-                                                         "FrameOfReferenceUID",
-                                                         )
-            
-            print(f"Starting patient {patient_id} analysis")
+                # Extraction of patient ID and of all the segments of current
+                # patient.
+                patient_id = HD_DSC.patient_info(study,
+                                                 "PatientID",
+                                                 )
+                all_segments = HD_DSC.extract_all_segments(study)
+            else:
+                # The worker process is the only one that parses the study,
+                # patient ID and segments are taken from the headers read by
+                # the scan.
+                study = None
+                patient_id = entry["Patient ID"]
+                all_segments = list(entry["ROI names"])
+        except (Exception, SystemExit):
+            if events is not None:
+                events.patient_start(patient_folder,
+                                     len(comparisons - done_comparisons),
+                                     )
+            patient_rows[index] = finish_patient(patient_folder,
+                                                 patient_folder_path,
+                                                 (None,
+                                                  traceback.format_exc(),
+                                                  time.perf_counter() - start,
+                                                  started,
+                                                  None,
+                                                  ),
+                                                 new_folder_path,
+                                                 columns,
+                                                 events=events,
+                                                 journal=journal,
+                                                 )
+            continue
         
-            # Creating the list of all segments of current patient.
-            all_segments = HD_DSC.extract_all_segments(ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       )
-            
-            # Creating manual segments list.
-            print("Creating the list of manual segments")
-            unknown_segments = HD_DSC.find_unknown_segments(all_segments,
-                                                            config,
-                                                            )
+        print(f"Starting patient {patient_id} analysis")
+        
+        if status == "partial":
+            print(f"{len(done_comparisons)} comparisons of patient",
+                  f"{patient_id} are already in the dataframe, computing",
+                  "only the missing ones",
+                  )
+        
+        # Creating manual segments list.
+        print("Creating the list of manual segments")
+        unknown_segments = HD_DSC.find_unknown_segments(all_segments,
+                                                        config,
+                                                        alias_index,
+                                                        )
+        if args.non_interactive:
+            deferred = HD_DSC.automatic_selection(unknown_segments,
+                                                  config,
+                                                  args.fuzzy_threshold,
+                                                  alias_rules,
+                                                  )
+            for segment in deferred:
+                segment["Patient folder"] = patient_folder
+            deferred_segments.extend(deferred)
+        else:
             HD_DSC.user_selection(unknown_segments,
                                   config,
                                   )
-            manual_segments = HD_DSC.extract_manual_segments(all_segments,
-                                                             config,
-                                                             )
+        
+        # Names added to the configuration must be in the lookup table.
+        if len(unknown_segments) > 0:
+            alias_index, _ = HD_DSC.build_alias_index(config)
+            if journal is not None:
+                journal.save_config(config)
+        manual_segments = HD_DSC.extract_manual_segments(all_segments,
+                                                         config,
+                                                         alias_index,
+                                                         )
+        
+        # Computing HD, DSC and SDSC for every segment in manual and MBS
+        # lists, directly or in a worker process.
+        if executor is None:
+            if events is not None:
+                events.patient_start(patient_folder,
+                                     len(comparisons - done_comparisons),
+                                     )
             
-            # Computing HD, DSC and SDSC for every segment in manual and MBS
-            # lists.
-            final_data = HD_DSC.extract_hausdorff_dice(manual_segments,
-                                                       config,
-                                                       ct_folder_path,
-                                                       rtstruct_file_path,
-                                                       final_data,
+            # Every row is committed to the store as soon as it is computed,
+            # if the patient fails the rows already stored are found as
+            # partially computed at the next run. Every row is also reported
+            # to the event stream and to the journal.
+            if store is None and events is None and journal is None:
+                on_row = None
+            else:
+                def on_row(row):
+                    if journal is not None:
+                        journal.append_rows(patient_folder,
+                                            [row],
+                                            )
+                    if store is not None:
+                        store.append_rows([row],
+                                          columns,
+                                          )
+                    if events is not None:
+                        events.comparison(patient_folder,
+                                          row,
+                                          )
+            result = compute_patient(study,
+                                     None,
+                                     manual_segments,
+                                     config,
+                                     args.crop_report,
+                                     args.threads,
+                                     mask_cache_bytes,
+                                     disk_cache,
+                                     done_comparisons,
+                                     on_row,
+                                     )
+            patient_rows[index] = finish_patient(patient_folder,
+                                                 patient_folder_path,
+                                                 result,
+                                                 new_folder_path,
+                                                 columns,
+                                                 None,
+                                                 cost,
+                                                 timings,
+                                                 profiler,
+                                                 events,
+                                                 journal,
+                                                 )
+        else:
+            # The worker profiles the patient on a new profiler, which is
+            # added to the one of the patient when it is finished.
+            if profiler is None:
+                worker_profiler = None
+            else:
+                worker_profiler = telemetry.Profiler()
+            if events is None:
+                worker_on_row = None
+                worker_on_start = None
+            else:
+                events.patient_queued(patient_folder,
+                                      len(comparisons - done_comparisons),
+                                      )
+                worker_events = telemetry.WorkerEvents(event_queue,
+                                                       patient_folder,
                                                        )
+                worker_on_row = worker_events.comparison
+                worker_on_start = worker_events.patient_start
+            future = executor.submit(compute_patient,
+                                     ct_folder_path,
+                                     rtstruct_file_path,
+                                     manual_segments,
+                                     config,
+                                     args.crop_report,
+                                     args.threads,
+                                     mask_cache_bytes,
+                                     disk_cache,
+                                     done_comparisons,
+                                     worker_on_row,
+                                     worker_profiler,
+                                     worker_on_start,
+                                     )
+            pending[future] = (index, patient_folder, patient_folder_path, cost)
             
-            # Moving patient folder to a different location, if the destination
-            # folder does not exist it will be automatically created.
-            HD_DSC.move_patient_folder(new_folder_path,
-                                       patient_folder_path,
-                                       patient_folder,
-                                       )
+            # Storing the patients already completed by the workers, after
+            # the events they sent.
+            done = [future for future in pending if future.done()]
+            if event_queue is not None:
+                events.drain(event_queue)
+            for future in done:
+                (done_index,
+                 done_folder,
+                 done_path,
+                 done_cost,
+                 ) = pending.pop(future)
+                patient_rows[done_index] = finish_patient(done_folder,
+                                                          done_path,
+                                                          future.result(),
+                                                          new_folder_path,
+                                                          columns,
+                                                          store,
+                                                          done_cost,
+                                                          timings,
+                                                          profilers.get(done_folder),
+                                                          events,
+                                                          journal,
+                                                          )
     
+    # Waiting for the patients still running in the workers. Their events
+    # are written while waiting, every tenth of a second.
+    while len(pending) > 0:
+        done, _ = wait(list(pending),
+                       timeout=None if event_queue is None else 0.1,
+                       return_when=FIRST_COMPLETED,
+                       )
+        if event_queue is not None:
+            events.drain(event_queue)
+        for future in done:
+            done_index, done_folder, done_path, done_cost = pending.pop(future)
+            patient_rows[done_index] = finish_patient(done_folder,
+                                                      done_path,
+                                                      future.result(),
+                                                      new_folder_path,
+                                                      columns,
+                                                      store,
+                                                      done_cost,
+                                                      timings,
+                                                      profilers.get(done_folder),
+                                                      events,
+                                                      journal,
+                                                      )
+    
+    if executor is not None:
+        executor.shutdown()
+    if manager is not None:
+        manager.shutdown()
+    
+    if events is not None:
+        events.close()
+    
+    failed_patients = [patient_folders[index] for index in sorted(patient_rows)
+                       if patient_rows[index] is None]
+    
+    # With a result store every row is already saved in it, the excel file
+    # is written only if asked, exporting the current data of the store
+    # (the rows of the resumed run included).
+    if store is not None:
+        if args.export_excel:
+            print("Exporting data")
+            with telemetry.profile_stage(run_profiler, "excel"):
+                store.export_excel(excel_path)
+    else:
+        # Merging the rows of every patient in input order, after the ones
+        # of the patients finished by the resumed run. With a journal the
+        # rows are read from it, so that the comparisons of a partially
+        # computed patient done by the resumed run are included too.
+        for rows in recovered_rows.values():
+            final_data.extend(rows)
+        for index in sorted(patient_rows):
+            if patient_rows[index] is None:
+                continue
+            elif journal is not None:
+                final_data.extend(journal.rows(patient_folders[index]))
+            else:
+                final_data.extend(patient_rows[index])
+        
         # Creating the dataframe
         new_data = pd.DataFrame(final_data,
-                                columns=["Patient ID",
-                                         "Frame of reference",
-                                         "Compared methods",
-                                         "Reference segment name",
-                                         "Compared segment name",
-                                         "Alias name",
-                                         "95% Hausdorff distance (mm)",
-                                         "Volumetric Dice similarity coefficient",
-                                         "Surface Dice similarity coefficient",
-                                         ],
+                                columns=columns,
                                 )
+        
+        # Concatenating old and new dataframes.
+        if join_data:
+            new_data = HD_DSC.concatenate_data(old_data,
+                                               new_data,
+                                               )
+        
         # Saving dataframe to excel.
         print("Saving data")
-        new_data.to_excel(excel_path,
-                          sheet_name="Data",
-                          index=False,
-                          )
-     
-        # Saving configuration data.
-        HD_DSC.save_config_data(config,
-                                new_config_path,
-                                )
-        
+        with telemetry.profile_stage(run_profiler, "excel"):
+            new_data.to_excel(excel_path,
+                              sheet_name="Data",
+                              index=False,
+                              )
+    
+    if store is not None:
+        store.close()
+    if journal is not None:
+        journal.close()
+    
+    # Saving configuration data.
+    HD_DSC.save_config_data(config,
+                            new_config_path,
+                            )
+    
+    # Reporting the segments left for later review.
+    if len(deferred_segments) > 0:
+        print(f"{len(deferred_segments)} unknown segments were not resolved",
+              "and have been discarded",
+              )
+    if args.deferred_report_path is not None:
+        HD_DSC.save_deferred_report(deferred_segments,
+                                    args.deferred_report_path.replace("\\", "/"),
+                                    )
+    
+    # Saving the time spent in every stage.
+    if args.profile_path is not None:
+        run_profiler.sample_rss()
+        telemetry.save_profile_report(profilers,
+                                      args.profile_path.replace("\\", "/"),
+                                      run_profiler,
+                                      )
+    
+    if len(failed_patients) == 0:
         print("Execution successfully ended")
+    else:
+        print("Execution ended, failed patients:",
+              ", ".join(failed_patients),
+              )
     
     
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
@@ -0,0 +1,491 @@
+import argparse
+import sys
+import os
+import datetime
+
+import numpy as np
+
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from rt_utils import RTStructBuilder
+
+import HD_DSC
+
+
+# SOP class of the CT images.
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+def write_ct_series(patient_folder_path,
+                    patient_id,
+                    rows,
+                    columns,
+                    slices,
+                    pixel_spacing_mm,
+                    slice_thickness_mm,
+                    ):
+    """
+    Writing a synthetic CT series, one file for each slice.
+
+    Slices are axial, equally spaced and filled with water (0 HU). Files are
+    called CT<SOPInstanceUID>.dcm, like the ones exported by the treatment
+    planning system.
+
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the folder where CT files are written (it is created if it
+        does not exist).
+    patient_id : str
+        PatientID of the series.
+    rows : int
+        Number of rows of each slice.
+    columns : int
+        Number of columns of each slice.
+    slices : int
+        Number of slices.
+    pixel_spacing_mm : float
+        In-plane pixel dimension in millimeters.
+    slice_thickness_mm : float
+        Distance between slices in millimeters.
+
+    Returns
+    -------
+    None.
+
+    """
+    os.makedirs(patient_folder_path,
+                exist_ok=True,
+                )
+    
+    # UIDs and attributes shared by all the slices.
+    study_instance_uid = generate_uid()
+    series_instance_uid = generate_uid()
+    frame_of_reference_uid = generate_uid()
+    date = datetime.datetime.now().strftime("%Y%m%d")
+    pixel_data = np.zeros((rows, columns), dtype=np.int16).tobytes()
+    
+    for index in range(slices):
+        sop_instance_uid = generate_uid()
+        
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        
+        file_path = os.path.join(patient_folder_path,
+                                 f"CT{sop_instance_uid}.dcm",
+                                 )
+        ds = FileDataset(file_path,
+                         {},
+                         file_meta=file_meta,
+                         preamble=b"\0" * 128,
+                         )
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.Modality = "CT"
+        ds.PatientName = patient_id
+        ds.PatientID = patient_id
+        ds.StudyInstanceUID = study_instance_uid
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.StudyDate = date
+        ds.StudyTime = "000000"
+        ds.StudyID = "1"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = index + 1
+        
+        # Geometry, the center of the first slice is the origin.
+        ds.ImagePositionPatient = [-columns * pixel_spacing_mm / 2,
+                                   -rows * pixel_spacing_mm / 2,
+                                   index * slice_thickness_mm,
+                                   ]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [pixel_spacing_mm, pixel_spacing_mm]
+        ds.SliceThickness = slice_thickness_mm
+        
+        # Pixel data.
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept = 0
+        ds.RescaleSlope = 1
+        ds.PixelData = pixel_data
+        
+        ds.save_as(file_path,
+                   write_like_original=False,
+                   )
+
+def ellipsoid_mask(shape,
+                   voxel_spacing_mm,
+                   center_mm,
+                   semi_axes_mm,
+                   ):
+    """
+    Creating the binary labelmap of an ellipsoid aligned with the axes.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the labelmap.
+    voxel_spacing_mm : tuple
+        Voxel dimensions in millimeters along each axis.
+    center_mm : tuple
+        Center of the ellipsoid in millimeters from the first voxel.
+    semi_axes_mm : tuple
+        Semi-axes of the ellipsoid in millimeters along each axis (equal
+        semi-axes give a sphere).
+
+    Returns
+    -------
+    labelmap : numpy.ndarray
+        3D binary array, True for the voxels whose center is inside the
+        ellipsoid.
+
+    """
+    distance = np.zeros(shape)
+    for axis, size in enumerate(shape):
+        coordinates = (np.arange(size) * voxel_spacing_mm[axis]
+                       - center_mm[axis]) / semi_axes_mm[axis]
+        view_shape = [1] * len(shape)
+        view_shape[axis] = size
+        distance = distance + coordinates.reshape(view_shape)**2
+    
+    return distance <= 1
+
+def phantom_organs(config,
+                   shape,
+                   voxel_spacing_mm,
+                   radius_mm=12,
+                   semi_axes_scale=(1, 1, 1),
+                   shift_mm=3,
+                   dl_scale=1.5,
+                   ):
+    """
+    Creating the labelmaps of the five organs of a phantom and the expected
+    metrics of every comparison.
+
+    The manual segment of each organ is an ellipsoid (a sphere by default),
+    the MBS segment is the same ellipsoid shifted along the first axis and
+    the DL segment is the manual ellipsoid scaled around its center, large
+    enough to contain the MBS segment. Organs are placed on a 3x2 grid in the
+    axial plane, in the middle slice.
+
+    Parameters
+    ----------
+    config : dict
+        Content of the configuration file, the first name of each list of
+        manual segment names, the MBS segments and the DL segments are used
+        as ROI names.
+    shape : tuple
+        Shape of the labelmaps (columns, rows, slices).
+    voxel_spacing_mm : tuple
+        Voxel dimensions in millimeters along each axis.
+    radius_mm : float
+        Radius of the manual segments, each semi-axis is radius_mm times the
+        corresponding element of semi_axes_scale.
+    semi_axes_scale : tuple
+        Ratio between each semi-axis and radius_mm.
+    shift_mm : float
+        Shift of the MBS segments along the first axis.
+    dl_scale : float
+        Ratio between the size of the DL and of the manual segments.
+
+    Returns
+    -------
+    labelmaps : dict
+        ROI name mapped to its labelmap.
+    expected : dict
+        (compared methods, alias name) mapped to the closed form
+        "Volumetric Dice similarity coefficient" and
+        "Hausdorff distance (mm)" (maximum distance, None when it has no
+        closed form).
+
+    """
+    semi_axes = np.array(semi_axes_scale, dtype=float) * radius_mm
+    if shift_mm > (dl_scale - 1) * semi_axes.min():
+        raise ValueError("The DL segments must contain the MBS segments, "
+                         "increase dl_scale or reduce shift_mm")
+    
+    # Centers on a 3x2 grid of the axial plane.
+    extent = np.array(shape) * np.array(voxel_spacing_mm)
+    grid = [(column, row) for row in [1, 3] for column in [1, 3, 5]]
+    
+    labelmaps = {}
+    expected = {}
+    for slot, list_name in enumerate(HD_DSC.MANUAL_NAME_LISTS):
+        center = np.array([extent[0] * grid[slot][0] / 6,
+                           extent[1] * grid[slot][1] / 4,
+                           extent[2] / 2,
+                           ])
+        shifted_center = center + np.array([shift_mm, 0, 0])
+        manual_name = config[list_name][0]
+        mbs_name = config["MBS segments"][slot]
+        dl_name = config["DL segments"][slot]
+        
+        labelmaps[manual_name] = ellipsoid_mask(shape,
+                                                voxel_spacing_mm,
+                                                center,
+                                                semi_axes,
+                                                )
+        labelmaps[mbs_name] = ellipsoid_mask(shape,
+                                             voxel_spacing_mm,
+                                             shifted_center,
+                                             semi_axes,
+                                             )
+        labelmaps[dl_name] = ellipsoid_mask(shape,
+                                            voxel_spacing_mm,
+                                            center,
+                                            semi_axes * dl_scale,
+                                            )
+        
+        # Two copies of a unit sphere at distance t share a lens of volume
+        # pi (4 + t) (2 - t)^2 / 12, ellipsoids shifted along an axis are
+        # scaled copies of it.
+        t = shift_mm / semi_axes[0]
+        shifted_dice = ((4 + t) * (2 - t)**2 / 12) / (4 / 3)
+        
+        # A segment contained in another one s^3 times bigger.
+        scaled_dice = 2 / (1 + dl_scale**3)
+        
+        # Distances between scaled spheres are constant along the radius.
+        if np.all(semi_axes == semi_axes[0]):
+            scaled_hausdorff = semi_axes[0] * (dl_scale - 1)
+            shifted_scaled_hausdorff = scaled_hausdorff + shift_mm
+        else:
+            scaled_hausdorff = None
+            shifted_scaled_hausdorff = None
+        
+        alias = config["Alias names"][slot]
+        expected[("Manual-MBS", alias)] = {
+            "Volumetric Dice similarity coefficient": shifted_dice,
+            "Hausdorff distance (mm)": shift_mm,
+            }
+        expected[("Manual-DL", alias)] = {
+            "Volumetric Dice similarity coefficient": scaled_dice,
+            "Hausdorff distance (mm)": scaled_hausdorff,
+            }
+        expected[("MBS-DL", alias)] = {
+            "Volumetric Dice similarity coefficient": scaled_dice,
+            "Hausdorff distance (mm)": shifted_scaled_hausdorff,
+            }
+    
+    return labelmaps, expected
+
+def create_phantom_patient(patient_folder_path,
+                           patient_id,
+                           config,
+                           rows=128,
+                           columns=128,
+                           slices=48,
+                           pixel_spacing_mm=1.0,
+                           slice_thickness_mm=2.0,
+                           **organ_options,
+                           ):
+    """
+    Writing the CT series and the RTSTRUCT of a synthetic patient.
+
+    Files are written directly in the patient folder, like the patients of
+    the patients folder, so the program moves them into the CT and RTSTRUCT
+    folders.
+
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder (it is created if it does not exist).
+    patient_id : str
+        PatientID of the phantom.
+    config : dict
+        Content of the configuration file (see phantom_organs).
+    rows : int
+        Number of rows of each slice.
+    columns : int
+        Number of columns of each slice.
+    slices : int
+        Number of slices.
+    pixel_spacing_mm : float
+        In-plane pixel dimension in millimeters.
+    slice_thickness_mm : float
+        Distance between slices in millimeters.
+    **organ_options
+        Shape options passed to phantom_organs (Ex. radius_mm=10).
+
+    Returns
+    -------
+    expected : dict
+        Closed form metrics of every comparison (see phantom_organs).
+
+    """
+    write_ct_series(patient_folder_path,
+                    patient_id,
+                    rows,
+                    columns,
+                    slices,
+                    pixel_spacing_mm,
+                    slice_thickness_mm,
+                    )
+    
+    # Labelmaps have the shape used by rt_utils (columns, rows, slices).
+    labelmaps, expected = phantom_organs(config,
+                                         (columns, rows, slices),
+                                         (pixel_spacing_mm,
+                                          pixel_spacing_mm,
+                                          slice_thickness_mm,
+                                          ),
+                                         **organ_options,
+                                         )
+    
+    rtstruct = RTStructBuilder.create_new(dicom_series_path=patient_folder_path)
+    for name, labelmap in labelmaps.items():
+        rtstruct.add_roi(mask=labelmap,
+                         name=name,
+                         )
+    
+    # Patient informations are read from the RTSTRUCT file.
+    rtstruct.ds.FrameOfReferenceUID = rtstruct.series_data[0].FrameOfReferenceUID
+    rtstruct.save(os.path.join(patient_folder_path,
+                               f"RS{rtstruct.ds.SOPInstanceUID}.dcm",
+                               ))
+    
+    return expected
+
+def create_phantom_cohort(output_folder_path,
+                          patients,
+                          config,
+                          **phantom_options,
+                          ):
+    """
+    Writing a folder of synthetic patients.
+
+    Parameters
+    ----------
+    output_folder_path : str
+        Path to the folder where patient folders are written.
+    patients : int
+        Number of patients.
+    config : dict
+        Content of the configuration file (see phantom_organs).
+    **phantom_options
+        Options passed to create_phantom_patient (Ex. slices=100).
+
+    Returns
+    -------
+    expected : dict
+        PatientID mapped to the closed form metrics of its comparisons.
+
+    """
+    expected = {}
+    for index in range(patients):
+        patient_id = f"Phantom-{index + 1:04d}"
+        print(f"Creating {patient_id}")
+        expected[patient_id] = create_phantom_patient(
+            os.path.join(output_folder_path,
+                         patient_id,
+                         ),
+            patient_id,
+            config,
+            **phantom_options,
+            )
+    
+    return expected
+
+def main(argv):
+    """
+    Writing synthetic patients to test the program at scale.
+
+    Parameters
+    ----------
+    argv : list
+        Command line arguments.
+
+    Returns
+    -------
+    None.
+
+    """
+    parser = argparse.ArgumentParser(description
+                                     = "Synthetic patients generator")
+    parser.add_argument(dest="output_folder_path",
+                        metavar="output_path",
+                        help="Path to the folder where patients are written",
+                        )
+    parser.add_argument(dest="config_path",
+                        metavar="config_path",
+                        help=("""Path to the configuration json file, ROI
+                              names are taken from it"""
+                              )
+                        )
+    parser.add_argument("-p", "--patients",
+                        dest="patients",
+                        type=int,
+                        default=1,
+                        help="Number of patients (default 1)",
+                        )
+    parser.add_argument("--rows",
+                        dest="rows",
+                        type=int,
+                        default=128,
+                        help="Number of rows of each slice (default 128)",
+                        )
+    parser.add_argument("--columns",
+                        dest="columns",
+                        type=int,
+                        default=128,
+                        help="Number of columns of each slice (default 128)",
+                        )
+    parser.add_argument("--slices",
+                        dest="slices",
+                        type=int,
+                        default=48,
+                        help="Number of slices (default 48)",
+                        )
+    parser.add_argument("--pixel-spacing",
+                        dest="pixel_spacing_mm",
+                        type=float,
+                        default=1.0,
+                        help="In-plane pixel dimension in mm (default 1)",
+                        )
+    parser.add_argument("--slice-thickness",
+                        dest="slice_thickness_mm",
+                        type=float,
+                        default=2.0,
+                        help="Distance between slices in mm (default 2)",
+                        )
+    parser.add_argument("--radius",
+                        dest="radius_mm",
+                        type=float,
+                        default=12,
+                        help="Radius of the manual segments in mm (default 12)",
+                        )
+    parser.add_argument("--shift",
+                        dest="shift_mm",
+                        type=float,
+                        default=3,
+                        help="Shift of the MBS segments in mm (default 3)",
+                        )
+    args = parser.parse_args(argv)
+    
+    config = HD_DSC.read_config(args.config_path.replace("\\", "/"))
+    create_phantom_cohort(args.output_folder_path.replace("\\", "/"),
+                          args.patients,
+                          config,
+                          rows=args.rows,
+                          columns=args.columns,
+                          slices=args.slices,
+                          pixel_spacing_mm=args.pixel_spacing_mm,
+                          slice_thickness_mm=args.slice_thickness_mm,
+                          radius_mm=args.radius_mm,
+                          shift_mm=args.shift_mm,
+                          )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
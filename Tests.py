@@ -5,6 +5,8 @@ import shutil
 import json
 import tempfile
 import math
+import sqlite3
+import queue
 
 import numpy as np
 import pandas as pd
@@ -15,6 +17,12 @@ from rt_utils import RTStructBuilder
 import surface_distance as sd
 
 import HD_DSC
+import Benchmarks
+import Phantoms
+import Main
+import classification
+import storage
+import telemetry
 
 
 def test_is_empty_with_empty_folder():
@@ -132,6 +140,29 @@ def test_spacing_and_tolerance():
     assert math.isclose(expected_spacing[2], spacing[2])
     assert math.isclose(expected_tolerance, tolerance)
     
+def test_read_ct_geometry():
+    """
+    GIVEN: the path to the folder containing a CT series
+        
+    WHEN: running the function read_ct_geometry
+        
+    THEN: the geometry matches the one of the fully read CT slices
+
+    """
+    # Path to CT series folder
+    ct_folder_path = r".\tests\test_patient\CT"
+    
+    slices = HD_DSC.read_ct_slices(ct_folder_path)
+    expected_z = [float(x.ImagePositionPatient[2]) for x in slices]
+    
+    geometry = HD_DSC.read_ct_geometry(ct_folder_path)
+    
+    assert list(geometry.z_positions) == expected_z
+    assert geometry.voxel_spacing_mm == (1.0, 1.0, 3.0)
+    assert (geometry.rows, geometry.columns) == (512, 512)
+    assert geometry.sop_instance_uids[0] == slices[0].SOPInstanceUID
+    assert geometry.consistent_slice_gaps
+    
 def test_extract_all_segment_with_patient_ref002():
     """
     GIVEN: a CT series and its RTSTRUCT file
@@ -169,6 +200,226 @@ def test_extract_all_segment_with_patient_ref002():
                                            )
     assert expected == observed
     
+def test_patient_study_with_patient_ref002():
+    """
+    GIVEN: a CT series and its RTSTRUCT file
+        
+    WHEN: loading them in a PatientStudy
+        
+    THEN: patient informations, segments names, voxel spacing and labelmaps
+          are the same obtained from the paths
+
+    """
+    # Path to CT series folder and RTSTRUCT file
+    ct_folder_path = r".\tests\test_patient\CT"
+    rtstruct_file_path = r".\tests\test_patient\RTSTRUCT\RS_002.dcm"
+    
+    study = HD_DSC.PatientStudy(ct_folder_path,
+                                rtstruct_file_path,
+                                )
+    
+    assert study.patient_id == "Pelvic-Ref-002"
+    assert study.roi_names == HD_DSC.extract_all_segments(ct_folder_path,
+                                                          rtstruct_file_path,
+                                                          )
+    assert (HD_DSC.spacing_and_tolerance(study)
+            == HD_DSC.spacing_and_tolerance(ct_folder_path))
+    
+    expected = HD_DSC.create_labelmap(ct_folder_path,
+                                      rtstruct_file_path,
+                                      "Vescica",
+                                      )
+    observed = HD_DSC.create_labelmap(study,
+                                      None,
+                                      "Vescica",
+                                      )
+    assert np.array_equal(expected, observed)
+    
+def test_compact_mask():
+    """
+    GIVEN: the labelmap of a segment
+        
+    WHEN: converting it to a CompactMask
+        
+    THEN: the mask is much smaller, it is expanded back to the same labelmap
+          and its crops are the crops of the labelmap
+
+    """
+    labelmap = HD_DSC.create_labelmap(r".\tests\test_patient\CT",
+                                      r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                      "Vescica",
+                                      )
+    
+    mask = HD_DSC.CompactMask.from_dense(labelmap)
+    index = (slice(200, 300), slice(0, 512), slice(40, 60))
+    empty_mask = HD_DSC.CompactMask.from_dense(np.zeros((4, 4, 4), dtype=bool))
+    
+    assert mask.nbytes * 100 < labelmap.nbytes
+    assert mask.bounding_box() == HD_DSC.bounding_box(labelmap)
+    assert np.array_equal(mask.to_dense(), labelmap)
+    assert np.array_equal(mask.crop(index), labelmap[index])
+    assert empty_mask.bounding_box() == (None, None)
+    assert not empty_mask.to_dense().any()
+    
+def test_rasterize_roi_equals_rt_utils():
+    """
+    GIVEN: the RTSTRUCT and the CT geometry of the test patient
+        
+    WHEN: rasterizing every segment with rasterize_roi
+        
+    THEN: every labelmap is identical to the one created by rt_utils
+
+    """
+    ct_folder_path = r".\tests\test_patient\CT"
+    rtstruct_file_path = r".\tests\test_patient\RTSTRUCT\RS_002.dcm"
+    rtstruct = RTStructBuilder.create_from(ct_folder_path,
+                                           rtstruct_file_path,
+                                           )
+    study = HD_DSC.PatientStudy(ct_folder_path,
+                                rtstruct_file_path,
+                                )
+    
+    for name in study.roi_names:
+        expected = rtstruct.get_roi_mask_by_name(name)
+        observed = HD_DSC.rasterize_roi(study.rtstruct_dataset,
+                                        study.roi_number(name),
+                                        study.geometry,
+                                        )
+        
+        assert observed.shape == expected.shape
+        assert np.array_equal(observed.to_dense(), expected)
+    
+def test_mask_cache_eviction():
+    """
+    GIVEN: a mask cache that can store only two labelmaps
+        
+    WHEN: storing three labelmaps and reading the first one in between
+        
+    THEN: the least recently used labelmap is discarded
+
+    """
+    labelmap = np.zeros((10, 10, 10), dtype=bool)
+    cache = HD_DSC.MaskCache(max_bytes=2 * labelmap.nbytes)
+    
+    cache.put("Prostate", labelmap)
+    cache.put("Rectum", labelmap.copy())
+    cache.get("Prostate")
+    cache.put("Bladder", labelmap.copy())
+    
+    assert "Prostate" in cache
+    assert "Rectum" not in cache
+    assert "Bladder" in cache
+    assert cache.current_bytes == 2 * labelmap.nbytes
+    
+def test_patient_study_builds_each_mask_once():
+    """
+    GIVEN: a patient study
+        
+    WHEN: running extract_hausdorff_dice
+        
+    THEN: every segment is rasterized only once
+
+    """
+    # List of manual segments names
+    manual_seg = ["Prostata",
+                  "Retto",
+                  "Vescica",
+                  "FemoreSinistro",
+                  "FemoreDestro",
+                  ]
+    
+    # Loading configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    HD_DSC.extract_hausdorff_dice(manual_seg,
+                                  config,
+                                  study,
+                                  )
+    
+    assert study.masks_built == 15
+    
+def test_disk_mask_cache():
+    """
+    GIVEN: a patient study with a persistent mask cache
+        
+    WHEN: creating the same labelmap in two different studies
+        
+    THEN: the second study loads the labelmap from disk without rasterizing
+          it and the two labelmaps are equal
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    disk_cache = HD_DSC.DiskMaskCache(temp_folder.name)
+    
+    # Path to CT series folder and RTSTRUCT file
+    ct_folder_path = r".\tests\test_patient\CT"
+    rtstruct_file_path = r".\tests\test_patient\RTSTRUCT\RS_002.dcm"
+    
+    first_study = HD_DSC.PatientStudy(ct_folder_path,
+                                      rtstruct_file_path,
+                                      disk_cache=disk_cache,
+                                      )
+    expected = first_study.get_mask("Vescica")
+    
+    second_study = HD_DSC.PatientStudy(ct_folder_path,
+                                       rtstruct_file_path,
+                                       disk_cache=disk_cache,
+                                       )
+    observed = second_study.get_mask("Vescica")
+    
+    assert first_study.masks_built == 1
+    assert second_study.masks_built == 0
+    assert np.array_equal(expected.to_dense(), observed.to_dense())
+    assert len(os.listdir(temp_folder.name)) == 1
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_disk_mask_cache_eviction():
+    """
+    GIVEN: a persistent mask cache that can hold only one labelmap
+        
+    WHEN: saving the same labelmap twice with different ROI numbers
+        
+    THEN: the running size of the cache is the size of its files and the
+          least recently used labelmap is deleted
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    bladder = study.get_mask("Vescica")
+    
+    disk_cache = HD_DSC.DiskMaskCache(temp_folder.name)
+    disk_cache.save("1.2.3", 1, study.geometry, bladder)
+    bladder_bytes = disk_cache.total_bytes
+    assert bladder_bytes == sum(size for _, size, _ in disk_cache.entries())
+    
+    # A new cache reads the size of the files already saved
+    disk_cache = HD_DSC.DiskMaskCache(temp_folder.name,
+                                      max_bytes=bladder_bytes,
+                                      )
+    assert disk_cache.total_bytes == bladder_bytes
+    
+    os.utime(disk_cache.file_path("1.2.3", 1, study.geometry),
+             (0, 0),
+             )
+    disk_cache.save("1.2.3", 2, study.geometry, bladder)
+    
+    assert disk_cache.load("1.2.3", 1, study.geometry) is None
+    assert disk_cache.load("1.2.3", 2, study.geometry) is not None
+    assert disk_cache.total_bytes == sum(size for _, size, _ in disk_cache.entries())
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
 def test_find_unknown_segments_with_example_list():
     """
     GIVEN: a list of segments names and the configuration file path
@@ -201,6 +452,119 @@ def test_find_unknown_segments_with_example_list():
     
     assert expected == observed
     
+def test_build_alias_index():
+    """
+    GIVEN: the configuration file with a name also added to a second list
+        
+    WHEN: building the alias index
+        
+    THEN: names are found regardless of case and whitespace, each with its
+          list and slot, and the duplicated name is reported as a conflict
+
+    """
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Rectum names"].append("CTV")
+    
+    alias_index, conflicts = HD_DSC.build_alias_index(config)
+    
+    assert alias_index[HD_DSC.normalize_name(" FemoreSINISTRO ")] == ("Left femur names", 3)
+    assert alias_index["prostate_mbs"] == ("MBS segments", None)
+    assert alias_index["external"] == ("External names", None)
+    assert alias_index["ctv"] == ("Prostate names", 0)
+    assert conflicts == [("ctv", "Prostate names", "Rectum names")]
+    
+def test_extract_manual_segments_with_alias_index():
+    """
+    GIVEN: segment names differing from the configuration only by case and
+           whitespace
+        
+    WHEN: running find_unknown_segments and extract_manual_segments with the
+          alias index
+        
+    THEN: no segment is unknown and the manual segments keep the patient names
+
+    """
+    config = HD_DSC.read_config(r".\tests\config.json")
+    alias_index, _ = HD_DSC.build_alias_index(config)
+    all_segments = ["PROSTATA",
+                    "retto",
+                    "Vescica ",
+                    "femoresinistro",
+                    "Femore Dx",
+                    "Bladder_MBS",
+                    ]
+    
+    unknown_segments = HD_DSC.find_unknown_segments(all_segments,
+                                                    config,
+                                                    alias_index,
+                                                    )
+    manual_segments = HD_DSC.extract_manual_segments(all_segments,
+                                                     config,
+                                                     alias_index,
+                                                     )
+    
+    assert unknown_segments == ["Femore Dx"]
+    assert manual_segments == ["PROSTATA",
+                               "retto",
+                               "Vescica ",
+                               "femoresinistro",
+                               0,
+                               ]
+    
+def test_automatic_selection():
+    """
+    GIVEN: unknown segments matched by a rule, close to a known name and
+           unrelated to every known name
+        
+    WHEN: running the function automatic_selection
+        
+    THEN: the first two are added to the right lists of the configuration
+          file and the last one is deferred
+
+    """
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Alias rules"] = {"Right femur names": ["^femore.*dx$"]}
+    unknown_segments = ["Femore_DX",
+                        "Vesciica",
+                        "Midollo",
+                        ]
+    
+    deferred = HD_DSC.automatic_selection(unknown_segments,
+                                          config,
+                                          )
+    
+    assert "Femore_DX" in config["Right femur names"]
+    assert "Vesciica" in config["Bladder names"]
+    assert [segment["Segment name"] for segment in deferred] == ["Midollo"]
+    assert deferred[0]["Score"] < HD_DSC.DEFAULT_FUZZY_THRESHOLD
+    assert all("Midollo" not in config[list_name]
+               for list_name in HD_DSC.MANUAL_NAME_LISTS)
+    
+def test_compile_alias_rules_with_invalid_rule():
+    """
+    GIVEN: a configuration file with an alias rule that is not a valid
+           regular expression
+        
+    WHEN: running the function compile_alias_rules
+        
+    THEN: the execution is stopped with a message naming the invalid rule,
+          while valid rules are compiled
+
+    """
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Alias rules"] = {"Right femur names": ["^femore.*dx$"]}
+    
+    alias_rules = HD_DSC.compile_alias_rules(config)
+    assert [rule[:2] for rule in alias_rules] == [("Right femur names",
+                                                   "^femore.*dx$",
+                                                   )]
+    
+    config["Alias rules"]["Prostate names"] = ["^prost(ata"]
+    with pytest.raises(SystemExit) as exit_info:
+        HD_DSC.compile_alias_rules(config)
+    assert "^prost(ata" in str(exit_info.value)
+    assert "Prostate names" in str(exit_info.value)
+    
 def test_extract_manual_segments_with_example_list():
     """
     GIVEN: a list of segments names and the configuration file path
@@ -281,6 +645,145 @@ def test_compute_metrics():
                         hd,
                         )
     
+def test_crop_to_bounding_box():
+    """
+    GIVEN: two labelmaps with small segments in a large volume
+        
+    WHEN: running the function crop_to_bounding_box
+        
+    THEN: the cropped labelmaps contain both segments plus the margin and
+          the metrics computed on them are identical
+
+    """
+    reference = np.zeros((60, 50, 40), dtype=bool)
+    compared = np.zeros((60, 50, 40), dtype=bool)
+    reference[10:20, 12:18, 5:9] = True
+    compared[14:25, 10:16, 0:7] = True
+    
+    crop_ref, crop_comp = HD_DSC.crop_to_bounding_box(reference,
+                                                      compared,
+                                                      margin=1,
+                                                      )
+    
+    assert crop_ref.shape == (17, 10, 10)
+    assert crop_ref.sum() == reference.sum()
+    assert crop_comp.sum() == compared.sum()
+    
+    # Path to CT series folder
+    ct_folder_path = r".\tests\test_patient\CT"
+    
+    expected = HD_DSC.compute_metrics(reference,
+                                      compared,
+                                      ct_folder_path,
+                                      crop=False,
+                                      )
+    observed = HD_DSC.compute_metrics(reference,
+                                      compared,
+                                      ct_folder_path,
+                                      crop=True,
+                                      )
+    assert expected == observed
+    
+def test_compute_all_metrics():
+    """
+    GIVEN: The CT series geometry and the labelmaps of two segments
+        
+    WHEN: running the function compute_all_metrics
+        
+    THEN: obtain the same metrics of compute_metrics plus the maximum
+          Hausdorff distance, the mean surface distance and the surface
+          Dice similarity coefficient at every tolerance
+
+    """
+    # Loading patient study
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    ref_labelmap = study.get_mask("Vescica")
+    comp_labelmap = study.get_mask("Bladder_MBS")
+    
+    metrics = HD_DSC.compute_all_metrics(ref_labelmap,
+                                         comp_labelmap,
+                                         study.geometry,
+                                         tolerances_mm=[1.0, 3.0],
+                                         )
+    
+    assert math.isclose(metrics.surface_dice[3.0], 0.9049208597597801)
+    assert math.isclose(metrics.volume_dice, 0.8680934291194945)
+    assert math.isclose(metrics.hausdorff_95_mm, 4.242640687119285)
+    assert metrics.surface_dice[1.0] < metrics.surface_dice[3.0]
+    assert metrics.hausdorff_max_mm >= metrics.hausdorff_95_mm
+    assert 0 < metrics.mean_surface_distance_mm < metrics.hausdorff_95_mm
+    
+def test_share_masks():
+    """
+    GIVEN: the compact masks of an empty segment and of a cube
+
+    WHEN: copying them to shared memory and attaching them again
+
+    THEN: the attached masks have the same voxels of the original ones
+
+    """
+    labelmap = np.zeros((10, 12, 14),
+                        dtype=bool,
+                        )
+    empty_mask = HD_DSC.CompactMask.from_dense(labelmap)
+    labelmap[2:5, 3:9, 4:6] = True
+    cube_mask = HD_DSC.CompactMask.from_dense(labelmap)
+    
+    shared_memory, layout = HD_DSC.share_masks({"Empty": empty_mask,
+                                                "Cube": cube_mask,
+                                                })
+    HD_DSC.attach_shared_masks(shared_memory.name,
+                               layout,
+                               )
+    masks = HD_DSC.SHARED_MASKS["Masks"]
+    
+    assert not masks["Empty"].to_dense().any()
+    assert np.array_equal(masks["Cube"].to_dense(), labelmap)
+    
+    # Views of the shared memory must be released before closing it
+    HD_DSC.SHARED_MASKS["Masks"] = {}
+    del masks
+    HD_DSC.SHARED_MASKS["Memory"].close()
+    shared_memory.close()
+    shared_memory.unlink()
+    
+def test_compute_pairs_metrics():
+    """
+    GIVEN: the patient study and two pairs of segments
+
+    WHEN: running the function compute_pairs_metrics with two processes
+
+    THEN: the metrics of every pair are yielded one at a time, in order,
+          and are equal to the ones of compute_all_metrics
+
+    """
+    # Loading patient study
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    reference_names = ["Vescica", "Retto"]
+    compared_names = ["Bladder_MBS", "Rectum_MBS"]
+    
+    pairs_metrics = HD_DSC.compute_pairs_metrics(study,
+                                                 reference_names,
+                                                 compared_names,
+                                                 2,
+                                                 )
+    first_metrics = next(pairs_metrics)
+    
+    assert first_metrics == HD_DSC.compute_all_metrics(study.get_mask("Vescica"),
+                                                       study.get_mask("Bladder_MBS"),
+                                                       study.geometry,
+                                                       )
+    assert list(pairs_metrics) == [
+        HD_DSC.compute_all_metrics(study.get_mask("Retto"),
+                                   study.get_mask("Rectum_MBS"),
+                                   study.geometry,
+                                   ),
+        ]
+    
 def test_store_patients():
     """
     GIVEN: the path of a directory containing one patient folder and some
@@ -521,6 +1024,152 @@ def test_extract_hausdorff_dice():
     assert math.isclose(expected_5_6, observed[5][6])
     assert expected_13_2 == observed[13][2]
     
+def test_result_columns_with_extra_metrics():
+    """
+    GIVEN: a configuration with Hausdorff percentiles and surface Dice
+           tolerances
+        
+    WHEN: running the function result_columns
+        
+    THEN: a column is added for every percentile different from 95 and for
+          every tolerance, before the study columns
+
+    """
+    # Loading configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Hausdorff percentiles"] = [95, 100]
+    config["Surface Dice tolerances (mm)"] = [1, 2.5]
+    
+    expected = HD_DSC.DATA_COLUMNS + ["100% Hausdorff distance (mm)",
+                                      "Surface Dice similarity coefficient at 1 mm",
+                                      "Surface Dice similarity coefficient at 2.5 mm",
+                                      ] + HD_DSC.STUDY_COLUMNS
+    observed = HD_DSC.result_columns(config)
+    
+    assert expected == observed
+    
+def test_extract_hausdorff_dice_with_extra_metrics():
+    """
+    GIVEN: a configuration with Hausdorff percentiles and surface Dice
+           tolerances
+        
+    WHEN: running the function extract_hausdorff_dice
+        
+    THEN: every row has a value for each column, the 100 percentile is not
+          lower than the 95 percentile and surface Dice grows with the
+          tolerance
+
+    """
+    # List of manual segments names
+    manual_seg = ["Prostata",
+                  "Retto",
+                  "Vescica",
+                  "FemoreSinistro",
+                  "FemoreDestro",
+                  ]
+    
+    # Loading configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Hausdorff percentiles"] = [100]
+    config["Surface Dice tolerances (mm)"] = [1, 2]
+    
+    observed = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             r".\tests\test_patient\CT",
+                                             r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                             )
+    
+    assert all(len(row) == 14 for row in observed)
+    assert math.isclose(observed[5][6], 9)
+    assert all(row[9] >= row[6] for row in observed)
+    assert all(row[10] <= row[11] <= row[8] for row in observed)
+    
+def test_iter_hausdorff_dice():
+    """
+    GIVEN: the list of manual segments and the configuration file, with one
+           comparison already computed
+        
+    WHEN: iterating over iter_hausdorff_dice
+        
+    THEN: a typed result is yielded for every other comparison and its rows
+          are the ones of extract_hausdorff_dice
+
+    """
+    # List of manual segments names
+    manual_seg = ["Prostata",
+                  "Retto",
+                  "Vescica",
+                  "FemoreSinistro",
+                  "FemoreDestro",
+                  ]
+    
+    # Loading configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    skip = {("Manual-MBS", "Prostate")}
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    
+    results = HD_DSC.iter_hausdorff_dice(manual_seg,
+                                         config,
+                                         study,
+                                         skip_comparisons=skip,
+                                         )
+    first = next(results)
+    observed = [first] + list(results)
+    expected = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             study,
+                                             skip_comparisons=skip,
+                                             )
+    
+    assert isinstance(first, HD_DSC.ComparisonResult)
+    assert (first.compared_methods, first.alias_name) == ("Manual-MBS", "Rectum")
+    assert len(observed) == len(HD_DSC.expected_comparisons(config)) - 1
+    assert [result.to_row() for result in observed] == expected
+    assert all(len(result.to_row()) == len(HD_DSC.result_columns(config))
+               for result in observed)
+    
+def test_extract_hausdorff_dice_with_threads():
+    """
+    GIVEN: the list of manual segments, the configuration file and the
+           patient study
+        
+    WHEN: running the function extract_hausdorff_dice with more than one
+          thread
+        
+    THEN: return the same data obtained with a single thread
+
+    """
+    # List of manual segments names
+    manual_seg = ["Prostata",
+                  "Retto",
+                  "Vescica",
+                  "FemoreSinistro",
+                  "FemoreDestro",
+                  ]
+    
+    # Loading configuration file
+    config_path = r".\tests\config.json"
+    config = HD_DSC.read_config(config_path)
+    
+    # Loading patient study
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    
+    expected = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             study,
+                                             )
+    observed = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             study,
+                                             threads=4,
+                                             )
+    
+    assert expected == observed
+    
 def test_load_existing_dataframe():
     """
     GIVEN: the path to an existing excel file
@@ -559,7 +1208,7 @@ def test_load_existing_dataframe_with_no_excel():
     observed = HD_DSC.load_existing_dataframe(excel_path)
     
     assert expected.equals(observed)
-        
+    
 def test_concatenate_data():
     """
     GIVEN: two pandas dataframes
@@ -590,39 +1239,298 @@ def test_concatenate_data():
     
     assert expected.equals(observed)
     
-def test_check_study():
+def test_result_store():
+    """
+    GIVEN: an empty result store
+        
+    WHEN: appending the rows of two runs, the second one with an additional
+          column
+        
+    THEN: all the rows are loaded, the missing values of the first run are
+          empty, the rows of a single run can be loaded and the study keys
+          are loaded without the other columns
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    store_path = os.path.join(temp_folder.name,
+                              "results.sqlite",
+                              )
+    
+    first_store = storage.ResultStore(store_path,
+                                      run_id="first",
+                                      )
+    first_store.append_rows([["Pelvic-Ref-002", 8]],
+                            ["Patient ID", "Frame of reference"],
+                            )
+    first_store.close()
+    
+    second_store = storage.ResultStore(store_path,
+                                       run_id="second",
+                                       )
+    second_store.append_rows([["Pelvic-Ref-003", 5, 0.9]],
+                             ["Patient ID", "Frame of reference", "Dice"],
+                             )
+    
+    observed = second_store.load_dataframe()
+    assert list(observed.columns) == ["Patient ID", "Frame of reference", "Dice"]
+    assert list(observed["Patient ID"]) == ["Pelvic-Ref-002", "Pelvic-Ref-003"]
+    assert math.isnan(observed["Dice"][0])
+    
+    observed = second_store.load_dataframe(run_id="second")
+    assert list(observed["Patient ID"]) == ["Pelvic-Ref-003"]
+    
+    observed = second_store.load_study_keys()
+    assert list(observed.columns) == ["Frame of reference"]
+    assert sorted(observed["Frame of reference"]) == [5, 8]
+    
+    second_store.close()
+    temp_folder.cleanup()
+    
+def test_result_store_run_ids():
+    """
+    GIVEN: a result store database
+
+    WHEN: opening it twice in a row and starting a run each time
+
+    THEN: the two runs have different identifiers, while a run can not be
+          started twice with the same identifier
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    store_path = os.path.join(temp_folder.name,
+                              "results.sqlite",
+                              )
+    
+    first_store = storage.ResultStore(store_path)
+    first_store.start_run(False)
+    second_store = storage.ResultStore(store_path)
+    second_store.start_run(True)
+    
+    assert first_store.run_id != second_store.run_id
+    assert second_store.current_runs() == [first_store.run_id,
+                                           second_store.run_id,
+                                           ]
+    with pytest.raises(sqlite3.IntegrityError):
+        second_store.start_run(True)
+    
+    first_store.close()
+    second_store.close()
+    temp_folder.cleanup()
+    
+def test_result_store_with_and_without_join():
+    """
+    GIVEN: a synthetic patient analysed once without result store
+
+    WHEN: running the program with a result store, first joining the excel
+          data, then twice without joining and finally joining again
+
+    THEN: the store is filled with the excel data, every excel file
+          contains every comparison only once and the excel file is not
+          written without --export-excel
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    input_folder_path = os.path.join(temp_folder.name,
+                                     "patients",
+                                     )
+    config_path = os.path.join(temp_folder.name,
+                               "config.json",
+                               )
+    excel_path = os.path.join(temp_folder.name,
+                              "data.xlsx",
+                              )
+    store_path = os.path.join(temp_folder.name,
+                              "results.sqlite",
+                              )
+    config = HD_DSC.read_config(r".\tests\config.json")
+    HD_DSC.save_config_data(config,
+                            config_path,
+                            )
+    Phantoms.create_phantom_cohort(input_folder_path,
+                                   1,
+                                   config,
+                                   rows=48,
+                                   columns=48,
+                                   slices=16,
+                                   radius_mm=6,
+                                   )
+    arguments = [input_folder_path,
+                 config_path,
+                 config_path,
+                 excel_path,
+                 "--non-interactive",
+                 ]
+    
+    Main.main(arguments)
+    comparisons = len(HD_DSC.load_existing_dataframe(excel_path))
+    
+    for extra_arguments in [["-s", store_path, "-j", "True"],
+                            ["-s", store_path],
+                            ["-s", store_path],
+                            ["-s", store_path, "-j", "True"],
+                            ]:
+        Main.main(arguments + extra_arguments + ["--export-excel"])
+        data = HD_DSC.load_existing_dataframe(excel_path)
+        
+        assert len(data) == comparisons
+        assert not data.duplicated(subset=storage.ResultStore.KEY_COLUMNS).any()
+    
+    os.remove(excel_path)
+    Main.main(arguments + ["-s", store_path, "-j", "True"])
+    assert not os.path.exists(excel_path)
+    
+    temp_folder.cleanup()
+    
+def test_study_index_with_old_excel_file():
     """
-    GIVEN: A dataframe, a frame of reference uid in the dataframe, a frame of
-           reference uid not in the dataframe and the patient id
+    GIVEN: A dataframe saved before the RTSTRUCT and configuration columns
+           were introduced, a frame of reference uid in the dataframe and a
+           frame of reference uid not in the dataframe
         
-    WHEN: running the function check_study
+    WHEN: asking the study index the status of each study
         
-    THEN: it is returned True for the frame of reference uid that is in the
-          dataframe, while it is returned False for the frame of reference
-          uid not in the dataframe
+    THEN: the study whose frame of reference uid is in the dataframe is
+          skipped, while the other one is computed
 
     """
     # Path to existing excel file
     excel_path = r".\tests\test_dataframe.xlsx"
     
     old_data = HD_DSC.load_existing_dataframe(excel_path)
+    config = HD_DSC.read_config(r".\tests\config.json")
+    comparisons = HD_DSC.expected_comparisons(config)
+    digest = HD_DSC.config_hash(config)
     correct_frame_of_reference = 8
     wrong_frame_of_reference = 55
-    patient_id = "Pelvic-Ref-002"
     
-    correct_expected = True
-    correct_observed = HD_DSC.check_study(old_data,
-                                          correct_frame_of_reference,
-                                          patient_id,
+    study_index = HD_DSC.StudyIndex(old_data)
+    correct_observed = study_index.status(correct_frame_of_reference,
+                                          "RS1",
+                                          digest,
+                                          comparisons,
                                           )
-    wrong_expected = False
-    wrong_observed = HD_DSC.check_study(old_data,
-                                        wrong_frame_of_reference,
-                                        patient_id,
+    wrong_observed = study_index.status(wrong_frame_of_reference,
+                                        "RS1",
+                                        digest,
+                                        comparisons,
                                         )
     
-    assert correct_expected == correct_observed
-    assert wrong_expected == wrong_observed
+    assert correct_observed[0] == "skip"
+    assert wrong_observed[0] == "compute"
+    
+def test_study_index():
+    """
+    GIVEN: a dataframe with all the comparisons of a study, some comparisons
+           of a second study and a row without RTSTRUCT and configuration
+        
+    WHEN: asking the study index the status of each study
+        
+    THEN: the first study is skipped, the second one is partially computed,
+          the old row study is skipped and an unknown study is computed
+
+    """
+    # Loading configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    comparisons = HD_DSC.expected_comparisons(config)
+    digest = HD_DSC.config_hash(config)
+    
+    rows = [["1.1", "RS1", digest, methods, alias]
+            for methods, alias in sorted(comparisons)]
+    rows += [["2.2", "RS2", digest, "Manual-MBS", "Prostate"]]
+    rows += [["3.3", None, None, "Manual-MBS", "Prostate"]]
+    old_data = pd.DataFrame(rows,
+                            columns=["Frame of reference",
+                                     "RTSTRUCT SOP instance UID",
+                                     "Configuration hash",
+                                     "Compared methods",
+                                     "Alias name",
+                                     ],
+                            )
+    
+    study_index = HD_DSC.StudyIndex(old_data)
+    
+    assert study_index.status("1.1", "RS1", digest, comparisons)[0] == "skip"
+    assert study_index.status("1.1", "RS9", digest, comparisons)[0] == "compute"
+    assert study_index.status("1.1", "RS1", "other", comparisons)[0] == "compute"
+    status, done = study_index.status("2.2", "RS2", digest, comparisons)
+    assert status == "partial"
+    assert done == {("Manual-MBS", "Prostate")}
+    assert study_index.status("3.3", "RS3", digest, comparisons)[0] == "skip"
+    assert study_index.status("4.4", "RS4", digest, comparisons)[0] == "compute"
+    
+def test_scan_patient():
+    """
+    GIVEN: the test patient with CT and RTSTRUCT folders
+        
+    WHEN: scanning the patient headers
+        
+    THEN: the manifest entry has the same information of the full study and
+          nothing is created in the patient folder
+
+    """
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                )
+    
+    manifest = HD_DSC.scan_patients(r".\tests",
+                                    ["test_patient"],
+                                    )
+    entry = manifest[0]
+    
+    assert len(manifest) == 1
+    assert entry["Patient folder"] == "test_patient"
+    assert entry["Patient ID"] == study.patient_id
+    assert entry["Frame of reference"] == study.frame_of_reference_uid
+    assert entry["RTSTRUCT SOP instance UID"] == study.rtstruct_dataset.SOPInstanceUID
+    assert entry["ROI names"] == study.roi_names
+    assert entry["Slices"] == len(study.geometry.z_positions)
+    assert entry["Rows"] == study.geometry.rows
+    assert entry["Columns"] == study.geometry.columns
+    assert entry["Bytes"] > 0
+    assert sorted(os.listdir(r".\tests\test_patient")) == ["CT", "RTSTRUCT"]
+    
+def test_estimate_patient_cost():
+    """
+    GIVEN: the manifest entry of the test patient
+        
+    WHEN: estimating its cost with and without some comparisons already done
+        
+    THEN: the cost is the number of voxels times the comparisons to compute
+
+    """
+    config = HD_DSC.read_config(r".\tests\config.json")
+    comparisons = HD_DSC.expected_comparisons(config)
+    entry = HD_DSC.scan_patient(r".\tests",
+                                "test_patient",
+                                )
+    voxels = entry["Slices"] * entry["Rows"] * entry["Columns"]
+    
+    cost = HD_DSC.estimate_patient_cost(entry,
+                                        config,
+                                        )
+    partial_cost = HD_DSC.estimate_patient_cost(entry,
+                                                config,
+                                                {("Manual-MBS", "Prostate")},
+                                                )
+    
+    assert cost == voxels * len(comparisons)
+    assert partial_cost == voxels * (len(comparisons) - 1)
+    
+def test_longest_job_first():
+    """
+    GIVEN: a list of job costs with two equal costs
+        
+    WHEN: ordering the jobs with longest_job_first
+        
+    THEN: jobs are ordered by decreasing cost, equal ones in input order
+
+    """
+    order = HD_DSC.longest_job_first([3, 10, 1, 10, 5])
+    
+    assert order == [1, 3, 4, 0, 2]
     
 def test_exit_if_empty():
     """
@@ -638,7 +1546,7 @@ def test_exit_if_empty():
     
     with pytest.raises(SystemExit):
         HD_DSC.exit_if_empty(temp_empty_folder.name)
-        
+    
 def test_exit_if_no_patients():
     """
     GIVEN: an empty patients list
@@ -657,4 +1565,657 @@ def test_exit_if_no_patients():
     with pytest.raises(SystemExit):
         HD_DSC.exit_if_no_patients(temp_empty_folder.name,
                                    patient_folders,
-                                   )
\ No newline at end of file
+                                   )
+    
+def test_run_benchmark():
+    """
+    GIVEN: a function returning additional values
+        
+    WHEN: running the function run_benchmark
+        
+    THEN: every run is timed, the peak memory is measured and the additional
+          values are saved with the results
+
+    """
+    calls = []
+    
+    def function():
+        calls.append(np.ones(1024**2, dtype=np.uint8))
+        return {"comparisons": 15}
+    
+    result = Benchmarks.run_benchmark(function,
+                                      repeat=2,
+                                      )
+    
+    assert len(calls) == 3
+    assert len(result["seconds"]) == 2
+    assert result["best_s"] == min(result["seconds"])
+    assert result["peak_memory_mb"] >= 1
+    assert result["comparisons"] == 15
+    
+def test_profiler():
+    """
+    GIVEN: a patient study profiled with a Profiler
+
+    WHEN: creating two labelmaps and saving the profiling report
+
+    THEN: header reading and rasterization are timed, bytes read and masks
+          built are counted and the report contains the patient and the
+          total of the run
+
+    """
+    profiler = telemetry.Profiler()
+    study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                profiler=profiler,
+                                )
+    study.get_mask("Vescica")
+    study.get_mask("Retto")
+    
+    assert profiler.seconds["header read"] > 0
+    assert profiler.seconds["rasterize"] > 0
+    assert profiler.counters["masks built"] == 2
+    assert profiler.counters["bytes read"] > 0
+    
+    # Headers read to classify the files are counted too
+    scan_profiler = telemetry.Profiler()
+    classification.classify_patient_files(r".\tests\test_patient",
+                                          cache=None,
+                                          profiler=scan_profiler,
+                                          )
+    assert scan_profiler.counters["bytes read"] > 0
+    
+    # Memory is sampled only while tracked, where it can be measured
+    memory_profiler = telemetry.Profiler()
+    assert memory_profiler.report()["Peak RSS (MB)"] is None
+    with memory_profiler.track_rss():
+        labelmap = np.ones((16, 512, 512), dtype=np.uint8)
+    if telemetry.current_rss_mb() is not None:
+        assert memory_profiler.report()["Peak RSS (MB)"] > 0
+        assert memory_profiler.report()["RSS increase (MB)"] >= 0
+    
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    profile_path = os.path.join(temp_folder.name,
+                                "profile.json",
+                                )
+    report = telemetry.save_profile_report({"test_patient": profiler},
+                                           profile_path,
+                                           )
+    
+    with open(profile_path) as infile:
+        assert json.load(infile) == report
+    assert report["patients"][0]["Patient folder"] == "test_patient"
+    assert report["total"]["masks built"] == 2
+    assert report["total"]["scan (s)"] == 0
+    
+    temp_folder.cleanup()
+    
+def test_event_stream():
+    """
+    GIVEN: a run of two patients with three planned comparisons each
+
+    WHEN: the first patient computes one comparison and finishes, while
+          the second one is queued to a worker, which sends its start and
+          one comparison through a queue before failing
+
+    THEN: one json line is written for every event, the events of the
+          worker are written when the queue is drained and the comparisons
+          that were not computed are removed from the ones left
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    events_path = os.path.join(temp_folder.name,
+                               "events.jsonl",
+                               )
+    row = ["ID", "FoR", "Manual-MBS", "Prostata", "Prostate_MBS", "Prostate",
+           1.0, 0.9, 0.8]
+    
+    events = telemetry.EventStream(events_path,
+                                   2,
+                                   6,
+                                   HD_DSC.DATA_COLUMNS,
+                                   )
+    events.run_start()
+    events.patient_start("Patient1", 3)
+    streamed = events.comparison("Patient1", row)
+    finished = events.patient_finish("Patient1", 1.0)
+    events.patient_queued("Patient2", 3)
+    worker_queue = queue.Queue()
+    worker_events = telemetry.WorkerEvents(worker_queue,
+                                           "Patient2",
+                                           )
+    worker_events.patient_start(events.start_time + 0.5)
+    worker_events.comparison(row)
+    events.drain(worker_queue)
+    failed = events.patient_finish("Patient2", 1.0, "error")
+    events.close()
+    
+    with open(events_path) as infile:
+        records = [json.loads(line) for line in infile]
+    
+    assert [record["event"] for record in records] == ["run_start",
+                                                       "patient_start",
+                                                       "comparison",
+                                                       "patient_finish",
+                                                       "patient_queued",
+                                                       "patient_start",
+                                                       "comparison",
+                                                       "patient_finish",
+                                                       "run_end",
+                                                       ]
+    assert streamed["compared_methods"] == "Manual-MBS"
+    assert streamed["alias_name"] == "Prostate"
+    assert streamed["eta_s"] > 0
+    assert finished["comparisons"] == 1
+    assert finished["patients_done"] == 1
+    assert records[5]["comparisons"] == 3
+    assert math.isclose(records[5]["started_s"], 0.5)
+    assert records[6]["alias_name"] == "Prostate"
+    assert failed["status"] == "failed"
+    assert failed["comparisons"] == 1
+    assert failed["eta_s"] == 0
+    
+    temp_folder.cleanup()
+    
+def test_run_journal():
+    """
+    GIVEN: a run journal where a patient has been moved and another one has
+           been interrupted after one comparison
+
+    WHEN: opening the journal again to resume the run
+
+    THEN: stages, rows and comparisons of every patient are found, rows
+          appended twice are stored once and starting a new run empties the
+          journal
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    journal_path = os.path.join(temp_folder.name,
+                                "journal.sqlite",
+                                )
+    row = ["ID", "FoR", "Manual-MBS", "Prostata", "Prostate_MBS", "Prostate",
+           1.0, 0.9, 0.8]
+    other_row = row[:2] + ["Manual-DL"] + row[3:]
+    
+    journal = storage.RunJournal(journal_path)
+    journal.start("digest", ["column"])
+    journal.set_stage("Patient1", "planned")
+    journal.set_stage("Patient2", "planned")
+    journal.append_rows("Patient1", [row, other_row])
+    journal.set_stage("Patient1", "moved")
+    journal.append_rows("Patient2", [row])
+    journal.append_rows("Patient2", [row])
+    journal.save_config({"Alias names": ["Prostate"]})
+    journal.close()
+    
+    journal = storage.RunJournal(journal_path)
+    
+    assert journal.setting("Configuration hash") == "digest"
+    assert list(journal.stages().items()) == [("Patient1", "moved"),
+                                              ("Patient2", "planned"),
+                                              ]
+    assert journal.rows("Patient1") == [row, other_row]
+    assert journal.done_comparisons("Patient2") == {("Manual-MBS", "Prostate")}
+    assert journal.load_config() == {"Alias names": ["Prostate"]}
+    
+    journal.start("new digest", ["column"])
+    
+    assert len(journal.stages()) == 0
+    assert journal.rows("Patient1") == []
+    assert journal.load_config() is None
+    
+    journal.close()
+    temp_folder.cleanup()
+    
+def test_resume_interrupted_run(monkeypatch):
+    """
+    GIVEN: a cohort of two synthetic patients and a run interrupted after the
+           first comparison of the second patient
+
+    WHEN: resuming the run from its journal, with and without result store
+          and joining the old data
+
+    THEN: the excel file and the result store contain every comparison of
+          both patients once
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    cohort_folder_path = os.path.join(temp_folder.name,
+                                      "cohort",
+                                      )
+    config_path = os.path.join(temp_folder.name,
+                               "config.json",
+                               )
+    config = HD_DSC.read_config(r".\tests\config.json")
+    HD_DSC.save_config_data(config,
+                            config_path,
+                            )
+    Phantoms.create_phantom_cohort(cohort_folder_path,
+                                   2,
+                                   config,
+                                   rows=48,
+                                   columns=48,
+                                   slices=16,
+                                   radius_mm=6,
+                                   )
+    
+    # Reference run, never interrupted
+    reference_path = os.path.join(temp_folder.name,
+                                  "reference.xlsx",
+                                  )
+    reference_input_path = os.path.join(temp_folder.name,
+                                        "reference",
+                                        )
+    shutil.copytree(cohort_folder_path,
+                    reference_input_path,
+                    )
+    Main.main([reference_input_path,
+               config_path,
+               config_path,
+               reference_path,
+               "--non-interactive",
+               ])
+    comparisons = len(HD_DSC.load_existing_dataframe(reference_path))
+    
+    # The second patient is interrupted after its first comparison.
+    compute_patient = Main.compute_patient
+    def interrupted_compute_patient(*args):
+        if len(started_patients) == 0:
+            started_patients.append(args)
+            return compute_patient(*args)
+        
+        on_row = args[9]
+        def interrupting_on_row(row):
+            on_row(row)
+            raise KeyboardInterrupt
+        return compute_patient(*args[:9], interrupting_on_row, *args[10:])
+    
+    for index, extra_arguments in enumerate([[],
+                                             ["-j", "True"],
+                                             ["-s", "store"],
+                                             ["-s", "store", "-j", "True"],
+                                             ]):
+        run_folder_path = os.path.join(temp_folder.name,
+                                       f"run{index}",
+                                       )
+        input_folder_path = os.path.join(run_folder_path,
+                                         "patients",
+                                         )
+        shutil.copytree(cohort_folder_path,
+                        input_folder_path,
+                        )
+        excel_path = os.path.join(run_folder_path,
+                                  "data.xlsx",
+                                  )
+        store_path = os.path.join(run_folder_path,
+                                  "results.sqlite",
+                                  )
+        arguments = [input_folder_path,
+                     config_path,
+                     config_path,
+                     excel_path,
+                     "--non-interactive",
+                     "--journal",
+                     os.path.join(run_folder_path,
+                                  "journal.sqlite",
+                                  ),
+                     ] + [store_path if argument == "store" else argument
+                          for argument in extra_arguments]
+        if "-s" in extra_arguments:
+            arguments.append("--export-excel")
+        
+        started_patients = []
+        monkeypatch.setattr(Main,
+                            "compute_patient",
+                            interrupted_compute_patient,
+                            )
+        with pytest.raises(KeyboardInterrupt):
+            Main.main(arguments)
+        monkeypatch.undo()
+        
+        Main.main(arguments + ["--resume"])
+        data = HD_DSC.load_existing_dataframe(excel_path)
+        
+        assert len(data) == comparisons
+        assert not data.duplicated(subset=storage.ResultStore.KEY_COLUMNS).any()
+        if "-s" in extra_arguments:
+            store = storage.ResultStore(store_path)
+            assert len(store.load_dataframe()) == comparisons
+            assert len(store.current_runs()) == 1
+            store.close()
+    
+    temp_folder.cleanup()
+    
+def test_broken_patient_among_good_ones():
+    """
+    GIVEN: a cohort of three synthetic patients, the second one without its
+           RTSTRUCT
+
+    WHEN: running the program in a single process and with two workers
+
+    THEN: the broken patient is recorded as failed and is not moved, the
+          other patients are computed and moved
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    cohort_folder_path = os.path.join(temp_folder.name,
+                                      "cohort",
+                                      )
+    config_path = os.path.join(temp_folder.name,
+                               "config.json",
+                               )
+    config = HD_DSC.read_config(r".\tests\config.json")
+    HD_DSC.save_config_data(config,
+                            config_path,
+                            )
+    Phantoms.create_phantom_cohort(cohort_folder_path,
+                                   3,
+                                   config,
+                                   rows=48,
+                                   columns=48,
+                                   slices=16,
+                                   radius_mm=6,
+                                   )
+    patient_folders = sorted(os.listdir(cohort_folder_path))
+    broken_folder_path = os.path.join(cohort_folder_path,
+                                      patient_folders[1],
+                                      )
+    for rtstruct_file_path in classification.classify_patient_files(
+            broken_folder_path,
+            cache=None,
+            )["RTSTRUCT"]:
+        os.remove(rtstruct_file_path)
+    
+    for index, extra_arguments in enumerate([[],
+                                             ["-w", "2"],
+                                             ]):
+        run_folder_path = os.path.join(temp_folder.name,
+                                       f"run{index}",
+                                       )
+        input_folder_path = os.path.join(run_folder_path,
+                                         "patients",
+                                         )
+        shutil.copytree(cohort_folder_path,
+                        input_folder_path,
+                        )
+        new_folder_path = os.path.join(run_folder_path,
+                                       "done",
+                                       )
+        excel_path = os.path.join(run_folder_path,
+                                  "data.xlsx",
+                                  )
+        journal_path = os.path.join(run_folder_path,
+                                    "journal.sqlite",
+                                    )
+        
+        Main.main([input_folder_path,
+                   config_path,
+                   config_path,
+                   excel_path,
+                   "--non-interactive",
+                   "-n",
+                   new_folder_path,
+                   "--journal",
+                   journal_path,
+                   ] + extra_arguments)
+        data = HD_DSC.load_existing_dataframe(excel_path)
+        journal = storage.RunJournal(journal_path)
+        
+        assert sorted(set(data["Patient ID"])) == [patient_folders[0],
+                                                   patient_folders[2],
+                                                   ]
+        assert journal.stages()[patient_folders[1]] == "failed"
+        assert os.listdir(input_folder_path) == [patient_folders[1]]
+        assert sorted(os.listdir(new_folder_path)) == [patient_folders[0],
+                                                       patient_folders[2],
+                                                       ]
+        
+        journal.close()
+    
+    temp_folder.cleanup()
+    
+def test_classify_patient_files():
+    """
+    GIVEN: a patient whose files have names that do not start with CT or RS,
+           together with a file that is not DICOM
+
+    WHEN: classifying its files and loading the study from the file lists
+
+    THEN: files are classified by their header without being moved and the
+          study has the same geometry and labelmaps of the one loaded from
+          the CT folder
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    patient_folder_path = os.path.join(temp_folder.name,
+                                       "test_patient",
+                                       )
+    os.mkdir(patient_folder_path)
+    for index, file in enumerate(os.listdir(r".\tests\test_patient\CT")):
+        shutil.copy(os.path.join(r".\tests\test_patient\CT",
+                                 file,
+                                 ),
+                    os.path.join(patient_folder_path,
+                                 f"image{index}.dcm",
+                                 ),
+                    )
+    shutil.copy(r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                os.path.join(patient_folder_path,
+                             "structures",
+                             ),
+                )
+    with open(os.path.join(patient_folder_path, "notes.txt"), "w") as file:
+        file.write("not a DICOM file")
+    files_before = sorted(os.listdir(patient_folder_path))
+    
+    patient_files = classification.classify_patient_files(patient_folder_path)
+    study = HD_DSC.PatientStudy(patient_files["CT"],
+                                patient_files["RTSTRUCT"][0],
+                                )
+    folder_study = HD_DSC.PatientStudy(r".\tests\test_patient\CT",
+                                       r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                                       )
+    
+    assert sorted(os.listdir(patient_folder_path)) == files_before
+    assert len(patient_files["CT"]) == len(os.listdir(r".\tests\test_patient\CT"))
+    assert patient_files["RTSTRUCT"] == [os.path.join(patient_folder_path,
+                                                      "structures",
+                                                      )]
+    assert study.geometry == folder_study.geometry
+    assert np.array_equal(study.get_mask("Vescica").to_dense(),
+                          folder_study.get_mask("Vescica").to_dense(),
+                          )
+    assert len(study.series_data) == len(folder_study.series_data)
+    
+    temp_folder.cleanup()
+
+    
+def test_phantom_patient():
+    """
+    GIVEN: a synthetic patient with spheres, shifted and scaled copies
+        
+    WHEN: running the function extract_hausdorff_dice
+        
+    THEN: Dice similarity coefficients and maximum Hausdorff distances are
+          close to the closed form values
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    patient_folder_path = os.path.join(temp_folder.name,
+                                       "Phantom",
+                                       )
+    
+    # Phantom with ROI names from the configuration file
+    config = HD_DSC.read_config(r".\tests\config.json")
+    config["Hausdorff percentiles"] = [100]
+    expected = Phantoms.create_phantom_patient(patient_folder_path,
+                                               "Phantom",
+                                               config,
+                                               rows=96,
+                                               columns=96,
+                                               slices=32,
+                                               slice_thickness_mm=1.5,
+                                               radius_mm=8,
+                                               shift_mm=2,
+                                               )
+    
+    # Moving files into CT and RTSTRUCT folders
+    ct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                          "CT",
+                                          )
+    rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                                "RTSTRUCT",
+                                                )
+    HD_DSC.fill_ct_rtstruct_folders(patient_folder_path,
+                                    ct_folder_path,
+                                    rtstruct_folder_path,
+                                    )
+    rtstruct_file_path = HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
+    manual_seg = HD_DSC.extract_manual_segments(
+        HD_DSC.extract_all_segments(ct_folder_path,
+                                    rtstruct_file_path,
+                                    ),
+        config,
+        )
+    
+    observed = HD_DSC.extract_hausdorff_dice(manual_seg,
+                                             config,
+                                             ct_folder_path,
+                                             rtstruct_file_path,
+                                             )
+    
+    # Voxel diagonal
+    tolerance = math.sqrt(1 + 1 + 1.5**2)
+    assert len(observed) == len(expected)
+    for row in observed:
+        values = expected[(row[2], row[5])]
+        assert math.isclose(row[7],
+                            values["Volumetric Dice similarity coefficient"],
+                            abs_tol=0.02,
+                            )
+        assert abs(row[9] - values["Hausdorff distance (mm)"]) <= tolerance
+    
+    # Remove the folder
+    temp_folder.cleanup()
+    
+def test_classify_patient_files_with_several_series():
+    """
+    GIVEN: a patient folder with two CT series and two RTSTRUCTs, whose file
+           names do not tell what they are
+
+    WHEN: classifying its files, moving them into the CT and RTSTRUCT
+          folders and extracting the rtstruct file path
+
+    THEN: the RTSTRUCT referencing the largest CT series is chosen, only its
+          files are moved and the classification is reused after the move
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    patient_folder_path = os.path.join(temp_folder.name,
+                                       "test_patient",
+                                       )
+    config = HD_DSC.read_config(r".\tests\config.json")
+    Phantoms.create_phantom_patient(patient_folder_path,
+                                    "Phantom",
+                                    config,
+                                    rows=32,
+                                    columns=32,
+                                    slices=8,
+                                    )
+    phantom_files = sorted(os.listdir(patient_folder_path))
+    for index, file in enumerate(os.listdir(r".\tests\test_patient\CT")):
+        shutil.copy(os.path.join(r".\tests\test_patient\CT",
+                                 file,
+                                 ),
+                    os.path.join(patient_folder_path,
+                                 f"image{index}.dcm",
+                                 ),
+                    )
+    shutil.copy(r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                os.path.join(patient_folder_path,
+                             "structures",
+                             ),
+                )
+    
+    patient_files = classification.classify_patient_files(patient_folder_path)
+    
+    assert len(patient_files["Series"]) == 2
+    assert len(patient_files["CT"]) == len(os.listdir(r".\tests\test_patient\CT"))
+    assert len(patient_files["RTSTRUCT"]) == 2
+    assert os.path.basename(patient_files["RTSTRUCT"][0]) == "structures"
+    assert (patient_files["Series instance UID"]
+            in patient_files["Structure sets"][patient_files["RTSTRUCT"][0]]["Referenced series"])
+    
+    # Moving files into CT and RTSTRUCT folders
+    ct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                          "CT",
+                                          )
+    rtstruct_folder_path = HD_DSC.create_folder(patient_folder_path,
+                                                "RTSTRUCT",
+                                                )
+    HD_DSC.move_ct_rtstruct_files(patient_folder_path,
+                                  ct_folder_path,
+                                  rtstruct_folder_path,
+                                  )
+    
+    assert classification.CLASSIFICATION_CACHE.get(patient_folder_path) is not None
+    assert sorted(os.listdir(patient_folder_path)) == sorted(phantom_files
+                                                             + ["CT", "RTSTRUCT"])
+    assert len(os.listdir(ct_folder_path)) == len(patient_files["CT"])
+    assert (HD_DSC.extract_rtstruct_file_path(rtstruct_folder_path)
+            == os.path.join(rtstruct_folder_path,
+                            "structures",
+                            ))
+    
+    temp_folder.cleanup()
+    
+def test_classification_cache():
+    """
+    GIVEN: a patient folder already classified
+
+    WHEN: looking up its classification before and after adding a file to
+          one of its subfolders
+
+    THEN: the classification is found until the file is added, then the
+          files are classified again and the new file is found
+
+    """
+    # Create a temporary empty folder
+    temp_folder = tempfile.TemporaryDirectory()
+    patient_folder_path = os.path.join(temp_folder.name,
+                                       "test_patient",
+                                       )
+    shutil.copytree(r".\tests\test_patient\RTSTRUCT",
+                    os.path.join(patient_folder_path,
+                                 "RTSTRUCT",
+                                 ),
+                    )
+    cache = classification.ClassificationCache()
+    
+    patient_files = classification.classify_patient_files(patient_folder_path,
+                                                          cache,
+                                                          )
+    assert cache.get(patient_folder_path) is patient_files
+    
+    shutil.copy(r".\tests\test_patient\RTSTRUCT\RS_002.dcm",
+                os.path.join(patient_folder_path,
+                             "RTSTRUCT",
+                             "copy.dcm",
+                             ),
+                )
+    
+    assert cache.get(patient_folder_path) is None
+    patient_files = classification.classify_patient_files(patient_folder_path,
+                                                          cache,
+                                                          )
+    assert len(patient_files["RTSTRUCT"]) == 2
+    
+    temp_folder.cleanup()
\ No newline at end of file
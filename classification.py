@@ -0,0 +1,310 @@
+import os
+from collections import OrderedDict
+
+import pydicom
+
+
+# SOP classes of CT images and of RT structure sets.
+CT_SOP_CLASS_UIDS = ["1.2.840.10008.5.1.4.1.1.2",
+                     "1.2.840.10008.5.1.4.1.1.2.1",
+                     ]
+RTSTRUCT_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.481.3"
+
+# Header tags read from the RTSTRUCT files during the pre-scan.
+SCAN_RTSTRUCT_TAGS = ["PatientID",
+                      "StudyInstanceUID",
+                      "FrameOfReferenceUID",
+                      "SOPInstanceUID",
+                      "StructureSetROISequence",
+                      ]
+
+# Header tags read from every file to classify it, they include the ones
+# needed by the pre-scan so that each file is read only once.
+CLASSIFY_TAGS = ["Modality",
+                 "SOPClassUID",
+                 "SeriesInstanceUID",
+                 "FrameOfReferenceUID",
+                 "Rows",
+                 "Columns",
+                 "ReferencedFrameOfReferenceSequence",
+                 ] + SCAN_RTSTRUCT_TAGS
+
+def folder_signature(folder_path):
+    """
+    Signature of a folder, it changes if a file or a folder is added,
+    removed or renamed in the folder or in one of its direct subfolders.
+    
+    Only the modification times of the folder and of its direct subfolders
+    are read, files are not listed one by one, so the signature is cheap
+    enough to be checked every time a classification is looked up. Files
+    rewritten in place, or changed deeper than the direct subfolders, are
+    not detected.
+
+    Parameters
+    ----------
+    folder_path : str
+        Path to the folder.
+
+    Returns
+    -------
+    signature : tuple
+        Name and modification time of the folder ("") and of its direct
+        subfolders. Empty if the folder does not exist.
+
+    """
+    if not os.path.isdir(folder_path):
+        return ()
+    
+    signature = [("", os.stat(folder_path).st_mtime_ns)]
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                signature.append((entry.name,
+                                  entry.stat().st_mtime_ns,
+                                  ))
+    
+    return tuple(sorted(signature))
+
+class ClassificationCache:
+    """
+    Classification of the patient folders already read (see
+    classify_patient_files), so that the headers of a patient are read only
+    once by all the stages of the analysis.
+    
+    A classification is reused only as long as the signature of the folder
+    (see folder_signature) does not change.
+
+    """
+    def __init__(self):
+        self.entries = {}
+    
+    def get(self, patient_folder_path):
+        """
+        Looking up the classification of a patient folder.
+
+        Parameters
+        ----------
+        patient_folder_path : str
+            Path to the patient folder.
+
+        Returns
+        -------
+        patient_files : dict or None
+            Classification of the folder, None if it is not in the cache or
+            the files of the folder have changed.
+
+        """
+        key = os.path.abspath(patient_folder_path)
+        if key not in self.entries:
+            return None
+        
+        signature, patient_files = self.entries[key]
+        if signature != folder_signature(patient_folder_path):
+            del self.entries[key]
+            return None
+        
+        return patient_files
+    
+    def put(self,
+            patient_folder_path,
+            patient_files,
+            ):
+        """
+        Storing the classification of a patient folder with the current
+        signature of its files.
+
+        Parameters
+        ----------
+        patient_folder_path : str
+            Path to the patient folder.
+        patient_files : dict
+            Classification of the folder.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.entries[os.path.abspath(patient_folder_path)] = (
+            folder_signature(patient_folder_path),
+            patient_files,
+            )
+    
+    def clear(self):
+        """
+        Removing all the classifications.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.entries.clear()
+
+# Classifications shared by all the functions of this module.
+CLASSIFICATION_CACHE = ClassificationCache()
+
+def referenced_series_uids(rtstruct_header):
+    """
+    SeriesInstanceUIDs of the image series referenced by an RTSTRUCT.
+
+    Parameters
+    ----------
+    rtstruct_header : pydicom.dataset.Dataset
+        Header of the RTSTRUCT file.
+
+    Returns
+    -------
+    series_uids : list
+        Referenced SeriesInstanceUIDs.
+
+    """
+    series_uids = []
+    for frame in rtstruct_header.get("ReferencedFrameOfReferenceSequence", []):
+        for study in frame.get("RTReferencedStudySequence", []):
+            for series in study.get("RTReferencedSeriesSequence", []):
+                series_uids.append(str(series.SeriesInstanceUID))
+    
+    return series_uids
+
+def classify_patient_files(patient_folder_path,
+                           cache=CLASSIFICATION_CACHE,
+                           profiler=None,
+                           ):
+    """
+    Classifying the files of a patient where they are, without moving them.
+    
+    Every file in the patient folder and in its subfolders is classified by
+    the Modality and SOPClassUID of its header, not by its name, so files
+    exported with any naming convention are found. Only the header is read
+    (see CLASSIFY_TAGS), once per file; files that are not DICOM or are
+    neither CT images nor RTSTRUCTs are ignored. CT files are grouped by
+    SeriesInstanceUID and the RTSTRUCT used for the analysis is the one that
+    references a CT series of the folder (if several do, the one whose series
+    has the most slices). Without references the FrameOfReferenceUID is
+    matched, then the largest series and the first RTSTRUCT are used.
+    Nothing is moved or created.
+
+    Parameters
+    ----------
+    patient_folder_path : str
+        Path to the patient folder.
+    cache : ClassificationCache or None
+        Cache where the classification is looked up before reading the files
+        and stored afterwards. If None the files are always read.
+    profiler : telemetry.Profiler or None
+        If given, the bytes of the headers actually read are added to its
+        "bytes read" counter (nothing is read if the classification is
+        found in the cache).
+
+    Returns
+    -------
+    patient_files : dict
+        Dictionary with keys:
+        "CT": sorted paths of the files of the selected CT series;
+        "RTSTRUCT": paths of the RTSTRUCT files, the selected one first;
+        "Series": information of every CT series by SeriesInstanceUID, a
+        dictionary with keys "Frame of reference", "Rows", "Columns" and
+        "Files";
+        "Structure sets": information of every RTSTRUCT by path, a dictionary
+        with keys "Patient ID", "Study instance UID", "Frame of reference",
+        "SOP instance UID", "ROI names" and "Referenced series";
+        "Series instance UID": UID of the selected CT series (None if there
+        are no CT files).
+
+    """
+    if cache is not None:
+        patient_files = cache.get(patient_folder_path)
+        if patient_files is not None:
+            return patient_files
+    
+    series = OrderedDict()
+    structure_sets = OrderedDict()
+    for root, folders, files in os.walk(patient_folder_path):
+        folders.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root,
+                                     file,
+                                     )
+            try:
+                with open(file_path, "rb") as dicom_file:
+                    header = pydicom.dcmread(dicom_file,
+                                             stop_before_pixels=True,
+                                             specific_tags=CLASSIFY_TAGS,
+                                             )
+                    if profiler is not None:
+                        profiler.count("bytes read", dicom_file.tell())
+            except (pydicom.errors.InvalidDicomError, OSError):
+                continue
+            
+            modality = header.get("Modality")
+            sop_class_uid = str(header.get("SOPClassUID", ""))
+            frame_of_reference_uid = header.get("FrameOfReferenceUID")
+            if frame_of_reference_uid is not None:
+                frame_of_reference_uid = str(frame_of_reference_uid)
+            if modality == "CT" or sop_class_uid in CT_SOP_CLASS_UIDS:
+                series_uid = str(header.get("SeriesInstanceUID", ""))
+                if series_uid not in series:
+                    series[series_uid] = {"Frame of reference": frame_of_reference_uid,
+                                          "Rows": header.get("Rows"),
+                                          "Columns": header.get("Columns"),
+                                          "Files": [],
+                                          }
+                    for key in ["Rows", "Columns"]:
+                        if series[series_uid][key] is not None:
+                            series[series_uid][key] = int(series[series_uid][key])
+                series[series_uid]["Files"].append(file_path)
+            elif (modality == "RTSTRUCT"
+                  or sop_class_uid == RTSTRUCT_SOP_CLASS_UID):
+                structure_sets[file_path] = {
+                    "Patient ID": str(header.get("PatientID", "")) or None,
+                    "Study instance UID": header.get("StudyInstanceUID"),
+                    "Frame of reference": frame_of_reference_uid,
+                    "SOP instance UID": header.get("SOPInstanceUID"),
+                    "ROI names": [str(structure_roi.ROIName) for structure_roi
+                                  in header.get("StructureSetROISequence", [])],
+                    "Referenced series": referenced_series_uids(header),
+                    }
+                for key in ["Study instance UID", "SOP instance UID"]:
+                    if structure_sets[file_path][key] is not None:
+                        structure_sets[file_path][key] = str(structure_sets[file_path][key])
+    
+    # Choosing the RTSTRUCT and the CT series it references. Pairs are
+    # ranked by reference, then by frame of reference, then by number of
+    # slices; the first of equal pairs is kept.
+    selected_series = None
+    selected_rtstruct = None
+    best_rank = None
+    for series_uid, series_info in series.items():
+        for rtstruct_file_path, rtstruct_info in structure_sets.items():
+            rank = (series_uid in rtstruct_info["Referenced series"],
+                    series_info["Frame of reference"] == rtstruct_info["Frame of reference"],
+                    len(series_info["Files"]),
+                    )
+            if best_rank is None or rank > best_rank:
+                best_rank = rank
+                selected_series = series_uid
+                selected_rtstruct = rtstruct_file_path
+    if selected_series is None and len(series) > 0:
+        selected_series = max(series,
+                              key=lambda series_uid: len(series[series_uid]["Files"]),
+                              )
+    
+    rtstruct_file_paths = list(structure_sets)
+    if selected_rtstruct is not None:
+        rtstruct_file_paths.remove(selected_rtstruct)
+        rtstruct_file_paths.insert(0, selected_rtstruct)
+    
+    patient_files = {"CT": (sorted(series[selected_series]["Files"])
+                            if selected_series is not None else []),
+                     "RTSTRUCT": rtstruct_file_paths,
+                     "Series": series,
+                     "Structure sets": structure_sets,
+                     "Series instance UID": selected_series,
+                     }
+    if cache is not None:
+        cache.put(patient_folder_path,
+                  patient_files,
+                  )
+    
+    return patient_files
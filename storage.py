@@ -0,0 +1,688 @@
+import json
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+import HD_DSC
+
+
+class ResultStore:
+    """
+    Append-only store of the final data, saved in a SQLite database.
+    
+    The rows of every patient are committed as soon as they are computed, so
+    an interrupted run never loses the patients already analysed. Every row
+    also records the run that produced it. The data can be exported to an
+    excel file at any moment.
+    Runs are recorded as joined or not (see start_run): like the excel file,
+    the current data are the rows of the last run that did not join the old
+    data and of the joined runs that followed it, older rows are kept but
+    not loaded.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the SQLite database (if it does not exist it will be
+        automatically created).
+    run_id : str or None
+        Identifier of the current run, it must be unique in the database. If
+        None the current date and time, to the microsecond, are used.
+
+    """
+    # Name of the tables and of the column that identifies the run.
+    TABLE = "results"
+    RUNS_TABLE = "runs"
+    RUN_COLUMN = "Run"
+    
+    # Columns that identify a comparison, a comparison stored more than once
+    # is loaded only once.
+    KEY_COLUMNS = ["Frame of reference",
+                   "RTSTRUCT SOP instance UID",
+                   "Configuration hash",
+                   "Compared methods",
+                   "Reference segment name",
+                   "Compared segment name",
+                   ]
+    
+    # Columns that identify the studies already analysed and their
+    # comparisons (see HD_DSC.StudyIndex).
+    STUDY_KEY_COLUMNS = ["Frame of reference",
+                         "Compared methods",
+                         "Alias name",
+                         ] + HD_DSC.STUDY_COLUMNS
+    
+    def __init__(self,
+                 store_path,
+                 run_id=None,
+                 ):
+        self.store_path = store_path
+        if run_id is None:
+            run_id = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.run_id = run_id
+        self.connection = sqlite3.connect(store_path)
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.RUNS_TABLE}" '
+                f'("{self.RUN_COLUMN}" PRIMARY KEY, "Joined")',
+                )
+    
+    def start_run(self, joined):
+        """
+        Recording the start of the current run.
+
+        Parameters
+        ----------
+        joined : bool
+            True if the run joins the data already stored, False if it
+            replaces them (they are kept in the database but not loaded
+            anymore).
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.connection:
+            self.connection.execute(
+                f'INSERT INTO "{self.RUNS_TABLE}" VALUES (?, ?)',
+                (self.run_id, int(bool(joined))),
+                )
+    
+    def has_run(self):
+        """
+        Checking if the current run was already started (Ex. by a run that is
+        being resumed).
+
+        Returns
+        -------
+        started : bool
+            True if the run was recorded with start_run.
+
+        """
+        run = self.connection.execute(
+            f'SELECT 1 FROM "{self.RUNS_TABLE}" WHERE "{self.RUN_COLUMN}" = ?',
+            (self.run_id,),
+            ).fetchone()
+        
+        return run is not None
+    
+    def current_runs(self):
+        """
+        Runs whose rows are the current data: the last run that did not join
+        the old data and the following ones.
+
+        Returns
+        -------
+        runs : list or None
+            Identifiers of the runs, None if no run was recorded with
+            start_run (all the rows are current).
+
+        """
+        runs = self.connection.execute(
+            f'SELECT "{self.RUN_COLUMN}", "Joined" FROM "{self.RUNS_TABLE}" '
+            'ORDER BY rowid',
+            ).fetchall()
+        if len(runs) == 0:
+            return None
+        
+        first = 0
+        for position, (_, joined) in enumerate(runs):
+            if not joined:
+                first = position
+        
+        return [run for run, _ in runs[first:]]
+    
+    def seed(self, data):
+        """
+        Filling an empty store with data read elsewhere (Ex. the excel file
+        of the runs made before using the store). Nothing is done if the
+        store already has rows.
+
+        Parameters
+        ----------
+        data : DataFrame
+            Data to store, they are recorded with the current run.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(self.columns()) > 0 or len(data) == 0:
+            return
+        
+        data = data.astype(object).where(pd.notna(data), None)
+        self.append_rows(data.values.tolist(),
+                         list(data.columns),
+                         )
+    
+    def columns(self):
+        """
+        Columns of the stored data (without the run column).
+
+        Returns
+        -------
+        columns : list
+            Names of the stored columns, empty if nothing was stored yet.
+
+        """
+        table_info = self.connection.execute(
+            f'PRAGMA table_info("{self.TABLE}")',
+            ).fetchall()
+        
+        return [column[1] for column in table_info
+                if column[1] != self.RUN_COLUMN]
+    
+    def append_rows(self,
+                    rows,
+                    columns,
+                    ):
+        """
+        Appending rows to the store and committing them.
+        Columns that are not in the store yet are added.
+
+        Parameters
+        ----------
+        rows : list
+            Rows to append, each row is a list of values.
+        columns : list
+            Names of the columns of the rows.
+
+        Returns
+        -------
+        None.
+
+        """
+        existing_columns = self.columns()
+        with self.connection:
+            if len(existing_columns) == 0:
+                definition = ", ".join(f'"{column}"' for column
+                                       in [self.RUN_COLUMN] + list(columns))
+                self.connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{self.TABLE}" ({definition})',
+                    )
+            else:
+                for column in columns:
+                    if column not in existing_columns:
+                        self.connection.execute(
+                            f'ALTER TABLE "{self.TABLE}" ADD COLUMN "{column}"',
+                            )
+            
+            names = ", ".join(f'"{column}"' for column
+                              in [self.RUN_COLUMN] + list(columns))
+            placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+            self.connection.executemany(
+                f'INSERT INTO "{self.TABLE}" ({names}) VALUES ({placeholders})',
+                [[self.run_id] + list(row) for row in rows],
+                )
+    
+    def append_missing_rows(self,
+                            rows,
+                            columns,
+                            ):
+        """
+        Appending only the rows whose comparison (see KEY_COLUMNS) is not
+        stored yet by the current run (Ex. rows recorded in the journal of an
+        interrupted run but not in the store).
+
+        Parameters
+        ----------
+        rows : list
+            Rows to append, each row is a list of values.
+        columns : list
+            Names of the columns of the rows.
+
+        Returns
+        -------
+        None.
+
+        """
+        key_indexes = [list(columns).index(column)
+                       for column in self.KEY_COLUMNS]
+        stored_keys = set()
+        if all(column in self.columns() for column in self.KEY_COLUMNS):
+            names = ", ".join(f'"{column}"' for column in self.KEY_COLUMNS)
+            stored_keys = set(self.connection.execute(
+                f'SELECT {names} FROM "{self.TABLE}" '
+                f'WHERE "{self.RUN_COLUMN}" = ?',
+                (self.run_id,),
+                ).fetchall())
+        
+        missing_rows = [row for row in rows
+                        if tuple(row[index] for index in key_indexes)
+                        not in stored_keys]
+        if len(missing_rows) > 0:
+            self.append_rows(missing_rows,
+                             columns,
+                             )
+    
+    def load_dataframe(self,
+                       run_id=None,
+                       ):
+        """
+        Loading the stored data.
+
+        Parameters
+        ----------
+        run_id : str or None
+            If given, only the rows of this run are loaded, otherwise the
+            rows of the current runs (see current_runs).
+
+        Returns
+        -------
+        data : DataFrame
+            Stored data (an empty dataframe if nothing was stored yet).
+            Comparisons stored more than once (see KEY_COLUMNS) appear only
+            once, with the last values stored.
+
+        """
+        columns = self.columns()
+        if len(columns) == 0:
+            return pd.DataFrame()
+        
+        condition, parameters = self.run_condition(run_id)
+        names = ", ".join(f'"{column}"' for column in columns)
+        query = f'SELECT {names} FROM "{self.TABLE}"{condition} ORDER BY rowid'
+        
+        data = pd.read_sql_query(query,
+                                 self.connection,
+                                 params=parameters,
+                                 )
+        
+        key_columns = [column for column in self.KEY_COLUMNS
+                       if column in data.columns]
+        if "Compared methods" in key_columns:
+            data = data.drop_duplicates(subset=key_columns,
+                                        keep="last",
+                                        ).reset_index(drop=True)
+        
+        return data
+    
+    def load_study_keys(self):
+        """
+        Loading only the columns that identify the studies and the
+        comparisons of the current data (see STUDY_KEY_COLUMNS), so that
+        HD_DSC.StudyIndex is built without loading the whole data.
+
+        Returns
+        -------
+        keys : DataFrame
+            Every distinct combination of the stored STUDY_KEY_COLUMNS (an
+            empty dataframe if nothing was stored yet).
+
+        """
+        stored_columns = self.columns()
+        columns = [column for column in self.STUDY_KEY_COLUMNS
+                   if column in stored_columns]
+        if len(columns) == 0:
+            return pd.DataFrame()
+        
+        condition, parameters = self.run_condition()
+        names = ", ".join(f'"{column}"' for column in columns)
+        
+        return pd.read_sql_query(
+            f'SELECT DISTINCT {names} FROM "{self.TABLE}"{condition}',
+            self.connection,
+            params=parameters,
+            )
+    
+    def run_condition(self,
+                      run_id=None,
+                      ):
+        """
+        SQL condition that selects the rows of a run or of the current runs.
+
+        Parameters
+        ----------
+        run_id : str or None
+            If given, the rows of this run are selected, otherwise the rows of
+            the current runs (see current_runs).
+
+        Returns
+        -------
+        condition : str
+            WHERE clause (with a leading space), empty if every row is
+            selected.
+        parameters : list
+            Values of the placeholders of the clause.
+
+        """
+        if run_id is not None:
+            runs = [run_id]
+        else:
+            runs = self.current_runs()
+        if runs is None:
+            return "", []
+        
+        placeholders = ", ".join("?" for _ in runs)
+        
+        return f' WHERE "{self.RUN_COLUMN}" IN ({placeholders})', runs
+    
+    def export_excel(self,
+                     excel_path,
+                     run_id=None,
+                     ):
+        """
+        Exporting the stored data to an excel file.
+
+        Parameters
+        ----------
+        excel_path : str
+            Path to the excel file.
+        run_id : str or None
+            If given, only the rows of this run are exported.
+
+        Returns
+        -------
+        None.
+
+        """
+        data = self.load_dataframe(run_id)
+        data.to_excel(excel_path,
+                      sheet_name="Data",
+                      index=False,
+                      )
+    
+    def close(self):
+        """
+        Closing the connection to the database.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection.close()
+
+class RunJournal:
+    """
+    Journal of a run, saved in a SQLite database, used to resume the run if
+    it is interrupted.
+    
+    For every patient the journal records the last stage completed
+    ("planned", "computed", "moved", "skipped" or "failed") and the rows
+    already computed, committed as soon as they are known. The configuration
+    hash and the columns of the run are saved too, together with the
+    configuration updated with the names chosen for the unknown segments and
+    the run of the result store (if any) where the rows are saved.
+
+    Parameters
+    ----------
+    journal_path : str
+        Path to the SQLite database (if it does not exist it will be
+        automatically created).
+
+    """
+    # Stages after which a patient does not need to be computed again.
+    FINISHED_STAGES = ["computed",
+                       "moved",
+                       "skipped",
+                       ]
+    
+    # Columns of the rows that identify a comparison of a patient.
+    ROW_KEY_COLUMNS = ["Compared methods",
+                       "Reference segment name",
+                       "Compared segment name",
+                       ]
+    
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.connection = sqlite3.connect(journal_path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS "run" ("Key" PRIMARY KEY, "Value")',
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS "patients" '
+                '("Patient folder" PRIMARY KEY, "Stage")',
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS "rows" ("Patient folder", '
+                '"Compared methods", "Reference segment name", '
+                '"Compared segment name", "Row", UNIQUE ("Patient folder", '
+                '"Compared methods", "Reference segment name", '
+                '"Compared segment name"))',
+                )
+    
+    def start(self,
+              digest,
+              columns,
+              ):
+        """
+        Starting a new run, the content of the journal is deleted.
+
+        Parameters
+        ----------
+        digest : str
+            Hash of the configuration of the run (see HD_DSC.config_hash).
+        columns : list
+            Columns of the rows.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.connection:
+            for table in ["run", "patients", "rows"]:
+                self.connection.execute(f'DELETE FROM "{table}"')
+            self.connection.executemany(
+                'INSERT INTO "run" VALUES (?, ?)',
+                [("Configuration hash", digest),
+                 ("Columns", json.dumps(list(columns))),
+                 ],
+                )
+    
+    def setting(self, key):
+        """
+        Reading a setting of the run saved in the journal.
+
+        Parameters
+        ----------
+        key : str
+            Name of the setting (Ex. "Configuration hash").
+
+        Returns
+        -------
+        value : str or None
+            Value of the setting, None if it was not saved.
+
+        """
+        value = self.connection.execute(
+            'SELECT "Value" FROM "run" WHERE "Key" = ?',
+            (key,),
+            ).fetchone()
+        
+        return None if value is None else value[0]
+    
+    def save_setting(self,
+                     key,
+                     value,
+                     ):
+        """
+        Saving a setting of the run in the journal, replacing its old value.
+
+        Parameters
+        ----------
+        key : str
+            Name of the setting (Ex. "Store run").
+        value : str
+            Value of the setting.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO "run" VALUES (?, ?)',
+                (key, value),
+                )
+    
+    def save_config(self, config):
+        """
+        Saving the current configuration, so that the names chosen for the
+        unknown segments are not asked again when the run is resumed.
+
+        Parameters
+        ----------
+        config : dict
+            Content of the configuration file.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.save_setting("Configuration",
+                          json.dumps(config),
+                          )
+    
+    def load_config(self):
+        """
+        Loading the configuration saved in the journal.
+
+        Returns
+        -------
+        config : dict or None
+            Saved configuration, None if it was never saved.
+
+        """
+        config = self.setting("Configuration")
+        
+        return None if config is None else json.loads(config)
+    
+    def set_stage(self,
+                  patient_folder,
+                  stage,
+                  ):
+        """
+        Recording the last stage completed by a patient.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        stage : str
+            Name of the stage (Ex. "computed").
+
+        Returns
+        -------
+        None.
+
+        """
+        # Updating in place keeps the order in which patients were recorded.
+        with self.connection:
+            updated = self.connection.execute(
+                'UPDATE "patients" SET "Stage" = ? WHERE "Patient folder" = ?',
+                (stage, patient_folder),
+                )
+            if updated.rowcount == 0:
+                self.connection.execute(
+                    'INSERT INTO "patients" VALUES (?, ?)',
+                    (patient_folder, stage),
+                    )
+    
+    def stages(self):
+        """
+        Last stage completed by every patient of the journal.
+
+        Returns
+        -------
+        stages : OrderedDict
+            Stage of every patient folder, in the order in which patients
+            were first recorded.
+
+        """
+        return OrderedDict(self.connection.execute(
+            'SELECT "Patient folder", "Stage" FROM "patients" ORDER BY rowid',
+            ).fetchall())
+    
+    def append_rows(self,
+                    patient_folder,
+                    rows,
+                    ):
+        """
+        Appending the rows of a patient and committing them.
+        Rows of comparisons already in the journal are ignored by the
+        database (see ROW_KEY_COLUMNS), so appending the same rows twice has
+        no effect.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        rows : list
+            Rows to append, each row is a list of values.
+
+        Returns
+        -------
+        None.
+
+        """
+        key_indexes = [HD_DSC.DATA_COLUMNS.index(column)
+                       for column in self.ROW_KEY_COLUMNS]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO "rows" VALUES (?, ?, ?, ?, ?)',
+                [(patient_folder,
+                  *[row[index] for index in key_indexes],
+                  json.dumps(list(row), default=float),
+                  )
+                 for row in rows],
+                )
+    
+    def rows(self, patient_folder):
+        """
+        Rows of a patient saved in the journal.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+
+        Returns
+        -------
+        rows : list
+            Rows of the patient, in the order in which they were computed.
+
+        """
+        return [json.loads(row[0]) for row in self.connection.execute(
+            'SELECT "Row" FROM "rows" WHERE "Patient folder" = ? ORDER BY rowid',
+            (patient_folder,),
+            )]
+    
+    def done_comparisons(self, patient_folder):
+        """
+        Comparisons of a patient saved in the journal.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+
+        Returns
+        -------
+        comparisons : set
+            Set of (compared methods, alias name) tuples.
+
+        """
+        methods_index = HD_DSC.DATA_COLUMNS.index("Compared methods")
+        alias_index = HD_DSC.DATA_COLUMNS.index("Alias name")
+        
+        return {(row[methods_index], row[alias_index])
+                for row in self.rows(patient_folder)}
+    
+    def close(self):
+        """
+        Closing the connection to the database.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection.close()
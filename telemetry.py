@@ -0,0 +1,627 @@
+import sys
+import os
+import json
+import time
+import threading
+from queue import Empty
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+
+# Stages timed by the Profiler, in the order they are reported.
+PROFILE_STAGES = ["scan",
+                  "header read",
+                  "rasterize",
+                  "metrics",
+                  "store",
+                  "move",
+                  ]
+
+# Path of the file where Linux reports the memory used by the current process.
+STATM_PATH = "/proc/self/statm"
+
+def current_rss_mb():
+    """
+    Resident memory currently used by the process.
+
+    Returns
+    -------
+    current_rss_mb : float or None
+        Current resident set size in megabytes, None if it can not be
+        measured on this platform (it is read from /proc, so only on Linux).
+
+    """
+    try:
+        with open(STATM_PATH) as statm_file:
+            pages = int(statm_file.read().split()[1])
+        page_size = os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    
+    return pages * page_size / 1024**2
+
+class Profiler:
+    """
+    Lightweight timers and counters of the analysis of a patient.
+    
+    Time spent in every stage (see PROFILE_STAGES) is accumulated, together
+    with counters such as the bytes read and the masks built, and the peak
+    resident memory of the process while the patient is analysed (see
+    track_rss). A worker process keeps part of the memory of the patients it
+    analysed before, so the increase of the resident memory since the start
+    of the patient is recorded too. A Profiler can be sent to a worker
+    process and back.
+
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.counters = {}
+        self.peak_rss_mb = None
+        self.rss_increase_mb = None
+        self._lock = threading.Lock()
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def stage(self, name):
+        """
+        Timing a stage, the time is added to the one already spent in it.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage (Ex. "rasterize").
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0) + elapsed
+    
+    def count(self,
+              name,
+              value=1,
+              ):
+        """
+        Incrementing a counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter (Ex. "bytes read").
+        value : int
+            Increment.
+
+        Returns
+        -------
+        None.
+
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def sample_rss(self):
+        """
+        Updating the peak resident memory with the current one.
+
+        Returns
+        -------
+        current : float or None
+            Current resident memory in megabytes, None if it can not be
+            measured.
+
+        """
+        current = current_rss_mb()
+        if current is not None:
+            with self._lock:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0, current)
+        
+        return current
+    
+    @contextmanager
+    def track_rss(self, interval=0.05):
+        """
+        Sampling the resident memory in a background thread while the
+        context is open, so the peak also includes the memory freed before
+        the end of a stage. The increase of the peak over the memory used
+        when the context was opened is recorded as well.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between two samples.
+
+        """
+        stop = threading.Event()
+        baseline = self.sample_rss()
+        peak = [baseline]
+        
+        def sample():
+            while not stop.wait(interval):
+                current = self.sample_rss()
+                if current is not None:
+                    peak[0] = max(peak[0] or 0, current)
+        
+        sampler = threading.Thread(target=sample,
+                                   daemon=True,
+                                   )
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            current = self.sample_rss()
+            if baseline is not None and current is not None:
+                increase = max(peak[0], current) - baseline
+                with self._lock:
+                    self.rss_increase_mb = max(self.rss_increase_mb or 0,
+                                               increase,
+                                               )
+    
+    def merge(self, other):
+        """
+        Adding the timers and counters of another profiler (Ex. the one
+        returned by a worker process).
+
+        Parameters
+        ----------
+        other : Profiler
+            Profiler to add.
+
+        Returns
+        -------
+        None.
+
+        """
+        if other is self:
+            return
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+        for name, value in other.counters.items():
+            self.count(name, value)
+        if other.peak_rss_mb is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0, other.peak_rss_mb)
+        if other.rss_increase_mb is not None:
+            self.rss_increase_mb = max(self.rss_increase_mb or 0,
+                                       other.rss_increase_mb,
+                                       )
+    
+    def report(self):
+        """
+        Summarizing the profiler in a flat dictionary.
+
+        Returns
+        -------
+        report : dict
+            "<stage> (s)" for every stage of PROFILE_STAGES and for any other
+            timed stage, every counter, "Peak RSS (MB)" and
+            "RSS increase (MB)".
+
+        """
+        report = {}
+        for name in PROFILE_STAGES + sorted(set(self.seconds)
+                                            - set(PROFILE_STAGES)):
+            report[f"{name} (s)"] = self.seconds.get(name, 0.0)
+        report.update(self.counters)
+        report["Peak RSS (MB)"] = self.peak_rss_mb
+        report["RSS increase (MB)"] = self.rss_increase_mb
+        
+        return report
+
+def profile_stage(profiler, name):
+    """
+    Timing a stage with a profiler that may be missing.
+
+    Parameters
+    ----------
+    profiler : Profiler or None
+        Profiler of the patient. If None nothing is timed.
+    name : str
+        Name of the stage.
+
+    Returns
+    -------
+    context : context manager
+        Context that times the stage.
+
+    """
+    if profiler is None:
+        return nullcontext()
+    
+    return profiler.stage(name)
+
+def track_rss(profiler):
+    """
+    Sampling the resident memory with a profiler that may be missing.
+
+    Parameters
+    ----------
+    profiler : Profiler or None
+        Profiler of the patient. If None nothing is sampled.
+
+    Returns
+    -------
+    context : context manager
+        Context that samples the memory (see Profiler.track_rss).
+
+    """
+    if profiler is None:
+        return nullcontext()
+    
+    return profiler.track_rss()
+
+def save_profile_report(profilers,
+                        profile_path,
+                        total=None,
+                        ):
+    """
+    Saving the profiling report of a run, one row for each patient and one
+    for the whole run.
+    
+    The report is a csv file if profile_path ends with .csv, otherwise a
+    json file with keys "patients" and "total".
+
+    Parameters
+    ----------
+    profilers : dict
+        Profiler of each patient folder.
+    profile_path : str
+        Path to the json or csv file.
+    total : Profiler or None
+        Profiler of the stages not related to a single patient (Ex. writing
+        the excel file). The profilers of all patients are added to it.
+
+    Returns
+    -------
+    report : dict
+        Report of every patient, as a list of dictionaries, under key
+        "patients" and aggregate report under key "total".
+
+    """
+    if total is None:
+        total = Profiler()
+    
+    patients = []
+    for patient_folder, profiler in profilers.items():
+        patients.append({"Patient folder": patient_folder,
+                         **profiler.report(),
+                         })
+        total.merge(profiler)
+    report = {"patients": patients,
+              "total": {"Patient folder": "Total",
+                        **total.report(),
+                        },
+              }
+    
+    if profile_path.lower().endswith(".csv"):
+        pd.DataFrame(patients + [report["total"]]).to_csv(profile_path,
+                                                          index=False,
+                                                          )
+    else:
+        with open(profile_path, "w") as outfile:
+            outfile.write(json.dumps(report,
+                                     indent=4,
+                                     ))
+    
+    return report
+
+class EventStream:
+    """
+    Stream of the progress events of a run, written as json lines.
+    
+    Every event is a json object on its own line, flushed as soon as it is
+    written, with keys "event" (Ex. "patient_finish"), "time", "elapsed_s"
+    (seconds since the start of the run), "patients_done",
+    "comparisons_done", "comparisons_per_s", "patients_per_h" and "eta_s"
+    (seconds still needed at the current rate, None until the first
+    comparison is computed), followed by the values of the event.
+
+    Parameters
+    ----------
+    events_path : str
+        Path to the file where events are appended, "-" for the standard
+        output.
+    patients : int
+        Number of patients to compute in the run.
+    comparisons : int
+        Number of comparisons to compute in the run, used for the ETA.
+    columns : list
+        Columns of the rows of the final data, the compared methods and the
+        alias name of every comparison are read from them.
+
+    """
+    def __init__(self,
+                 events_path,
+                 patients,
+                 comparisons,
+                 columns,
+                 ):
+        if events_path == "-":
+            self.stream = sys.stdout
+        else:
+            self.stream = open(events_path, "a")
+        self.columns = list(columns)
+        self.start = time.perf_counter()
+        self.start_time = time.time()
+        self.patients = patients
+        self.patients_done = 0
+        self.comparisons_done = 0
+        self.comparisons_left = comparisons
+        
+        # Comparisons planned for every patient queued and not started yet,
+        # planned and already written for every patient running.
+        self.queued = {}
+        self.planned = {}
+        self.streamed = {}
+    
+    def emit(self,
+             event,
+             **values,
+             ):
+        """
+        Writing an event with the current throughput and ETA.
+
+        Parameters
+        ----------
+        event : str
+            Name of the event.
+        **values
+            Additional values of the event.
+
+        Returns
+        -------
+        record : dict
+            The event as written.
+
+        """
+        elapsed = time.perf_counter() - self.start
+        if elapsed > 0 and self.comparisons_done > 0:
+            comparisons_per_s = self.comparisons_done / elapsed
+            eta_s = self.comparisons_left / comparisons_per_s
+        else:
+            comparisons_per_s = 0.0
+            eta_s = None
+        if elapsed > 0:
+            patients_per_h = 3600 * self.patients_done / elapsed
+        else:
+            patients_per_h = 0.0
+        
+        record = {"event": event,
+                  "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "elapsed_s": elapsed,
+                  "patients_done": self.patients_done,
+                  "comparisons_done": self.comparisons_done,
+                  "comparisons_per_s": comparisons_per_s,
+                  "patients_per_h": patients_per_h,
+                  "eta_s": eta_s,
+                  **values,
+                  }
+        self.stream.write(json.dumps(record, default=str) + "\n")
+        self.stream.flush()
+        
+        return record
+    
+    def run_start(self):
+        """
+        Writing the "run_start" event, with the planned patients and
+        comparisons.
+
+        """
+        return self.emit("run_start",
+                         patients=self.patients,
+                         comparisons=self.comparisons_left,
+                         )
+    
+    def patient_queued(self,
+                       patient_folder,
+                       comparisons,
+                       ):
+        """
+        Writing the "patient_queued" event of a patient sent to a worker
+        process, which may start it later.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        comparisons : int
+            Number of comparisons planned for the patient.
+
+        """
+        self.queued[patient_folder] = comparisons
+        return self.emit("patient_queued",
+                         patient_folder=patient_folder,
+                         comparisons=comparisons,
+                         )
+    
+    def patient_start(self,
+                      patient_folder,
+                      comparisons=None,
+                      started=None,
+                      ):
+        """
+        Writing the "patient_start" event.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        comparisons : int or None
+            Number of comparisons planned for the patient. If None the ones
+            given when the patient was queued are used.
+        started : float or None
+            Time (as returned by time.time) when the patient actually
+            started, Ex. in a worker process. It is written as "started_s",
+            seconds since the start of the run. If None the patient starts
+            now.
+
+        """
+        queued = self.queued.pop(patient_folder, None)
+        if comparisons is None:
+            comparisons = queued
+        self.planned[patient_folder] = comparisons
+        self.streamed[patient_folder] = 0
+        if started is None:
+            started_s = time.perf_counter() - self.start
+        else:
+            started_s = started - self.start_time
+        return self.emit("patient_start",
+                         patient_folder=patient_folder,
+                         comparisons=comparisons,
+                         started_s=started_s,
+                         )
+    
+    def comparison(self,
+                   patient_folder,
+                   row,
+                   ):
+        """
+        Writing the "comparison" event of a computed row.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        row : list
+            Row of the final data (see HD_DSC.ComparisonResult.to_row).
+
+        """
+        self.comparisons_done += 1
+        self.comparisons_left = max(self.comparisons_left - 1, 0)
+        self.streamed[patient_folder] = self.streamed.get(patient_folder, 0) + 1
+        return self.emit("comparison",
+                         patient_folder=patient_folder,
+                         compared_methods=row[self.columns.index("Compared methods")],
+                         alias_name=row[self.columns.index("Alias name")],
+                         )
+    
+    def patient_finish(self,
+                       patient_folder,
+                       seconds,
+                       error=None,
+                       ):
+        """
+        Writing the "patient_finish" event.
+        
+        Planned comparisons that were not computed (Ex. a segment missing in
+        the patient) are removed from the ones left, so that the ETA does not
+        count them.
+
+        Parameters
+        ----------
+        patient_folder : str
+            Name of the patient folder.
+        seconds : float
+            Seconds spent computing the patient.
+        error : str or None
+            Error that stopped the patient, None if it succeeded.
+
+        """
+        computed = self.streamed.pop(patient_folder, 0)
+        planned = self.planned.pop(patient_folder, computed)
+        
+        self.patients_done += 1
+        self.comparisons_left = max(self.comparisons_left
+                                    - max(planned - computed, 0),
+                                    0,
+                                    )
+        return self.emit("patient_finish",
+                         patient_folder=patient_folder,
+                         status="failed" if error is not None else "computed",
+                         comparisons=computed,
+                         seconds=seconds,
+                         )
+    
+    def drain(self, queue):
+        """
+        Writing the events sent by the worker processes (see WorkerEvents)
+        that are waiting in the queue, without waiting for new ones.
+
+        Parameters
+        ----------
+        queue : queue.Queue or multiprocessing.managers proxy
+            Queue shared with the worker processes.
+
+        """
+        while True:
+            try:
+                event, patient_folder, value = queue.get_nowait()
+            except Empty:
+                return
+            if event == "patient_start":
+                self.patient_start(patient_folder,
+                                   started=value,
+                                   )
+            else:
+                self.comparison(patient_folder,
+                                value,
+                                )
+    
+    def close(self):
+        """
+        Writing the "run_end" event and closing the file.
+
+        """
+        self.emit("run_end")
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+class WorkerEvents:
+    """
+    Progress events of a patient computed in a worker process.
+    
+    Events are sent to the main process through a queue shared with it (Ex.
+    made by multiprocessing.Manager), where EventStream.drain writes them as
+    soon as they arrive. The object can be pickled, so it can be passed to
+    the worker with the patient.
+
+    Parameters
+    ----------
+    queue : multiprocessing.managers proxy or queue.Queue
+        Queue shared with the main process.
+    patient_folder : str
+        Name of the patient folder.
+
+    """
+    def __init__(self,
+                 queue,
+                 patient_folder,
+                 ):
+        self.queue = queue
+        self.patient_folder = patient_folder
+    
+    def patient_start(self, started):
+        """
+        Sending the start of the patient.
+
+        Parameters
+        ----------
+        started : float
+            Time (as returned by time.time) when the patient started.
+
+        """
+        self.queue.put(("patient_start", self.patient_folder, started))
+    
+    def comparison(self, row):
+        """
+        Sending a computed row of the patient.
+
+        Parameters
+        ----------
+        row : list
+            Row of the final data (see HD_DSC.ComparisonResult.to_row).
+
+        """
+        self.queue.put(("comparison", self.patient_folder, list(row)))